@@ -0,0 +1,244 @@
+'''
+Benchmarks of the simulation and fitting hot paths
+
+    1. simulate:             BanditModel.simulate() in generative mode, for each forager
+    2. negLL_func:           one likelihood evaluation (= one simulation in fitting mode) for each model in MODELS
+    3. fit_bandit:           DE fit of one real session (export/FOR*.npz)
+    4. run_sessions_parallel: the testbed at several n_reps
+    5. prepare_logistic:     design matrix of the logistic regression
+    6. compute_LL_surface:   fit + likelihood surface of fake data on the shared pool
+
+Run from the repo root:
+    python benchmarks/bench_hot_paths.py                                  # All, print only
+    python benchmarks/bench_hot_paths.py --only simulate negLL --quick    # Groups whose name contains any of these
+    python benchmarks/bench_hot_paths.py --output bench.json              # Save results (JSON, one record per benchmark)
+    python benchmarks/bench_hot_paths.py --compare bench.json             # Ratios to a previous run (regression tracking)
+
+Times are in seconds: best and median of --repeat runs, after one warm-up run.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import multiprocessing as mp
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import matplotlib
+matplotlib.use('Agg')   # Some benchmarked functions plot
+
+from models.bandit_model import BanditModel
+from models.bandit_model_comparison import MODELS
+from models.fitting_functions import negLL_func, fit_bandit
+
+
+# =============================================================================
+#   Harness
+# =============================================================================
+
+def timeit(func, repeat = 5, warmup = 1):
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+def record(group, name, times, **params):
+    result = {'group': group, 'name': name, 'params': params, 'repeat': len(times),
+              'best': float(np.min(times)), 'median': float(np.median(times)), 'times': [float(t) for t in times]}
+    print('%-22s %-50s best %9.4f s   median %9.4f s' % (group, name, result['best'], result['median']))
+    sys.stdout.flush()
+    return result
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = ROOT, capture_output = True, text = True).stdout.strip()
+    except OSError:
+        commit = ''
+    import scipy
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpu_count': mp.cpu_count()}
+
+
+# =============================================================================
+#   Data
+# =============================================================================
+
+def mid_paras(para_names, lower, upper):
+    return {name: (lo + hi) / 2 for name, lo, hi in zip(para_names, lower, upper)}
+
+def fake_session(n_trials = 1000, seed = 0):
+    np.random.seed(seed)
+    bandit = BanditModel('Hattori2019', n_trials = n_trials, learn_rate_rew = 0.4, learn_rate_unrew = 0.1,
+                         forget_rate = 0.1, softmax_temperature = 0.3, p_reward_seed_override = seed)
+    bandit.simulate()
+    return bandit.choice_history[:, :n_trials], bandit.reward_history[:, :n_trials]
+
+def real_session(data_dir = os.path.join(ROOT, 'export')):
+    '''
+    First session of the first mouse in export/ (same formatting as fit_each_mice), or None
+    '''
+    files = sorted(f for f in os.listdir(data_dir) if f.endswith('.npz')) if os.path.isdir(data_dir) else []
+    if not files: return None
+
+    data = np.load(os.path.join(data_dir, files[0]))
+    valid_trials = data['choice'] != 0
+    choice = data['choice'][valid_trials] - 1
+    reward = data['reward'][valid_trials]
+    session_num = data['session'][valid_trials]
+    this_session = session_num == np.unique(session_num)[0]
+
+    choice, reward = choice[this_session], reward[this_session]
+    reward_history = np.zeros([2, len(choice)])
+    for c in (0, 1):
+        reward_history[c, choice == c] = (reward[choice == c] > 0).astype(int)
+    return files[0], np.array([choice]), reward_history
+
+
+# =============================================================================
+#   Benchmarks
+# =============================================================================
+
+def bench_simulate(args):
+    foragers = [(forager, mid_paras(names, lo, hi)) for forager, names, lo, hi in MODELS]
+    foragers += [('Random', {}), ('pMatching', {}), ('IdealpHatGreedy', {}), ('IdealpHatOptimal', {})]
+    results, seen = [], set()
+
+    for forager, paras in foragers:
+        key = (forager, tuple(paras))
+        if key in seen: continue
+        seen.add(key)
+
+        def run():
+            BanditModel(forager, n_trials = args.n_trials, **paras).simulate()
+        name = '%s(%s)' % (forager, ','.join(paras))
+        results.append(record('simulate', name, timeit(run, args.repeat), forager = forager, n_trials = args.n_trials))
+    return results
+
+def bench_negLL(args):
+    choice_history, reward_history = fake_session(args.n_trials)
+    results = []
+    for idx, (forager, names, lo, hi) in enumerate(MODELS):
+        x = list(mid_paras(names, lo, hi).values())
+        def run():
+            negLL_func(x, forager, names, choice_history, reward_history, None, {}, [])
+        name = '#%g %s(%s)' % (idx + 1, forager, ','.join(names))
+        results.append(record('negLL_func', name, timeit(run, args.repeat), model = idx + 1, n_trials = args.n_trials))
+    return results
+
+def bench_fit_bandit(args):
+    session = real_session()
+    if session is None:
+        print('fit_bandit: no export/*.npz, skipped')
+        return []
+
+    file, choice_history, reward_history = session
+    results = []
+    for model in [5, 6]:   # RW1972_softmax, Hattori2019 (3 paras)
+        forager, names, lo, hi = MODELS[model - 1]
+        def run():
+            np.random.seed(0)
+            fit_bandit(forager, names, [lo, hi], choice_history, reward_history, fit_method = 'DE', DE_pop_size = 16)
+        name = '#%g %s DE on %s (%g trials)' % (model, forager, file, choice_history.shape[1])
+        results.append(record('fit_bandit', name, timeit(run, 1 if args.quick else 3), model = model, file = file))
+    return results
+
+def bench_run_sessions_parallel(args):
+    from utils.run_foraging_testbed import run_sessions_parallel
+    from utils.worker_pool import get_pool
+
+    bandit = BanditModel('Hattori2019', n_trials = args.n_trials, learn_rate_rew = 0.4, learn_rate_unrew = 0.1,
+                         forget_rate = 0.1, softmax_temperature = 0.3)
+    pools = [('serial', '')] + ([('pool', get_pool(args.workers))] if args.workers > 1 else [])
+    results = []
+    for n_reps in ([10, 50] if args.quick else [10, 100, 500]):
+        for pool_name, pool in pools:
+            def run():
+                run_sessions_parallel(bandit, n_reps = n_reps, pool = pool, if_plot = False)
+            name = 'Hattori2019 n_reps=%g %s' % (n_reps, pool_name)
+            results.append(record('run_sessions_parallel', name, timeit(run, 1 if args.quick else 3),
+                                  n_reps = n_reps, workers = args.workers if pool != '' else 1))
+    return results
+
+def bench_prepare_logistic(args):
+    from utils.descriptive_analysis import prepare_logistic
+    results = []
+    for n_trials in [1000, 20000]:
+        choice = np.random.randint(0, 2, n_trials)
+        reward = np.random.randint(0, 2, n_trials)
+        def run():
+            prepare_logistic(choice, reward, trials_back = 20)
+        results.append(record('prepare_logistic', 'n_trials=%g' % n_trials, timeit(run, args.repeat), n_trials = n_trials))
+    return results
+
+def bench_LL_surface(args):
+    from utils.run_model_recovery import compute_LL_surface
+    n_grid = 6 if args.quick else 15
+    def run():
+        np.random.seed(0)
+        compute_LL_surface('RW1972_softmax', ['learn_rate', 'softmax_temperature'], [[0, 1e-2], [1, 15]], [0.3, 0.2],
+                           n_grids = [[n_grid, n_grid]], fit_method = 'DE', n_trials = 500)
+        matplotlib.pyplot.close('all')
+    name = 'RW1972_softmax %gx%g grid, 500 trials' % (n_grid, n_grid)
+    return [record('compute_LL_surface', name, timeit(run, 1, warmup = 0 if args.quick else 1), n_grid = n_grid)]
+
+BENCHMARKS = {'simulate': bench_simulate,
+              'negLL_func': bench_negLL,
+              'fit_bandit': bench_fit_bandit,
+              'run_sessions_parallel': bench_run_sessions_parallel,
+              'prepare_logistic': bench_prepare_logistic,
+              'compute_LL_surface': bench_LL_surface,
+              }
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = {(r['group'], r['name']): r for r in json.load(f)['results']}
+    print('\n=== Compared with %s (best time, new / old) ===' % baseline_file)
+    for r in results:
+        old = baseline.get((r['group'], r['name']))
+        if old is None: continue
+        ratio = r['best'] / old['best']
+        print('%-22s %-50s %6.2fx %s' % (r['group'], r['name'], ratio, '  <-- slower' if ratio > 1.2 else ''))
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs = '*', default = None, help = 'Only groups containing any of these strings')
+    parser.add_argument('--quick', action = 'store_true', help = 'Fewer repeats and smaller problems')
+    parser.add_argument('--repeat', type = int, default = None)
+    parser.add_argument('--n-trials', type = int, default = 1000)
+    parser.add_argument('--workers', type = int, default = mp.cpu_count())
+    parser.add_argument('--output', default = None, help = 'Save results to this JSON file')
+    parser.add_argument('--compare', default = None, help = 'JSON file of a previous run')
+    args = parser.parse_args(argv)
+    if args.repeat is None: args.repeat = 3 if args.quick else 10
+
+    results = []
+    for group, bench in BENCHMARKS.items():
+        if args.only and not any(s in group for s in args.only): continue
+        results.extend(bench(args))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': metadata(), 'results': results}, f, indent = 1)
+        print('\nSaved to %s' % args.output)
+    if args.compare:
+        compare(results, args.compare)
+
+    from utils.worker_pool import close_pool
+    close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+'''
+Startup-time benchmark
+
+1. Cold import time of the compute path (fresh interpreter for each module, best of n_repeat)
+2. Spin-up time of a spawn-based pool: from creating the pool to getting negLL_func evaluated once on every worker
+
+Run from the repo root:
+    python benchmarks/bench_startup.py
+'''
+
+import os
+import sys
+import time
+import subprocess
+import multiprocessing as mp
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ['numpy',
+           'models.bandit_model',
+           'models.fitting_functions',
+           'models.bandit_model_comparison',
+           'utils.plot_fitting',    # For reference: what every worker used to pay
+           ]
+
+HEAVY = ['matplotlib', 'seaborn', 'statsmodels', 'IPython', 'scipy.stats']
+
+
+def cold_import(module, n_repeat = 5):
+    code = ('import time, sys; t = time.perf_counter(); import %s; '
+            'print(time.perf_counter() - t); print(",".join(m for m in %r if m in sys.modules))') % (module, HEAVY)
+    times = []
+    for _ in range(n_repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd = ROOT, capture_output = True, text = True, check = True).stdout.split('\n')
+        times.append(float(out[0]))
+    return min(times), out[1]
+
+def _eval_once(_):
+    from models.fitting_functions import negLL_func
+    choice = np.random.randint(0, 2, [1, 200])
+    reward = np.random.randint(0, 2, [2, 200])
+    return negLL_func([0.5, 0.5], 'RW1972_softmax', ['learn_rate', 'softmax_temperature'], choice, reward, None, {}, [])
+
+def pool_spin_up(n_workers):
+    ctx = mp.get_context('spawn')
+    start = time.perf_counter()
+    with ctx.Pool(processes = n_workers) as pool:
+        pool.map(_eval_once, range(n_workers), chunksize = 1)
+        return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    print('=== Cold import (best of 5) ===')
+    for module in MODULES:
+        t, heavy = cold_import(module)
+        print('%-35s %7.1f ms   heavy deps loaded: %s' % (module, t * 1000, heavy or '-'))
+
+    print('\n=== Spawn pool spin-up (until negLL_func runs on every worker) ===')
+    for n_workers in [1, 4, mp.cpu_count()]:
+        print('%3g workers: %7.1f ms' % (n_workers, pool_spin_up(n_workers) * 1000))
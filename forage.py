@@ -0,0 +1,272 @@
+'''
+Command-line entry points for the fitting and testbed pipelines
+
+    python forage.py fit      --data export --models 1 9 15 --store results/model_comparison --workers 8 --resume
+    python forage.py cv       --data export --fit-prefix model_comparison --models 15 --store results/model_comparison
+    python forage.py recover  --models 1 2 3 4 5 6 7 8 --n-runs 10 --n-trials 1000 --store results/confusion
+    python forage.py scan     --forager LossCounting --para loss_count_threshold_mean=0:20:21 --set loss_count_threshold_std=0
+    python forage.py scan     --forager Hattori2019 --para learn_rate_rew=0:1:11 learn_rate_unrew=0:1:11 softmax_temperature=0.1,0.3 --ci-target 0.01
+    python forage.py optimize --forager Hattori2019 --n-reps-per-iter 200
+    python forage.py optimize --forager Hattori2019 --n-reps-per-iter 500 --method halving
+
+Every command is split into independent tasks (one mouse / one confusion cell / one scan) which are either
+run right away in this process, or, with --queue, put into a job queue (see utils/job_queue.py):
+
+    python forage.py fit --data export --queue queue.sqlite --enqueue     # Once
+    python forage.py worker --queue queue.sqlite --store results/model_comparison --workers 8     # On each node
+    python forage.py status --queue queue.sqlite
+
+Workers on other machines reach the queue through a small HTTP server on the machine that has the file
+(no authentication: trusted network only; --store must then be a folder shared by all machines):
+
+    python forage.py serve --queue queue.sqlite --host 0.0.0.0 --port 8765      # On the head node
+    python forage.py worker --queue http://head-node:8765 --store /shared/results/model_comparison   # On each node
+
+Options shared by all commands:
+    --workers N      size of the multiprocessing pool used inside each task (1 = serial)
+    --batch-size N   run at most N tasks in this call, then exit (handy for job schedulers with a time limit)
+    --store DIR      where results are saved (same .npz files as before)
+    --resume         skip tasks whose result is already in the store (and was produced by the same settings)
+    --profile DIR    record counts and times of the hot paths in all processes, and print a merged report at the end
+                     (see utils/instrumentation.py)
+'''
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing as mp
+import numpy as np
+
+from utils import instrumentation
+from utils.results_store import ResultStore
+from utils.worker_pool import get_pool, close_pool
+from utils.job_queue import (SQLiteBroker, open_broker, broker_server, run_task, run_worker, result_is_current, collect_confusion_matrix,
+                             fit_all_mice_specs, patch_cross_validation_specs, confusion_matrix_specs,
+                             para_scan_specs, para_optimize_specs)
+
+DEFAULT_DATA = 'export'
+DEFAULT_STORE = os.path.join('results', 'model_comparison')
+
+
+def parse_value(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return {'True': True, 'False': False, 'None': None}.get(value, value)
+
+def parse_para_range(text):
+    '''
+    'name=0.1,0.2,0.5' --> explicit values;  'name=0:1:11' --> np.linspace(0, 1, 11)
+    '''
+    name, values = text.split('=', 1)
+    if ':' in values:
+        lo, hi, num = values.split(':')
+        return name, list(np.linspace(float(lo), float(hi), int(num)))
+    return name, [float(v) for v in values.split(',')]
+
+def parse_fixed_paras(texts):
+    return {name: parse_value(value) for name, value in (t.split('=', 1) for t in texts)}
+
+def make_pool(n_workers):
+    return '' if n_workers <= 1 else get_pool(n_workers = n_workers)
+
+def run_specs(specs, store, pool = '', batch_size = None, if_resume = False):
+    '''
+    Run tasks in this process (no broker)
+    '''
+    n_done = 0
+    for spec in specs:
+        if batch_size is not None and n_done >= batch_size: break
+        if if_resume and result_is_current(store, spec):
+            print('--- %s exists, skipped ---' % spec['key'])
+            continue
+        if if_resume and store.exists(spec['key']):
+            print('--- %s exists but was produced by other settings, rerun ---' % spec['key'])
+
+        print('=== %s (%s) ===' % (spec['task'], spec['key']))
+        sys.stdout.flush()
+        start = time.time()
+        run_task(spec, store, pool)
+        print('--- done in %g mins ---\n' % ((time.time() - start)/60))
+        n_done += 1
+
+    return n_done
+
+
+# =============================================================================
+#   Specs for each command
+# =============================================================================
+
+def specs_fit(args):
+    return fit_all_mice_specs(args.data, save_prefix = args.save_prefix, models = args.models,
+                              if_session_wise = not args.pooled_only, mice = args.mice)
+
+def specs_cv(args):
+    result_to_patch = os.path.join(args.fit_store or args.store, args.fit_prefix + '_')
+    return patch_cross_validation_specs(args.data, result_to_patch, cross_validation_model_num = args.models,
+                                        k_fold = args.k_fold, mice = args.mice)
+
+def specs_recover(args):
+    return confusion_matrix_specs(models = args.models, n_runs = args.n_runs, n_trials = args.n_trials)
+
+def specs_scan(args):
+    para_to_scan = dict(parse_para_range(p) for p in args.para)
+    return para_scan_specs(args.forager, para_to_scan, n_reps = args.n_reps, save_prefix = args.save_prefix,
+                           ci_target = args.ci_target, task = args.task, if_baited = not args.no_baiting, p_reward_sum = args.p_reward_sum,
+                           **parse_fixed_paras(args.set))
+
+def specs_optimize(args):
+    return para_optimize_specs(args.forager, n_reps_per_iter = args.n_reps_per_iter, save_prefix = args.save_prefix,
+                               method = args.method, task = args.task, if_baited = not args.no_baiting, p_reward_sum = args.p_reward_sum,
+                               **parse_fixed_paras(args.set))
+
+def after_recover(args, store):
+    # Assemble the cells into one confusion matrix
+    confusion_results = collect_confusion_matrix(store, models = args.models, n_runs = args.n_runs, n_trials = args.n_trials)
+    store.save('confusion_results', confusion_results = confusion_results)
+    print('Confusion matrix saved to %s' % store.path('confusion_results'))
+
+
+# =============================================================================
+#   Argument parser
+# =============================================================================
+
+def add_common(parser, save_prefix):
+    parser.add_argument('--store', default = DEFAULT_STORE, help = 'Folder of the results store (default: %(default)s)')
+    parser.add_argument('--save-prefix', default = save_prefix, help = 'Prefix of the result files (default: %(default)s)')
+    parser.add_argument('--workers', type = int, default = mp.cpu_count(), help = 'Processes per task (1 = serial; default: %(default)s)')
+    parser.add_argument('--batch-size', type = int, default = None, help = 'Run at most this many tasks, then exit')
+    parser.add_argument('--resume', action = 'store_true', help = 'Skip tasks whose result is already in the store (with the same settings)')
+    parser.add_argument('--queue', default = None, help = 'Job queue (SQLite file, or http://host:port of forage.py serve). Without --enqueue, also run a worker on it')
+    parser.add_argument('--enqueue', action = 'store_true', help = 'Only put the tasks into --queue')
+    parser.add_argument('--profile', default = None, metavar = 'DIR', help = 'Record per-stage counts and times into DIR')
+
+def add_testbed(parser):
+    parser.add_argument('--forager', required = True)
+    parser.add_argument('--task', default = 'Bandit_block', choices = ['Bandit_block', 'Bandit_restless'])
+    parser.add_argument('--no-baiting', action = 'store_true')
+    parser.add_argument('--p-reward-sum', type = float, default = 0.45)
+    parser.add_argument('--set', nargs = '*', default = [], metavar = 'NAME=VALUE', help = 'Fixed parameters of the forager')
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog = 'forage', description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest = 'command', required = True)
+
+    p = sub.add_parser('fit', help = 'Model comparison of all mice (fit_all_mice)')
+    add_common(p, 'model_comparison')
+    p.add_argument('--data', default = DEFAULT_DATA, help = 'Folder of the exported behavior (default: %(default)s)')
+    p.add_argument('--mice', nargs = '*', default = None, help = 'Only these mice (e.g. FOR01 FOR05)')
+    p.add_argument('--models', nargs = '*', type = int, default = None, help = 'Model indices in MODELS (1-based; default: all)')
+    p.add_argument('--pooled-only', action = 'store_true', help = 'Skip the session-wise fitting')
+    p.set_defaults(get_specs = specs_fit)
+
+    p = sub.add_parser('cv', help = 'Patch fitted results with cross validation (patch_cross_validation)')
+    add_common(p, 'model_comparison')
+    p.add_argument('--data', default = DEFAULT_DATA)
+    p.add_argument('--mice', nargs = '*', default = None)
+    p.add_argument('--fit-prefix', default = 'model_comparison', help = 'Prefix of the fitted results to patch')
+    p.add_argument('--fit-store', default = None, help = 'Folder of the fitted results (default: --store)')
+    p.add_argument('--models', nargs = '*', type = int, default = [15])
+    p.add_argument('--k-fold', type = int, default = 2)
+    p.set_defaults(get_specs = specs_cv)
+
+    p = sub.add_parser('recover', help = 'Model recovery confusion matrix (compute_confusion_matrix)')
+    add_common(p, 'confusion')
+    p.add_argument('--models', nargs = '*', type = int, default = [1,2,3,4,5,6,7,8])
+    p.add_argument('--n-runs', type = int, default = 2)
+    p.add_argument('--n-trials', type = int, default = 1000)
+    p.set_defaults(get_specs = specs_recover, after = after_recover)
+
+    p = sub.add_parser('scan', help = 'N-D parameter scan of a forager (para_scan)')
+    add_common(p, 'para_scan')
+    add_testbed(p)
+    p.add_argument('--para', nargs = '+', required = True, metavar = 'NAME=LO:HI:N|V1,V2,..', help = 'Parameters to scan (any number; full grid)')
+    p.add_argument('--n-reps', type = int, default = 500, help = 'Sessions per grid cell (maximum, with --ci-target)')
+    p.add_argument('--ci-target', type = float, default = None, help = 'Adaptive replication: stop a cell once the 95%% CI half-width of its efficiency is below this')
+    p.set_defaults(get_specs = specs_scan)
+
+    p = sub.add_parser('optimize', help = 'Optimize a forager for foraging efficiency (para_optimize)')
+    add_common(p, 'para_optimize')
+    add_testbed(p)
+    p.add_argument('--n-reps-per-iter', type = int, default = 200, help = 'Sessions per candidate (maximum, with --method halving)')
+    p.add_argument('--method', default = 'DE', choices = ['DE', 'halving'], help = 'halving: successive halving with common random numbers')
+    p.set_defaults(get_specs = specs_optimize)
+
+    p = sub.add_parser('worker', help = 'Run tasks from a job queue')
+    p.add_argument('--queue', required = True, help = 'SQLite job queue file, or http://host:port of forage.py serve')
+    p.add_argument('--store', default = DEFAULT_STORE)
+    p.add_argument('--workers', type = int, default = mp.cpu_count())
+    p.add_argument('--batch-size', type = int, default = None)
+    p.add_argument('--resume', action = 'store_true')
+    p.add_argument('--wait', action = 'store_true', help = 'Keep polling when the queue is empty')
+    p.add_argument('--profile', default = None, metavar = 'DIR', help = 'Record per-stage counts and times into DIR')
+
+    p = sub.add_parser('serve', help = 'Serve a SQLite job queue to workers on other machines (HTTP)')
+    p.add_argument('--queue', required = True, help = 'SQLite job queue file on this machine')
+    p.add_argument('--host', default = '127.0.0.1', help = 'Address to listen on (0.0.0.0: all interfaces; default: %(default)s)')
+    p.add_argument('--port', type = int, default = 8765)
+
+    p = sub.add_parser('status', help = 'Task counts of a job queue')
+    p.add_argument('--queue', required = True)
+    p.add_argument('--requeue-stale', type = float, default = None, metavar = 'HOURS',
+                   help = 'Requeue running tasks started more than HOURS ago (dead workers)')
+    p.add_argument('--show-failed', action = 'store_true')
+
+    return parser
+
+
+def main(argv = None):
+    args = build_parser().parse_args(argv)
+
+    if args.command == 'serve':
+        server = broker_server(SQLiteBroker(args.queue), args.host, args.port)
+        print('Serving %s on http://%s:%g (Ctrl+C to stop)' % (args.queue, args.host, args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    if args.command == 'status':
+        broker = open_broker(args.queue)
+        if args.requeue_stale is not None:
+            print('Requeued %g stale tasks' % broker.requeue_stale(args.requeue_stale * 3600))
+        print(broker.counts())
+        if args.show_failed:
+            for task_id, spec, error in broker.failed_tasks():
+                print('--- Task %g: %s ---\n%s' % (task_id, spec, error))
+        return
+
+    if getattr(args, 'enqueue', False):
+        if args.queue is None: raise ValueError('--enqueue needs --queue')
+        task_ids = open_broker(args.queue).enqueue_many(args.get_specs(args))
+        print('Enqueued %g tasks to %s' % (len(task_ids), args.queue))
+        return
+
+    if args.profile: instrumentation.enable(args.profile)   # Before the pool, so that the workers record too
+    store = ResultStore(args.store)
+    pool = make_pool(args.workers)
+
+    try:
+        if args.command == 'worker' or args.queue is not None:
+            broker = open_broker(args.queue)
+            if args.command != 'worker':
+                broker.enqueue_many(args.get_specs(args))
+            run_worker(broker, store, pool = pool, max_tasks = args.batch_size,
+                       if_wait = getattr(args, 'wait', False), if_skip_existing = args.resume)
+            print(broker.counts())
+        else:
+            run_specs(args.get_specs(args), store, pool = pool, batch_size = args.batch_size, if_resume = args.resume)
+            if hasattr(args, 'after'): args.after(args, store)
+    finally:
+        close_pool()   # Workers dump their counters when they exit
+        if instrumentation.enabled(): instrumentation.report()
+
+
+if __name__ == '__main__':  # This line is essential for multiprocessing to run in Windows
+    main()
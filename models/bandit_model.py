@@ -33,7 +33,8 @@
 #  = Other types that can simulate but not fit =
 #   1. 'Random'
 #   2. 'IdealpHatGreedy'
-#   3. 'pMatching'
+#   3. 'IdealpHatOptimal'
+#   4. 'pMatching'
 #
 # Feb 2020, Han Hou (houhan@gmail.com) @ Janelia
 # Svoboda & Li lab
@@ -41,9 +42,11 @@
 
 
 import numpy as np
-from scipy.stats import norm
+import math
+import functools
 from utils.helper_func import softmax, choose_ps
 from models.random_walk import RandomWalkReward
+from utils.instrumentation import instrument
 
 LEFT = 0
 RIGHT = 1
@@ -52,6 +55,36 @@ global_block_size_mean = 80
 global_block_size_sd = 20
 
 
+@functools.lru_cache(maxsize=None)
+def IdealpHatOptimal_strategy(p_max, p_min, run_max=1000, if_baited=True):
+    '''
+    Best {m, n} pattern (m trials on the rich side, n on the lean side, repeated) of a forager that knows the p_reward of the current block,
+    and its long-run reward per trial (for 2-arm task). Memoized per (p_max, p_min), so each pair is solved only once per process.
+
+    States are (side, run length on that side). With baiting, staying on a side gives p of that side, and leaving a side after a run of j
+    trials gives 1 - (1 - p_other)**(j + 1) on the other side. For a given gain (reward per trial), the relative-value Bellman equations
+    split into one optimal-stopping problem per side, solved here for all run lengths (<= run_max) at once; the gain is then updated to
+    that of the resulting cycle (policy iteration), until the policy is stable (a few iterations).
+    '''
+    if p_min <= 0 or not if_baited:
+        return [run_max, 1], p_max   # Safe to be always on p_max side for this block
+
+    run = np.arange(1, run_max + 1)
+    stay_rich = (run - 1) * p_max + 1 - (1 - p_min) ** (run + 1)   # A run of m on the rich side (+ first trial back on the lean side)
+    stay_lean = (run - 1) * p_min + 1 - (1 - p_max) ** (run + 1)
+
+    gain, mn = p_max, [run_max, 1]   # Start from always staying on the rich side
+    while True:
+        m = np.argmax(stay_rich - gain * run)
+        n = np.argmax(stay_lean - gain * run)
+        gain_new = (stay_rich[m] + stay_lean[n]) / (run[m] + run[n])
+        if gain_new <= gain: break
+        gain, mn = gain_new, [int(run[m]), int(run[n])]
+
+    return mn, float(gain)
+
+
+
 class BanditModel:
     '''
     Foragers that can simulate and fit bandit models
@@ -97,8 +130,13 @@ class BanditModel:
                  loss_count_threshold_mean=None,
                  loss_count_threshold_std=0,
 
+                 # Denominator of foraging_efficiency: rewards of 'IdealpHatGreedy' (default) or 'IdealpHatOptimal'
+                 foraging_eff_baseline='IdealpHatGreedy',
+
                  # If true, use the same random seed for generating p_reward!!
                  p_reward_seed_override='',
+                 # If not '', seed of everything random after the p_reward schedule (baiting, agent's choices), for common random numbers
+                 agent_seed_override='',
                  p_reward_sum=0.45,   # Gain of reward. Default = 0.45
                  p_reward_pairs=None,  # Full control of reward prob
 
@@ -126,6 +164,8 @@ class BanditModel:
         self.loss_count_threshold_mean = loss_count_threshold_mean
         self.loss_count_threshold_std = loss_count_threshold_std
         self.p_reward_seed_override = p_reward_seed_override
+        self.agent_seed_override = agent_seed_override
+        self.foraging_eff_baseline = foraging_eff_baseline
         self.p_reward_sum = p_reward_sum
         self.p_reward_pairs = p_reward_pairs
 
@@ -322,6 +362,7 @@ class BanditModel:
         if '_CK' in self.forager:
             self.choice_kernel = np.zeros([self.K, self.n_trials + 1])
 
+    @instrument('generate_p_reward')
     def generate_p_reward(self, block_size_base=global_block_size_mean,
                           block_size_sd=global_block_size_sd,
                           # (Bari-Cohen 2019)
@@ -401,35 +442,34 @@ class BanditModel:
         self.p_reward_ratio = p_reward[RIGHT, :] / \
             p_reward[LEFT, :]   # For future use
 
-        # We should make it random afterwards
-        np.random.seed()
+        # We should make it random afterwards (unless the agent's noise is also fixed)
+        np.random.seed(None if self.agent_seed_override == '' else self.agent_seed_override)
         
 
     def get_AmBn_choice_history(self, p_reward_this_block, n_trials_this_block, n_trials_now):
         
-        if not self.if_para_optim:  
-            # Calculate theoretical upper bound (ideal-p^-optimal) and the (fixed) choice history/matching point of it
-            # Ideal-p^-Optimal
-            # mn_star_pHatOptimal, p_star_pHatOptimal = self.get_IdealpHatOptimal_strategy(p_reward_this_block[0])
-            # self.rewards_IdealpHatOptimal += p_star_pHatOptimal * n_trials_this_block
-            pass
+        # Calculate theoretical upper bound (ideal-p^-optimal) and the (fixed) choice history/matching point of it
+        # Ideal-p^-Optimal (memoized, so this is cheap even during para_optim)
+        mn_star_pHatOptimal, p_star_pHatOptimal = self.get_IdealpHatOptimal_strategy(p_reward_this_block[0])
+        self.rewards_IdealpHatOptimal += p_star_pHatOptimal * n_trials_this_block
 
         # Ideal-p^-Greedy
         mn_star_pHatGreedy, p_star_pHatGreedy = self.get_IdealpHatGreedy_strategy(
             p_reward_this_block[0])
-        mn_star = mn_star_pHatGreedy
         # Ideal-p^-Greedy
         self.rewards_IdealpHatGreedy += p_star_pHatGreedy * n_trials_this_block
 
 
-        if self.forager == 'IdealpHatGreedy':
-            # For ideal optimal, given p_0(t) and p_1(t), the optimal choice history is fixed, i.e., {m_star, 1} (p_min > 0)
+        if self.forager in ['IdealpHatGreedy', 'IdealpHatOptimal']:
+            mn_star = mn_star_pHatGreedy if self.forager == 'IdealpHatGreedy' else mn_star_pHatOptimal
+            
+            # For ideal optimal, given p_0(t) and p_1(t), the optimal choice history is fixed, i.e., {m_star, n_star} (p_min > 0)
             S = int(np.ceil(n_trials_this_block/(mn_star[0] + mn_star[1])))
             c_max_this = np.argwhere(p_reward_this_block[0] == np.max(
                 p_reward_this_block))[0]  # To handle the case of p0 = p1
             c_min_this = np.argwhere(
                 p_reward_this_block[0] == np.min(p_reward_this_block))[-1]
-            # Choice pattern of {m_star, 1}
+            # Choice pattern of {m_star, n_star}
             c_star_this_block = ([c_max_this] * mn_star[0] +
                                 [c_min_this] * mn_star[1]) * S
             # Truncate to the correct length
@@ -439,6 +479,13 @@ class BanditModel:
                                 n_trials_this_block] = np.hstack(c_star_this_block)  # Save the optimal sequence
             
 
+    def get_IdealpHatOptimal_strategy(self, p_reward):
+        '''
+        Ideal-p^-optimal, the real optimal {m, n} given the current p^ (see IdealpHatOptimal_strategy)
+        '''
+        return IdealpHatOptimal_strategy(float(np.max(p_reward)), float(np.min(p_reward)), 
+                                         run_max=self.n_trials, if_baited=bool(self.if_baited))
+
     def get_IdealpHatGreedy_strategy(self, p_reward):
         '''
         Ideal-p^-greedy, only care about the current p^, which is good enough (for 2-arm task)  03/28/2020
@@ -484,8 +531,9 @@ class BanditModel:
 
             # Predict this choice prob
             # To be general, and ensure that alway switch when mean = 0, std = 0
-            prob_switch = norm.cdf(
-                self.loss_count[0, self.time], self.loss_count_threshold_mean - 1e-6, self.loss_count_threshold_std + 1e-16)
+            # (= scipy.stats.norm.cdf; math.erfc avoids importing scipy.stats on every worker)
+            prob_switch = 0.5 * math.erfc(-(self.loss_count[0, self.time] - (self.loss_count_threshold_mean - 1e-6))
+                                          / ((self.loss_count_threshold_std + 1e-16) * math.sqrt(2)))
 
             # Choice prob [choice] = 1-prob_switch, [others] = prob_switch /(K-1). Assuming randomly switch to other alternatives
             self.predictive_choice_prob[:,
@@ -694,7 +742,7 @@ class BanditModel:
 
         # -- Predefined --
         # Foragers that have the pattern {AmBn} (not for fitting)
-        if self.forager in ['IdealpHatGreedy']:
+        if self.forager in ['IdealpHatGreedy', 'IdealpHatOptimal']:
             return self.choice_history[0, self.time]  # Already initialized
 
         # Probability matching of base probabilities p (not for fitting)
@@ -780,6 +828,7 @@ class BanditModel:
         if '_CK' in self.forager:  # Could be independent of other foragers, so use "if" rather than "elif"
             self.step_choice_kernel(choice)
 
+    @instrument()
     def simulate(self):
 
         # =============================================================================
@@ -810,12 +859,11 @@ class BanditModel:
         # Method 4: Sum of all ever-baited rewards (not fair)  
         # self.maximum_rewards = np.sum(np.sum(self.reward_available, axis = 0))
         
-        ''' Use ideal-p^-optimal'''
-        # self.maximum_rewards = self.rewards_IdealpHatGreedy
-        # if not para_optim: 
-        #     self.maximum_rewards = self.rewards_IdealpHatOptimal
-        # else:  # If in optimization, fast and good
-        self.maximum_rewards = self.rewards_IdealpHatGreedy
+        ''' Use ideal-p^-greedy (default; fast and good), or ideal-p^-optimal (the real upper bound)'''
+        if self.foraging_eff_baseline == 'IdealpHatOptimal':
+            self.maximum_rewards = self.rewards_IdealpHatOptimal
+        else:
+            self.maximum_rewards = self.rewards_IdealpHatGreedy
             
         self.foraging_efficiency = self.actual_rewards / self.maximum_rewards
         
@@ -835,6 +883,7 @@ class BanditModelRestless(BanditModel):
         self.if_baited = False
         
 
+    @instrument('generate_p_reward')
     def generate_p_reward(self):
 
         restless_bandit = RandomWalkReward(p_min=self.p_min, p_max=self.p_max, sigma=self.sigma, mean=self.mean)
@@ -858,8 +907,8 @@ class BanditModelRestless(BanditModel):
         self.p_reward_ratio = p_reward[RIGHT, :] / \
             p_reward[LEFT, :]   # For future use
 
-        # We should make it random afterwards
-        np.random.seed()
+        # We should make it random afterwards (unless the agent's noise is also fixed)
+        np.random.seed(None if self.agent_seed_override == '' else self.agent_seed_override)
         
         self.rewards_IdealpHatOptimal = 1
         self.rewards_IdealpHatGreedy = 1
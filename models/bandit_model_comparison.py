@@ -9,8 +9,9 @@ import pandas as pd
 import time
 
 from models.fitting_functions import fit_bandit, cross_validate_bandit
-from utils.plot_fitting import plot_model_comparison_predictive_choice_prob, plot_model_comparison_result
-from IPython.display import display
+from utils.shared_dataset import SharedDataset
+from utils.table_builder import TableBuilder
+# Plotting (matplotlib, seaborn, statsmodels) and IPython are imported on first use, so that workers only fitting models don't load them
 
 # Default models (reordered with hindsight results). Use the format: [forager, [para_names], [lower bounds], [higher bounds]]
 MODELS = [
@@ -114,9 +115,13 @@ class BanditModelComparison:
                   plot_generative = None):
         
         self.results_raw = []
-        self.results = pd.DataFrame()
+        results = TableBuilder()
         
         if if_verbose: print('=== Model Comparison ===\nMethods = %s, %s, pool = %s' % (fit_method, fit_settings, pool!=''))
+        
+        # Put the data into shared memory once for all models
+        data = SharedDataset(if_share = pool != '', choice_history = self.fit_choice_history, reward_history = self.fit_reward_history, session_num = self.session_num)
+        
         for mm, model in enumerate(self.models):
             # == Get settings for this model ==
             forager, fit_names, fit_lb, fit_ub = model
@@ -139,16 +144,19 @@ class BanditModelComparison:
             if if_verbose: print('Model %g/%g: %15s, Km = %g ...'%(mm+1, len(self.models), forager, Km), end='')
             start = time.time()
                 
-            result_this = fit_bandit(forager, fit_names, fit_bounds, self.fit_choice_history, self.fit_reward_history, self.session_num,
+            result_this = fit_bandit(forager, fit_names, fit_bounds, data['choice_history'], data['reward_history'], data['session_num'],
                                      fit_method = fit_method, **fit_settings, 
                                      pool = pool, if_predictive = True) #plot_predictive is not None)
             
             if if_verbose: print(' AIC = %g, BIC = %g (done in %.3g secs)' % (result_this.AIC, result_this.BIC, time.time()-start) )
             self.results_raw.append(result_this)
-            self.results = self.results.append(pd.DataFrame({'model': [forager], 'Km': Km, 'AIC': result_this.AIC, 'BIC': result_this.BIC, 
-                                    'LPT_AIC': result_this.LPT_AIC, 'LPT_BIC': result_this.LPT_BIC, 'LPT': result_this.LPT,
-                                    'para_names': [fit_names], 'para_bounds': [fit_bounds], 
-                                    'para_notation': [para_notation], 'para_fitted': [np.round(result_this.x,3)]}, index = [mm+1]))
+            results.add_row({'model': forager, 'Km': Km, 'AIC': result_this.AIC, 'BIC': result_this.BIC, 
+                             'LPT_AIC': result_this.LPT_AIC, 'LPT_BIC': result_this.LPT_BIC, 'LPT': result_this.LPT,
+                             'para_names': fit_names, 'para_bounds': fit_bounds, 
+                             'para_notation': para_notation, 'para_fitted': np.round(result_this.x,3)}, index = mm+1)
+        
+        data.close()
+        self.results = results.build()
         
         # == Reorganize data ==
         delta_AIC = self.results.AIC - np.min(self.results.AIC) 
@@ -181,10 +189,12 @@ class BanditModelComparison:
     
     def cross_validate(self, k_fold = 2, fit_method = 'DE', fit_settings = {'DE_pop_size': 16}, pool = '', if_verbose = True):
         
-        self.prediction_accuracy_CV = pd.DataFrame()
+        prediction_accuracy_CV = TableBuilder()
         
         if if_verbose: print('=== Cross validation ===\nMethods = %s, %s, pool = %s' % (fit_method, fit_settings, pool!=''))
         
+        data = SharedDataset(if_share = pool != '', choice_history = self.fit_choice_history, reward_history = self.fit_reward_history, session_num = self.session_num)
+        
         for mm, model in enumerate(self.models):
             # == Get settings for this model ==
             forager, fit_names, fit_lb, fit_ub = model
@@ -208,29 +218,34 @@ class BanditModelComparison:
             start = time.time()
                 
             prediction_accuracy_test, prediction_accuracy_fit, prediction_accuracy_test_bias_only= cross_validate_bandit(forager, fit_names, fit_bounds, 
-                                                                                      self.fit_choice_history, self.fit_reward_history, self.session_num, 
+                                                                                      data['choice_history'], data['reward_history'], data['session_num'], 
                                                                                       k_fold = k_fold, **fit_settings, pool = pool, if_verbose = if_verbose) #plot_predictive is not None)
             
             if if_verbose: print('  \n%g-fold CV: Test acc.= %s, Fit acc. = %s (done in %.3g secs)' % (k_fold, prediction_accuracy_test, prediction_accuracy_fit, time.time()-start) )
             
-            self.prediction_accuracy_CV = pd.concat([self.prediction_accuracy_CV, 
-                                                     pd.DataFrame({'model#': mm,
-                                                                   'forager': forager,
-                                                                   'Km': Km,
-                                                                   'para_notation': para_notation,
-                                                                   'prediction_accuracy_test': prediction_accuracy_test, 
-                                                                   'prediction_accuracy_fit': prediction_accuracy_fit,
-                                                                   'prediction_accuracy_test_bias_only': prediction_accuracy_test_bias_only})])
+            prediction_accuracy_CV.add_frame({'model#': mm,
+                                              'forager': forager,
+                                              'Km': Km,
+                                              'para_notation': para_notation,
+                                              'prediction_accuracy_test': prediction_accuracy_test, 
+                                              'prediction_accuracy_fit': prediction_accuracy_fit,
+                                              'prediction_accuracy_test_bias_only': prediction_accuracy_test_bias_only})
+        
+        data.close()
+        self.prediction_accuracy_CV = prediction_accuracy_CV.build()
             
         return
 
     def plot_predictive_choice(self):
+        from utils.plot_fitting import plot_model_comparison_predictive_choice_prob
         plot_model_comparison_predictive_choice_prob(self)
 
     def show(self):
+        from IPython.display import display
         pd.options.display.max_colwidth = 100
         display(self.results_sort[['model','Km', 'AIC','log10_BF_AIC', 'model_weight_AIC', 'BIC','log10_BF_BIC', 'model_weight_BIC', 'para_notation','para_fitted']].round(2))
         
     def plot(self):
+        from utils.plot_fitting import plot_model_comparison_result
         plot_model_comparison_result(self)
 
@@ -6,54 +6,52 @@ Created on Tue May 26 00:33:58 2020
 """
 
 import numpy as np
-import scipy.optimize as optimize
 from tqdm import tqdm
 
-from utils.helper_func import softmax
+from utils.helper_func import softmax, softmax_batch, logistic_2arm
+from utils.worker_pool import n_pool_workers
 
 
 def fit_dynamic_learning_rate_session(choice_history, reward_history, slide_win = 10, pool = '', x0 = [], fixed_sigma_bias = 'None', method = 'DE'):
-    ''' Fit R-W 1972 with sliding window = 10 (Wang, ..., Botvinick, 2018) '''
+    ''' 
+    Fit R-W 1972 with sliding window = 10 (Wang, ..., Botvinick, 2018) 
+    Windows are chained (Q_0 of each window comes from the fit of the previous one), so they are fitted one after another,
+    each one warm-started from the previous optimum. pool is not used (the DE population is evaluated in one vectorized call instead).
+    '''
     
     trial_n = np.shape(choice_history)[1]
-    if x0 == []:    x0 = [0.4, 0.4, 0]
+    if len(x0) == 0:    x0 = [0.4, 0.4, 0]
     
     # Settings for RW1972
     # ['RW1972_softmax', ['learn_rate', 'softmax_temperature', 'biasL'],[0, 1e-2, -5],[1, 15, 5]]
     
+    fixed_sigma_bias = str(fixed_sigma_bias).lower()
     if fixed_sigma_bias == 'global':
         fit_bounds = [[0, x0[1], x0[2]],[1, x0[1], x0[2]]]  # Fixed sigma and bias at the global fitted parameters
     elif fixed_sigma_bias == 'zeros':
         fit_bounds = [[0, 1e-4, 0], [1, 1e-4, 0]]
-    elif fixed_sigma_bias == 'none' :
+    else:   # 'none'
         fit_bounds = [[0, 1e-2, -5],[1, 15, 5]]
         
-    
+    choice_history = np.asarray(choice_history).astype(int)
     Q = np.zeros(np.shape(reward_history))  # Cache of Q values (using the best fit at each step)
     choice_prob = Q.copy()
     fitted_learn_rate = np.zeros(np.shape(choice_history))
     fitted_sigma = np.zeros(np.shape(choice_history))
     fitted_bias = np.zeros(np.shape(choice_history))
     
+    x_last = np.clip(x0, *fit_bounds)
+    
     for t in tqdm(range(1, trial_n - slide_win), desc = 'Sliding window', total = trial_n - slide_win):
     # for t in range(1, trial_n - slide_win):  # Start from the second trial
         Q_0 = Q[:, t-1] # Initial Q for this window
         choice_this = choice_history[:, t : t + slide_win]
         reward_this = reward_history[:, t : t + slide_win]
         
-        if method == 'DE':
-            fitting_result = optimize.differential_evolution(func = negLL_slide_win, args = (Q_0, choice_this, reward_this),
-                                                  bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]), 
-                                                  mutation=(0.5, 1), recombination = 0.7, popsize = 4, strategy = 'best1bin', 
-                                                  disp = False, 
-                                                  workers = 1 if pool == '' else 8,   # For DE, use pool to control if_parallel, although we don't use pool for DE
-                                                  updating = 'immediate' if pool == '' else 'deferred')
-        else:        
-            fitting_result = optimize.minimize(negLL_slide_win, x0, args = (Q_0, choice_this, reward_this), method = 'L-BFGS-B', 
-                        bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]))
+        x_last = _fit_window(negLL_slide_win, (Q_0, choice_this, reward_this), fit_bounds, x_last, method)
 
         # Save parameters
-        learn_rate, softmax_temperature, biasL = fitting_result.x
+        learn_rate, softmax_temperature, biasL = x_last
         fitted_learn_rate[:, t] = learn_rate
         fitted_sigma[:, t] = softmax_temperature
         fitted_bias[:, t] = biasL
@@ -71,124 +69,130 @@ def fit_dynamic_learning_rate_session_no_bias_free_Q_0(choice_history, reward_hi
     ''' 
     Fit R-W 1972 with sliding window = 10 (Wang, ..., Botvinick, 2018) 
     For each sliding window, allows Q_init to be a parameter, no bias term   
+    Here the windows are independent of each other, so with a pool, they are split into contiguous chunks and fitted in parallel
+    (within a chunk, each window is warm-started from the previous one)
     '''
         
     trial_n = np.shape(choice_history)[1]
-    if x0 == []:    x0 = [0.4, 0.4, 0.5, 0.5]
+    if len(x0) == 0:    x0 = [0.4, 0.4, 0.5, 0.5]
     
     # Settings for RW1972
     # ['RW1972_softmax', ['learn_rate', 'softmax_temperature', 'Q_0'],[0, 1e-2, -5],[1, 15, 5]]
     
+    fixed_sigma = str(fixed_sigma).lower()
     if fixed_sigma == 'global':
         fit_bounds = [[0, x0[1], 0,0],[1, x0[1], 1,1]]  # Fixed sigma and bias at the global fitted parameters
     elif fixed_sigma == 'zeros':
         fit_bounds = [[0, 1e-4, 0,0], [1, 1e-4, 1,1]]
-    elif fixed_sigma == 'none' :
+    else:   # 'none'
         fit_bounds = [[0, 1e-2, 0,0],[1, 15, 1,1]]
     
+    choice_history = np.asarray(choice_history).astype(int)
+    window_starts = np.arange(1, trial_n - slide_win)   # Start from the second trial
+    
+    if pool == '':
+        fitted_x = _fit_windows_free_Q_0(choice_history, reward_history, window_starts, slide_win, fit_bounds, x0, method)
+    else:
+        n_chunks = n_pool_workers(pool)
+        result_ids = [pool.apply_async(_fit_windows_free_Q_0, args = (choice_history, reward_history, starts, slide_win, fit_bounds, x0, method))
+                      for starts in np.array_split(window_starts, n_chunks) if len(starts)]
+        fitted_x = np.vstack([result_id.get() for result_id in result_ids])
+    
+    # Simulate one step from each window's best fit
+    learn_rate, softmax_temperature = fitted_x[:, 0], fitted_x[:, 1]
+    fitted_Q_0 = fitted_x[:, 2:].T    # [2, n_windows]
+    choice_0 = choice_history[0, window_starts]
+    chosen = choice_0 == np.arange(2)[:, None]
+    
     Q = np.zeros(np.shape(reward_history))  # Cache of Q values (using the best fit at each step)
     choice_prob = Q.copy()
     fitted_learn_rate = np.zeros(np.shape(choice_history))
     fitted_sigma = np.zeros(np.shape(choice_history))
-    # fitted_Q_0 = np.zeros(np.shape(choice_history))
-    
-    for t in tqdm(range(1, trial_n - slide_win), desc = 'Sliding window', total = trial_n - slide_win):
-    # for t in range(1, trial_n - slide_win):  # Start from the second trial
-        choice_this = choice_history[:, t : t + slide_win]
-        reward_this = reward_history[:, t : t + slide_win]
-        
-        if method == 'DE':
-            fitting_result = optimize.differential_evolution(func = negLL_slide_win_no_bias_free_Q_0, args = (choice_this, reward_this),
-                                                  bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]), 
-                                                  mutation=(0.5, 1), recombination = 0.7, popsize = 4, strategy = 'best1bin', 
-                                                  disp = False, 
-                                                  workers = 1 if pool == '' else 8,   # For DE, use pool to control if_parallel, although we don't use pool for DE
-                                                  updating = 'immediate' if pool == '' else 'deferred')
-        else:        
-            fitting_result = optimize.minimize(negLL_slide_win_no_bias_free_Q_0, x0, args = (choice_this, reward_this), method = 'L-BFGS-B', 
-                        bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]))
+    fitted_learn_rate[:, window_starts] = learn_rate
+    fitted_sigma[:, window_starts] = softmax_temperature
 
-        # Save parameters
-        learn_rate, softmax_temperature, Q_0_L, Q_0_R = fitting_result.x
-        fitted_learn_rate[:, t] = learn_rate
-        fitted_sigma[:, t] = softmax_temperature
-        fitted_Q_0 = np.array([Q_0_L, Q_0_R])
+    Q[:, window_starts] = fitted_Q_0 + chosen * learn_rate * (reward_history[:, window_starts] - fitted_Q_0)   # Only the chosen side is updated
+    choice_prob[:, window_starts] = softmax_batch((Q[:, window_starts] / softmax_temperature).T).T    # Choice prob (just for validation)
         
-        # Simulate one step to get the first Q from this best fit as the initial value of the next window
-        choice_0 = choice_this[0, 0]
-        Q[choice_0, t] = fitted_Q_0[choice_0] + learn_rate * (reward_this[choice_0, 0] - fitted_Q_0[choice_0])  # Chosen side
-        Q[1 - choice_0, t] = fitted_Q_0[1-choice_0]   # Unchosen side
+    return fitted_learn_rate, fitted_sigma, fitted_Q_0[:, -1], Q, choice_prob
+
+
+def _fit_windows_free_Q_0(choice_history, reward_history, window_starts, slide_win, fit_bounds, x0, method):
+    ''' Fit a run of consecutive windows, each one warm-started from the previous optimum. Returns [n_windows, 4] '''
+    fitted_x = np.zeros([len(window_starts), len(fit_bounds[0])])
+    x_last = np.clip(x0, *fit_bounds)
+    
+    for i, t in enumerate(window_starts):
+        args = (choice_history[:, t : t + slide_win], reward_history[:, t : t + slide_win])
+        x_last = fitted_x[i] = _fit_window(negLL_slide_win_no_bias_free_Q_0, args, fit_bounds, x_last, method)
         
-        choice_prob[:, t] = softmax(Q[:, t], softmax_temperature)    # Choice prob (just for validation)
+    return fitted_x
+
+
+def _fit_window(func, args, fit_bounds, x_last, method):
+    '''
+    One window. x_last (the optimum of the previous window) seeds the DE population, or is the starting point of L-BFGS-B
+    '''
+    import scipy.optimize as optimize
+    
+    if method == 'DE':
+        fitting_result = optimize.differential_evolution(func = func, args = args, x0 = x_last,
+                                              bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]), 
+                                              mutation=(0.5, 1), recombination = 0.7, popsize = 4, strategy = 'best1bin', 
+                                              disp = False, vectorized = True, updating = 'deferred')
+    else:        
+        fitting_result = optimize.minimize(func, x_last, args = args, method = 'L-BFGS-B', 
+                    bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]))
         
-    return fitted_learn_rate, fitted_sigma, fitted_Q_0, Q, choice_prob
+    return fitting_result.x
     
     
 def negLL_slide_win(fit_value, *args):
-    '''    Negative likelihood function for the sliding window    '''
+    '''    
+    Negative likelihood function for the sliding window
+    fit_value: [learn_rate, softmax_temperature, biasL], or [3, S] for S parameter sets at once (DE with vectorized = True)
+    '''
     
     # Arguments interpretation
     Q_0, choices, rewards = args
     learn_rate, softmax_temperature, biasL = fit_value
-    bias_terms = np.array([biasL, 0])
-    
-    trial_n_win = np.shape(choices)[1]
-    Q_win = np.zeros_like(rewards)  # K_arm * trial_n
-    choice_prob_win = np.zeros_like(rewards)
     
-    # -- Do mini-simulation in this sliding window (light version of RW1972) --
-    for t in range(trial_n_win):
-        Q_old = Q_0 if t == 0 else Q_win[:, t - 1]
-        
-        # Update Q
-        choice_this = choices[0, t]
-        Q_win[choice_this, t] = Q_old[choice_this] + learn_rate * (rewards[choice_this, t] - Q_old[choice_this])  # Chosen side
-        Q_win[1 - choice_this, t] = Q_old[1 - choice_this]   # Unchosen side
-        
-        # Update choice_prob
-        choice_prob_win[:, t] = softmax(Q_win[:, t], softmax_temperature, bias = bias_terms)  
-        
-    # Compute negative likelihood
-    likelihood_each_trial = choice_prob_win [choices[0,:], range(trial_n_win)]  # Get the actual likelihood for each trial
-    
-    # Deal with numerical precision
-    likelihood_each_trial[(likelihood_each_trial <= 0) & (likelihood_each_trial > -1e-5)] = 1e-16  # To avoid infinity, which makes the number of zero likelihoods informative!
-    likelihood_each_trial[likelihood_each_trial > 1] = 1
-    
-    negLL = - sum(np.log(likelihood_each_trial))
-        
-    return negLL
+    return _negLL_RW_win(learn_rate, softmax_temperature, biasL, Q_0[0], Q_0[1], choices, rewards)
 
 def negLL_slide_win_no_bias_free_Q_0(fit_value, *args):
-    '''    Negative likelihood function for the sliding window    '''
+    '''    
+    Negative likelihood function for the sliding window
+    fit_value: [learn_rate, softmax_temperature, Q_0_L, Q_0_R], or [4, S] for S parameter sets at once
+    '''
     
     # Arguments interpretation
     choices, rewards = args
     learn_rate, softmax_temperature, Q_0_L, Q_0_R = fit_value
         
-    trial_n_win = np.shape(choices)[1]
-    Q_win = np.zeros_like(rewards)  # K_arm * trial_n
-    choice_prob_win = np.zeros_like(rewards)
-    
-    # -- Do mini-simulation in this sliding window (light version of RW1972) --
-    for t in range(trial_n_win):
-        Q_old = np.array([Q_0_L, Q_0_R]) if t == 0 else Q_win[:, t - 1]
-        
-        # Update Q
-        choice_this = choices[0, t]
-        Q_win[choice_this, t] = Q_old[choice_this] + learn_rate * (rewards[choice_this, t] - Q_old[choice_this])  # Chosen side
-        Q_win[1 - choice_this, t] = Q_old[1 - choice_this]   # Unchosen side
-        
-        # Update choice_prob
-        choice_prob_win[:, t] = softmax(Q_win[:, t], softmax_temperature)  
-        
-    # Compute negative likelihood
-    likelihood_each_trial = choice_prob_win [choices[0,:], range(trial_n_win)]  # Get the actual likelihood for each trial
-    
-    # Deal with numerical precision
-    likelihood_each_trial[(likelihood_each_trial <= 0) & (likelihood_each_trial > -1e-5)] = 1e-16  # To avoid infinity, which makes the number of zero likelihoods informative!
-    likelihood_each_trial[likelihood_each_trial > 1] = 1
-    
-    negLL = - sum(np.log(likelihood_each_trial))
-        
-    return negLL
+    return _negLL_RW_win(learn_rate, softmax_temperature, 0, Q_0_L, Q_0_R, choices, rewards)
+
+def _negLL_RW_win(learn_rate, softmax_temperature, biasL, Q_0_L, Q_0_R, choices, rewards):
+    '''
+    Mini-simulation of RW1972 in a window (vectorized over parameter sets) --> negative log likelihood
+    Same numerics as helper_func.softmax: greedy choice when the softmax would overflow, and zero likelihoods count as 1e-16
+    '''
+    learn_rate, softmax_temperature, biasL = np.broadcast_arrays(*[np.asarray(x, dtype = float) for x in (learn_rate, softmax_temperature, biasL)])
+    choices = np.asarray(choices[0], dtype = int)
+    trial_n_win = len(choices)
+    
+    # Only the Q update is recursive: Q after each trial, [2, trial_n_win, ...]
+    Q = np.empty((2, trial_n_win) + learn_rate.shape)
+    Q_this = [Q_0_L + np.zeros(learn_rate.shape), Q_0_R + np.zeros(learn_rate.shape)]
+    for t, choice_this in enumerate(choices):
+        Q_this[choice_this] = Q_this[choice_this] + learn_rate * (rewards[choice_this, t] - Q_this[choice_this])  # Chosen side
+        Q[0, t], Q[1, t] = Q_this
+    
+    # Likelihood of the actual choices, all trials at once
+    X = Q / softmax_temperature
+    X[0] += biasL
+    chosen = (choices == 0).reshape((trial_n_win,) + (1,) * learn_rate.ndim)
+    X_chosen, X_unchosen = np.where(chosen, X[0], X[1]), np.where(chosen, X[1], X[0])
+    
+    likelihood = logistic_2arm(X_chosen, X_unchosen)
+    likelihood[likelihood <= 0] = 1e-16   # To avoid infinity, which makes the number of zero likelihoods informative!
+    return - np.sum(np.log(likelihood), axis = 0)
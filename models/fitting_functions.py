@@ -4,19 +4,22 @@ Created on Thu Mar 19 16:30:26 2020
 @author: Han
 """
 import numpy as np
-import scipy.optimize as optimize
-import multiprocessing as mp
 # from tqdm import tqdm  # For progress bar. HH
 
 from models.bandit_model import BanditModel
+from utils.shared_dataset import SharedDataset, resolve
+from utils.worker_pool import de_workers
+from utils.instrumentation import instrument, de_generation_timer
 global fit_history
 
+@instrument()
 def negLL_func(fit_value, *argss):
     '''
     Compute negative likelihood (Core func)
     '''
     # Arguments interpretation
     forager, fit_names, choice_history, reward_history, session_num, para_fixed, fit_set = argss
+    choice_history, reward_history, session_num, fit_set = map(resolve, (choice_history, reward_history, session_num, fit_set))  # Data could be shared-memory handles
     
     kwargs_all = {'forager': forager, **para_fixed}  # **kargs includes all other fixed parameters
     for (nn, vv) in zip(fit_names, fit_value):
@@ -57,7 +60,7 @@ def negLL_func(fit_value, *argss):
     
     likelihood_all_trial = np.array(likelihood_all_trial)
     
-    if fit_set == []: # Use all trials
+    if len(fit_set) == 0: # Use all trials
         negLL = - sum(np.log(likelihood_all_trial))
     else:   # Only return likelihoods in the fit_set
         negLL = - sum(np.log(likelihood_all_trial[fit_set]))
@@ -68,7 +71,7 @@ def negLL_func(fit_value, *argss):
     
     return negLL
 
-def callback_history(x, **kargs):
+def callback_history(x, *args, **kargs):
     '''
     Store the intermediate DE results. I have to use global variable as a workaround. Any better ideas?
     '''
@@ -82,6 +85,10 @@ def fit_each_init(forager, fit_names, fit_bounds, choice_history, reward_history
     '''
     For local optimizers, fit using ONE certain initial condition    
     '''
+    import scipy.optimize as optimize   # Not at module level: workers that only evaluate negLL_func don't need scipy
+    
+    choice_history, reward_history, session_num = map(resolve, (choice_history, reward_history, session_num))
+    
     x0 = []
     for lb,ub in zip(fit_bounds[0], fit_bounds[1]):
         x0.append(np.random.uniform(lb,ub))
@@ -94,12 +101,15 @@ def fit_each_init(forager, fit_names, fit_bounds, choice_history, reward_history
     return fitting_result
 
 
+@instrument()
 def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history, session_num = None, 
                if_predictive = False, if_generative = False,  # Whether compute predictive or generative choice sequence
                if_history = False, fit_method = 'DE', DE_pop_size = 16, n_x0s = 1, pool = ''):
     '''
     Main fitting func and compute BIC etc.
     '''
+    import scipy.optimize as optimize
+    
     if if_history: 
         global fit_history
         fit_history = []
@@ -107,16 +117,20 @@ def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history, s
         
     # === Fitting ===
     
+    # In parallel mode, data go to the workers once via shared memory instead of being pickled for every task / evaluation
+    data = SharedDataset(if_share = pool != '', choice_history = choice_history, reward_history = reward_history, session_num = session_num)
+    choice_history, reward_history, session_num = map(resolve, (choice_history, reward_history, session_num))   # In case handles are passed in
+    
     if fit_method == 'DE':
         
         # Use DE's own parallel method
-        fitting_result = optimize.differential_evolution(func = negLL_func, args = (forager, fit_names, choice_history, reward_history, session_num, {}, []),
+        fitting_result = optimize.differential_evolution(func = negLL_func, args = (forager, fit_names, data['choice_history'], data['reward_history'], data['session_num'], {}, []),
                                                          bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]), 
                                                          mutation=(0.5, 1), recombination = 0.7, popsize = DE_pop_size, strategy = 'best1bin', 
                                                          disp = False, 
-                                                         workers = 1 if pool == '' else int(mp.cpu_count()),   # For DE, use pool to control if_parallel, although we don't use pool for DE
+                                                         workers = de_workers(pool),   # DE runs on the given pool (no new pool for every fit)
                                                          updating = 'immediate' if pool == '' else 'deferred',
-                                                         callback = callback_history if if_history else None,)
+                                                         callback = de_generation_timer(callback_history if if_history else None),)
         if if_history:
             fit_history.append(fitting_result.x.copy())  # Add the final result
             fit_histories = [fit_history]  # Backward compatibility
@@ -132,7 +146,7 @@ def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history, s
             # Must use two separate for loops, one for assigning and one for harvesting!
             for nn in range(n_x0s):
                 # Assign jobs
-                pool_results.append(pool.apply_async(fit_each_init, args = (forager, fit_names, fit_bounds, choice_history, reward_history, session_num, fit_method, 
+                pool_results.append(pool.apply_async(fit_each_init, args = (forager, fit_names, fit_bounds, data['choice_history'], data['reward_history'], data['session_num'], fit_method, 
                                                                             None)))   # We can have multiple histories only in serial mode
             for rr in pool_results:
                 # Get data    
@@ -162,6 +176,8 @@ def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history, s
         if if_history and fit_histories != []:
             fit_histories.insert(0,fit_histories.pop(best_ind))  # Move the best one to the first
         
+    data.close()
+    
     if if_history:
         fitting_result.fit_histories = fit_histories
         
@@ -203,7 +219,7 @@ def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history, s
             # Run **PREDICTIVE** simulation    
             bandit = BanditModel(forager = forager, **kwargs_all, fit_choice_history = choice_this, fit_reward_history = reward_this)  # Into the fitting mode
             bandit.simulate()
-            predictive_choice_prob.append(bandit.predictive_choice_prob)
+            predictive_choice_prob.append(bandit.predictive_choice_prob[:, :choice_this.shape[1]])   # Drop the prediction after the last trial
         
         fitting_result.predictive_choice_prob = np.hstack(predictive_choice_prob)
         
@@ -220,6 +236,11 @@ def cross_validate_bandit(forager, fit_names, fit_bounds, choice_history, reward
     '''
     k-fold cross-validation
     '''
+    import scipy.optimize as optimize
+    
+    # Share the data with DE workers once for all folds (see fit_bandit)
+    data = SharedDataset(if_share = pool != '', choice_history = choice_history, reward_history = reward_history, session_num = session_num)
+    choice_history, reward_history, session_num = map(resolve, (choice_history, reward_history, session_num))
     
     # Split the data into k_fold parts
     n_trials = np.shape(choice_history)[1]
@@ -239,13 +260,16 @@ def cross_validate_bandit(forager, fit_names, fit_bounds, choice_history, reward
         
         # == Fit data using fit_set_this ==
         if if_verbose: print('%g/%g...'%(kk+1, k_fold), end = '')
-        fitting_result = optimize.differential_evolution(func = negLL_func, args = (forager, fit_names, choice_history, reward_history, session_num, {}, fit_set_this),
+        fit_set_shared = SharedDataset(if_share = pool != '', fit_set = fit_set_this)
+        fitting_result = optimize.differential_evolution(func = negLL_func, args = (forager, fit_names, data['choice_history'], data['reward_history'], data['session_num'], 
+                                                                                    {}, fit_set_shared['fit_set']),
                                                          bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]), 
                                                          mutation=(0.5, 1), recombination = 0.7, popsize = DE_pop_size, strategy = 'best1bin', 
                                                          disp = False, 
-                                                         workers = 1 if pool == '' else int(mp.cpu_count()),   # For DE, use pool to control if_parallel, although we don't use pool for DE
+                                                         workers = de_workers(pool),   # DE runs on the given pool (no new pool for every fit)
                                                          updating = 'immediate' if pool == '' else 'deferred',
                                                          callback = None,)
+        fit_set_shared.close()
             
         # == Rerun predictive choice sequence and get the prediction accuracy of the test_set_this ==
         kwargs_all = {}
@@ -269,10 +293,10 @@ def cross_validate_bandit(forager, fit_names, fit_bounds, choice_history, reward
             # Run PREDICTIVE simulation    
             bandit = BanditModel(forager = forager, **kwargs_all, fit_choice_history = choice_this, fit_reward_history = reward_this)  # Into the fitting mode
             bandit.simulate()
-            predictive_choice_prob.extend(bandit.predictive_choice_prob)
+            predictive_choice_prob.append(bandit.predictive_choice_prob[:, :choice_this.shape[1]])   # Drop the prediction after the last trial
             
         # Get prediction accuracy of the test_set and fitting_set
-        predictive_choice_prob = np.array(predictive_choice_prob)
+        predictive_choice_prob = np.hstack(predictive_choice_prob)
         predictive_choice = np.argmax(predictive_choice_prob, axis = 0)
         prediction_correct = predictive_choice == choice_history[0]
         
@@ -286,6 +310,8 @@ def cross_validate_bandit(forager, fit_names, fit_bounds, choice_history, reward
         
         prediction_accuracy_test_bias_only.append(sum(prediction_correct_bias_only[test_set_this]) / len(test_set_this))
 
+    data.close()
+
     return prediction_accuracy_test, prediction_accuracy_fit, prediction_accuracy_test_bias_only
             
 
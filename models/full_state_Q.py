@@ -6,10 +6,8 @@ Created on Fri May  8 22:29:03 2020
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.animation import FFMpegWriter
 
-from utils.helper_func import choose_ps, softmax
+from utils.helper_func import choose_ps, softmax, softmax_batch
 
 class FullStateQ():
 
@@ -87,6 +85,9 @@ class FullStateQ():
         # print('Right,stay : ', [s.Q[1] for s in self.states[1,:]])
         
     def plot_Q(self, time = np.nan, reward = np.nan, p_reward = np.nan, description = ''):  # Visualize value functions (Q(s,a))
+        import matplotlib.pyplot as plt
+        from matplotlib.animation import FFMpegWriter
+        
         # Initialization
         if self.ax == []:   
             # Prepare axes
@@ -113,10 +114,7 @@ class FullStateQ():
             # Compute policy p(a|s)
             if self.if_softmax:
                 Qs = np.array([s.Q for s in self.states[d,:-1]])
-                ps = []
-                for qq in Qs:
-                    ps.append(softmax(qq, self.softmax_temperature))    
-                ps = np.array(ps)
+                ps = softmax_batch(Qs / self.softmax_temperature)
                 
             for c in [0,1]:
                 self.ax[c, d].cla()
@@ -1,7 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-# matplotlib.use('Qt5Agg')
 
 #  np.random.seed(56)
 
@@ -70,6 +67,9 @@ class RandomWalkReward:
         return acorr
 
     def plot_reward_schedule(self):
+        import matplotlib.pyplot as plt
+        # matplotlib.use('Qt5Agg')
+
         fig, ax = plt.subplots(2, 2, figsize=[15, 7], sharex='col', gridspec_kw=dict(width_ratios=[4, 1], wspace=0.1))
 
         for s, col in zip(['L', 'R'], ['r', 'b']):
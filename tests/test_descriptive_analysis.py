@@ -0,0 +1,61 @@
+'''
+Run from the repo root: python -m pytest tests
+'''
+
+import warnings
+
+import numpy as np
+import pytest
+from sklearn.linear_model import LogisticRegression
+
+from utils.descriptive_analysis import prepare_logistic, logistic_regression_batch
+
+
+def _sessions(n_sessions=8, n_trials=300, trials_back=5, seed=0):
+    ''' Sticky, reward-following choices: the history explains most choices, so the fits are nearly separable at large C '''
+    rng = np.random.default_rng(seed)
+    data, Y = [], []
+    for _ in range(n_sessions):
+        choice, reward = np.zeros(n_trials, dtype=int), np.zeros(n_trials, dtype=int)
+        for t in range(1, n_trials):
+            if_stay = rng.random() < (0.97 if reward[t - 1] else 0.6)
+            choice[t] = choice[t - 1] if if_stay else 1 - choice[t - 1]
+            reward[t] = rng.random() < (0.7 if choice[t] else 0.3)
+        data_this, Y_this = prepare_logistic(choice, reward, trials_back=trials_back)
+        data.append(data_this)
+        Y.append(Y_this)
+    return np.stack(data), np.stack(Y)
+
+
+def _objective(coef, data, Y, C):
+    z = data @ coef[:-1] + coef[-1]
+    return 0.5 * coef @ coef + C * np.sum(np.logaddexp(0, -np.where(Y > 0, 1, -1) * z))
+
+
+@pytest.mark.parametrize('C', [1, 1e2, 1e4, 1e6])
+@pytest.mark.parametrize('init', ['pooled', None, 'liblinear'])
+def test_logistic_regression_batch_matches_liblinear(C, init):
+    data, Y = _sessions()
+    reference = np.array([np.concatenate([(fit := LogisticRegression(solver='liblinear', C=C, tol=1e-8, max_iter=10000).fit(data_this, Y_this)).coef_[0],
+                                          fit.intercept_])
+                          for data_this, Y_this in zip(data, Y)])
+    init_coef = reference.mean(axis=0) if init == 'liblinear' else init
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', RuntimeWarning)   # No overflow, and no fallback to liblinear
+        output, _ = logistic_regression_batch(data, Y, C=C, init_coef=init_coef)
+
+    assert np.all(np.isfinite(output))
+    for coef, coef_ref, data_this, Y_this in zip(output, reference, data, Y):
+        f, f_ref = _objective(coef, data_this, Y_this, C), _objective(coef_ref, data_this, Y_this, C)
+        assert f <= f_ref + 1e-6 * abs(f_ref)
+
+
+def test_logistic_regression_batch_falls_back_to_liblinear():
+    data, Y = _sessions(n_sessions=3)
+    with pytest.warns(RuntimeWarning, match='refitted with liblinear'):
+        output, _ = logistic_regression_batch(data, Y, C=1e4, max_iter=1, init_coef=None)
+
+    for coef, data_this, Y_this in zip(output, data, Y):
+        fit = LogisticRegression(solver='liblinear', C=1e4).fit(data_this, Y_this)
+        assert np.allclose(coef, np.concatenate([fit.coef_[0], fit.intercept_]))
@@ -13,11 +13,16 @@ Assumed format:
 Han Hou, Feb 2023
 '''
 
+import warnings
+
 import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.model_selection import train_test_split
 from sklearn.linear_model import LogisticRegression, LogisticRegressionCV
 
+from utils.shared_dataset import SharedDataset, resolve
+from utils.worker_pool import n_pool_workers
+
 
 def win_stay_lose_shift(choice, reward):
     '''
@@ -30,6 +35,65 @@ def win_stay_lose_shift(choice, reward):
     return: dict{'p_stay_win', 'p_stay_win_CI', ...}
     '''
     
+    p_wsls = {}
+    for name, (k, n) in _wsls_events(np.asarray(choice), np.asarray(reward)).items():
+        p_wsls[name], p_wsls[name + '_CI'] = _binomial(np.sum(k), np.sum(n))
+        
+    return p_wsls
+
+
+def win_stay_lose_shift_grouped(choice, reward, session_num):
+    '''
+    win_stay_lose_shift of many sessions in one pass
+    
+    choice, reward: concatenated sessions (same format as win_stay_lose_shift)
+    session_num: session id of each trial. Transitions across two sessions are not counted.
+    
+    ---
+    return: p_wsls_each, p_wsls_pooled
+            p_wsls_each: dict{'session_num': unique ids, 'p_stay_win': [n_sessions], 'p_stay_win_CI': [n_sessions], ...}
+            p_wsls_pooled: all sessions together, same as win_stay_lose_shift
+    '''
+    return wsls_from_counts(*wsls_counts_grouped(choice, reward, session_num))
+
+
+def wsls_counts_grouped(choice, reward, session_num):
+    '''
+    Event counts behind win_stay_lose_shift_grouped, which can be summed over batches of sessions
+    return: sessions, k_each, n_each  (k_each, n_each: dict{'p_stay_win': [n_sessions], ...})
+    '''
+    choice, reward, session_num = np.asarray(choice), np.asarray(reward), np.asarray(session_num)
+    sessions, session_idx = np.unique(session_num, return_inverse=True)
+    
+    same_session = session_idx[1:] == session_idx[:-1]
+    group = session_idx[:-1]
+    
+    k_each, n_each = {}, {}
+    for name, (k, n) in _wsls_events(choice, reward).items():
+        k, n = k & same_session, n & same_session
+        k_each[name] = np.bincount(group, weights=k, minlength=len(sessions))
+        n_each[name] = np.bincount(group, weights=n, minlength=len(sessions))
+    
+    return sessions, k_each, n_each
+
+
+def wsls_from_counts(sessions, k_each, n_each):
+    '''
+    Counts from wsls_counts_grouped --> p_wsls_each, p_wsls_pooled (see win_stay_lose_shift_grouped)
+    '''
+    p_wsls_each, p_wsls_pooled = {'session_num': sessions}, {}
+    for name in k_each:
+        with np.errstate(invalid='ignore', divide='ignore'):   # Sessions without this event --> nan
+            p_wsls_each[name], p_wsls_each[name + '_CI'] = _binomial(k_each[name], n_each[name])
+            p_wsls_pooled[name], p_wsls_pooled[name + '_CI'] = _binomial(np.sum(k_each[name]), np.sum(n_each[name]))
+    
+    return p_wsls_each, p_wsls_pooled
+
+
+def _wsls_events(choice, reward):
+    '''
+    For each transition t --> t+1: 'p(y|x)': (y & x, x)
+    '''
     stays = np.diff(choice) == 0
     switches = np.diff(choice) != 0
     wins = reward[:-1] == 1
@@ -37,19 +101,13 @@ def win_stay_lose_shift(choice, reward):
     Ls = choice[:-1] == 0
     Rs = choice[:-1] == 1
     
-    p_wsls = {}
-    p_lookup = {'p_stay_win':    (stays & wins, wins),   # 'p(y|x)': (y * x, x)
-                'p_stay_win_L':  (stays & wins & Ls, wins & Ls),
-                'p_stay_win_R':  (stays & wins & Rs, wins & Rs),
-                'p_switch_lose': (switches & loses, loses),
-                'p_switch_lose_L': (switches & loses & Ls, loses & Ls),
-                'p_switch_lose_R': (switches & loses & Rs, loses & Rs),
-                }
-
-    for name, (k, n) in p_lookup.items():
-        p_wsls[name], p_wsls[name + '_CI'] = _binomial(np.sum(k), np.sum(n))
-        
-    return p_wsls
+    return {'p_stay_win':    (stays & wins, wins),   # 'p(y|x)': (y * x, x)
+            'p_stay_win_L':  (stays & wins & Ls, wins & Ls),
+            'p_stay_win_R':  (stays & wins & Rs, wins & Rs),
+            'p_switch_lose': (switches & loses, loses),
+            'p_switch_lose_L': (switches & loses & Ls, loses & Ls),
+            'p_switch_lose_R': (switches & loses & Rs, loses & Rs),
+            }
 
 
 def _binomial(k, n):
@@ -60,48 +118,64 @@ def _binomial(k, n):
     return p, 1.96 * np.sqrt(p * (1 - p) / n)
 
 
-def prepare_logistic(choice, reward, trials_back=15):
+def prepare_logistic(choice, reward, trials_back=20, session_num=None):
     '''    
     Assuming format:
     choice = np.array([0, 1, 1, 0, ...])  # 0 = L, 1 = R
     reward = np.array([0, 0, 0, 1, ...])  # 0 = Unrew, 1 = Reward
+    
+    Also accepts many sessions at once:
+    - choice, reward of shape [n_sessions, n_trials] (same length) --> data [n_sessions, n_trials - trials_back, 3 * trials_back]
+    - or 1-D concatenated sessions with session_num (session id of each trial): the history never crosses 
+      a session boundary, i.e., the first trials_back trials of each session are not used as Y
     ---
     return: data, Y
     '''
-    n_trials = len(choice)
-    trials_back = 20
-    data = []
+    choice, reward = np.asarray(choice), np.asarray(reward)
+    n_trials = choice.shape[-1]
 
     # Encoding data
-    RewC, UnrC, C = np.zeros(n_trials), np.zeros(n_trials), np.zeros(n_trials)
-    RewC[(choice == 0) & (reward == 1)] = -1   # L rew = -1, R rew = 1, others = 0
-    RewC[(choice == 1) & (reward == 1)] = 1
-    UnrC[(choice == 0) & (reward == 0)] = -1    # L unrew = -1, R unrew = 1, others = 0
-    UnrC[(choice == 1) & (reward == 0)] = 1
-    C[choice == 0] = -1
-    C[choice == 1] = 1
-
-    for trial in range(trials_back, n_trials):
-        data.append(np.hstack([RewC[trial - trials_back : trial],
-                            UnrC[trial - trials_back : trial], 
-                            C[trial - trials_back : trial]]))
-    data = np.array(data)
-    Y = C[trials_back:]  # Use -1/1 or 0/1?
+    C = (choice == 1).astype(float) - (choice == 0)   # L = -1, R = 1, others = 0
+    RewC = C * (reward == 1)   # L rew = -1, R rew = 1, others = 0
+    UnrC = C * (reward == 0)   # L unrew = -1, R unrew = 1, others = 0
+
+    if n_trials <= trials_back:
+        return np.zeros(choice.shape[:-1] + (0, 3 * trials_back)), np.zeros(choice.shape[:-1] + (0,))
+    
+    # Windows of the past trials_back trials for each trial (views, no copy): [..., 3, n_trials - trials_back, trials_back]
+    history = np.stack([RewC, UnrC, C], axis=-2)
+    windows = np.lib.stride_tricks.sliding_window_view(history, trials_back, axis=-1)[..., :-1, :]
+    
+    # --> [..., n_trials - trials_back, [RewC(t-trials_back : t), UnrC(...), C(...)]] (the only copy)
+    data = np.moveaxis(windows, -3, -2).reshape(choice.shape[:-1] + (n_trials - trials_back, 3 * trials_back))
+    Y = C[..., trials_back:]  # Use -1/1 or 0/1?
+    
+    if session_num is not None:
+        # Keep trials whose whole history is in the same session
+        session_idx = np.cumsum(np.r_[0, np.diff(np.asarray(session_num)) != 0])
+        valid = session_idx[trials_back:] == session_idx[:-trials_back]
+        data, Y = data[valid], Y[valid]
     
     return data, Y
 
 
-def logistic_regression(data, Y, solver='liblinear', penalty='l2', C=1, test_size=0.10):
+def logistic_regression(data, Y, solver='liblinear', penalty='l2', C=1, test_size=0.10, init_coef=None):
     '''
     Run one logistic regression fit
     (Reward trials + Unreward trials + Choice + bias)
+    init_coef: [coefs..., intercept] to start from (e.g. the full-data fit when bootstrapping).
+               Ignored by liblinear, which can't be warm-started.
     Han 20230208
     '''
     trials_back = int(data.shape[1] / 3)
     
     # Do training
     # x_train, x_test, y_train, y_test = train_test_split(data, Y, test_size=test_size)
-    logistic_reg = LogisticRegression(solver=solver, fit_intercept=True, penalty=penalty, C=C, n_jobs=1)
+    if_warm_start = init_coef is not None and solver != 'liblinear'
+    logistic_reg = LogisticRegression(solver=solver, fit_intercept=True, penalty=penalty, C=C, n_jobs=1, warm_start=if_warm_start)
+    if if_warm_start:
+        logistic_reg.coef_ = np.atleast_2d(init_coef[:-1]).copy()
+        logistic_reg.intercept_ = np.array(init_coef[-1:], dtype=float)
     logistic_reg.fit(data, Y)
     output = np.concatenate([logistic_reg.coef_[0], logistic_reg.intercept_])
     
@@ -113,6 +187,140 @@ def logistic_regression(data, Y, solver='liblinear', penalty='l2', C=1, test_siz
     return output, logistic_reg
 
 
+def _cho_solve_batch(L, b):
+    '''
+    Solve (L @ L.T) x = b for stacks of lower-triangular L [n, k, k] and b [n, k] by forward and back substitution
+    (numpy has no batched triangular solver; k small steps over the whole stack are cheap)
+    '''
+    k = L.shape[-1]
+    LT = L.transpose(0, 2, 1)
+    y = np.empty_like(b)
+    for j in range(k):
+        y[:, j] = (b[:, j] - np.einsum('nk,nk->n', L[:, j, :j], y[:, :j])) / L[:, j, j]
+    x = np.empty_like(b)
+    for j in range(k - 1, -1, -1):
+        x[:, j] = (y[:, j] - np.einsum('nk,nk->n', LT[:, j, j + 1:], x[:, j + 1:])) / L[:, j, j]
+    return x
+
+
+def _logistic_objective(X, coef, sign, weight, C):
+    '''
+    Penalized L2 logistic loss of logistic_regression_batch (divided by C) for a stack of sessions
+    ---
+    return: objective [n_sessions], X @ coef [n_sessions, n_trials]
+    '''
+    z = np.matmul(X, coef[..., None])[..., 0]
+    return 0.5 / C * np.sum(coef ** 2, axis=-1) + np.sum(weight * np.logaddexp(0, -sign * z), axis=-1), z
+
+
+def logistic_regression_batch(data, Y, C=1, sample_weight=None, max_iter=100, tol=1e-5, n_hessian=2, init_coef='pooled', n_pooled=10,
+                              fallback='liblinear'):
+    '''
+    Fit many independent L2 logistic regressions at once (e.g. one per simulated session) with batched, damped Newton (IRLS).
+    Same objective as LogisticRegression(solver='liblinear', penalty='l2', C=C), whose intercept is also penalized:
+        0.5 * |coef, bias|^2 + C * sum(sample_weight * log(1 + exp(-y * (x @ coef + bias))))
+
+    data: [n_sessions, n_trials, n_features] (e.g. stacked prepare_logistic outputs)
+    Y: [n_sessions, n_trials], -1/1 (or 0/1)
+    sample_weight: [n_sessions, n_trials]; set 0 to pad sessions of different lengths
+    n_hessian: the Hessian is updated (and Cholesky-factorized) on the first n_hessian iterations, and after that only for sessions
+               whose last full step did not decrease the objective, or was not much shorter than the one before (it barely changes
+               close to the optimum, and building it is the expensive part). Every step is halved until the objective decreases
+               enough (Armijo), so a stale Hessian or a large C (weak penalty, nearly separable data) can't make the fit diverge
+    tol: a session has converged when no coefficient of its full Newton step is larger than tol; converged sessions drop out
+    init_coef: where all sessions start from. 'pooled': the fit of the first n_pooled sessions pooled together
+               (with the per-session penalty), which is close to every session's optimum and saves iterations;
+               None: zeros; or [n_features + 1] / [n_sessions, n_features + 1]
+    fallback: 'liblinear': sessions that have not converged after max_iter are refitted with liblinear (with a warning);
+              None: they are only warned about
+    ---
+    return: output [n_sessions, n_features + 1] ([coefs..., intercept], as logistic_regression),
+            decode_betas(output) (b_RewC, b_UnrC, b_C, bias, each [n_sessions, ...])
+    '''
+    data, Y = np.asarray(data, dtype=float), np.asarray(Y)
+    n_sessions, n_trials, n_features = data.shape
+    weight = np.ones((n_sessions, n_trials)) if sample_weight is None else np.asarray(sample_weight, dtype=float)
+
+    if isinstance(init_coef, str) and init_coef == 'pooled':
+        n_pooled = min(n_pooled, n_sessions)
+        init_coef = None
+        if n_pooled > 1:   # Pooled = one long session whose weights are divided by n_pooled (= the mean of the per-session objectives)
+            init_coef, _ = logistic_regression_batch(data[:n_pooled].reshape(1, -1, n_features), Y[:n_pooled].reshape(1, -1), C=C,
+                                                     sample_weight=weight[:n_pooled].reshape(1, -1) / n_pooled,
+                                                     max_iter=max_iter, tol=tol, n_hessian=n_hessian, init_coef=None, fallback=fallback)
+
+    X = np.empty((n_sessions, n_trials, n_features + 1))
+    X[..., :-1] = data
+    X[..., -1] = 1
+    sign = np.where(Y > 0, 1., -1.)
+    target = (Y > 0).astype(float)
+
+    coef = np.zeros((n_sessions, n_features + 1)) if init_coef is None else np.broadcast_to(init_coef, (n_sessions, n_features + 1)).astype(float)
+    eye = np.eye(n_features + 1) / C
+
+    # State of the sessions not converged yet (compacted whenever some converge, so converged sessions cost nothing)
+    active = np.arange(n_sessions)
+    X_a, weight_a, sign_a, target_a, coef_a = X, weight, sign, target, coef.copy()
+    L = np.empty((n_sessions, n_features + 1, n_features + 1))
+    if_refresh = np.ones(n_sessions, dtype=bool)
+    last_step = np.full(n_sessions, np.inf)   # max |step| of the previous iteration
+    f, z = _logistic_objective(X_a, coef_a, sign_a, weight_a, C)
+
+    for i in range(max_iter):
+        p = 0.5 + 0.5 * np.tanh(z / 2)   # = 1 / (1 + exp(-z)), without overflow
+        residual = weight_a * (p - target_a)
+        grad = coef_a / C + np.matmul(X_a.transpose(0, 2, 1), residual[..., None])[..., 0]
+
+        refresh = if_refresh | (i < n_hessian)
+        if refresh.any():
+            X_r = X_a if refresh.all() else X_a[refresh]
+            hessian = np.matmul(X_r.transpose(0, 2, 1) * (weight_a * p * (1 - p))[refresh][:, None, :], X_r) + eye
+            L[refresh] = np.linalg.cholesky(hessian)   # The penalized Hessian is positive definite
+
+        step = _cho_solve_batch(L, grad)
+        slope = np.sum(grad * step, axis=-1)   # > 0: a descent direction, even with a stale Hessian
+
+        # Backtracking: halve the steps that don't decrease the objective enough
+        t = np.ones(len(active))
+        coef_new = coef_a - step
+        f_new, z_new = _logistic_objective(X_a, coef_new, sign_a, weight_a, C)
+        for _ in range(40):
+            bad = f_new - f > -1e-4 * t * slope + 1e-12 * np.abs(f)   # (+ rounding of f near the optimum)
+            if not bad.any():
+                break
+            t[bad] /= 2
+            coef_new[bad] = coef_a[bad] - t[bad, None] * step[bad]
+            f_new[bad], z_new[bad] = _logistic_objective(X_a[bad], coef_new[bad], sign_a[bad], weight_a[bad], C)
+        else:   # No decrease even with tiny steps: stay and retry with a fresh Hessian
+            coef_new[bad], f_new[bad], z_new[bad] = coef_a[bad], f[bad], z[bad]
+
+        step_size = np.max(np.abs(step), axis=-1)
+        if_refresh = (t < 1) | (step_size > 0.25 * last_step)   # Stale Hessian: halved or slowly shrinking steps
+        last_step = step_size
+        coef_a, f, z = coef_new, f_new, z_new
+
+        converged = step_size < tol
+        if converged.any():
+            coef[active[converged]] = coef_a[converged]
+            keep = ~converged
+            active, X_a, weight_a, sign_a, target_a = active[keep], X_a[keep], weight_a[keep], sign_a[keep], target_a[keep]
+            coef_a, f, z, L, if_refresh, last_step = coef_a[keep], f[keep], z[keep], L[keep], if_refresh[keep], last_step[keep]
+        if not len(active):
+            break
+
+    if len(active):
+        coef[active] = coef_a
+        warnings.warn(f'logistic_regression_batch: {len(active)} of {n_sessions} sessions did not converge in {max_iter} iterations'
+                      + (', refitted with liblinear' if fallback == 'liblinear' else ''), RuntimeWarning)
+        if fallback == 'liblinear':
+            for ss in active:
+                logistic_reg = LogisticRegression(solver='liblinear', penalty='l2', C=C, fit_intercept=True)
+                logistic_reg.fit(data[ss], Y[ss], sample_weight=weight[ss])
+                coef[ss] = np.concatenate([logistic_reg.coef_[0], logistic_reg.intercept_])
+
+    return coef, decode_betas(coef)
+
+
 def logistic_regression_CV(data, Y, Cs=10, cv=10, solver='liblinear', penalty='l2', n_jobs=-1):
     '''
     logistic regression with cross validation
@@ -135,23 +343,84 @@ def logistic_regression_CV(data, Y, Cs=10, cv=10, solver='liblinear', penalty='l
     return logistic_reg_cv
 
 
-def bootstrap(func, data, Y, n_bootstrap=1000, **kwargs):
-    # Generate bootstrap samples
-    indices = np.random.choice(range(Y.shape[0]), size=(n_bootstrap, Y.shape[0]), replace=True)
-    bootstrap_Y = [Y[index] for index in indices]
-    bootstrap_data = [data[index, :] for index in indices]
+def _bootstrap_chunk(func, data, Y, seed, n, kwargs, batch_size=None):
+    '''
+    Fit n bootstrap samples. Indices are drawn here, one sample (or one batch of samples) at a time, so that 
+    n_bootstrap x n_trials indices never exist at once (and nothing but a seed is sent to the workers)
+    batch_size: if not None, func fits a stack of batch_size samples at once ([batch, n_trials, ...] --> [batch, n_outputs])
+    '''
+    data, Y = resolve(data), resolve(Y)
+    rng = np.random.default_rng(seed)
+    outputs = []
+    if batch_size is None:
+        for _ in range(n):
+            index = rng.integers(0, Y.shape[0], size=Y.shape[0])
+            outputs.append(func(data[index, :], Y[index], **kwargs)[0])
+        return np.array(outputs)
+
+    for start in range(0, n, batch_size):
+        index = rng.integers(0, Y.shape[0], size=(min(batch_size, n - start), Y.shape[0]))
+        outputs.append(func(data[index], Y[index], **kwargs)[0])
+    return np.vstack(outputs)
+
+
+def _bootstrap_summary(outputs):
+    return {'raw': outputs,
+            'mean': np.mean(outputs, axis=0),
+            'std': np.std(outputs, axis=0),
+            'CI_lower': np.percentile(outputs, 2.5, axis=0),
+            'CI_upper': np.percentile(outputs, 97.5, axis=0),
+            'n_bootstrap': len(outputs)}
+
+
+def bootstrap(func, data, Y, n_bootstrap=1000, pool='', chunk_size=50, seed=None, 
+              warm_start_coef=None, CI_tol=None, min_bootstrap=200, batch_size=None, n_workers=None, **kwargs):
+    '''
+    Bootstrap func(data, Y, **kwargs)[0]
     
-    # Fit the logistic regression model to each bootstrap sample
-    outputs = np.array([func(data, Y, **kwargs)[0] for data, Y in zip(bootstrap_data, bootstrap_Y)])
+    pool: if not '', chunks of chunk_size samples are fitted in parallel (data are sent once via shared memory)
+    n_workers: chunks per round with a pool (default: the pool's n_workers, see worker_pool.n_pool_workers)
+    seed: the result is reproducible with a given seed, no matter serial or parallel
+    warm_start_coef: passed to func as init_coef (e.g. the full-data coefficients; logistic_regression with liblinear ignores it,
+                     logistic_regression_batch starts every sample from it)
+    batch_size: func is a batched fitter (e.g. logistic_regression_batch) that takes batch_size samples at once
+    CI_tol: stop early (after at least min_bootstrap samples) when neither end of the 95% CI of any parameter
+            has moved more than CI_tol since the last round of chunks. None = always do n_bootstrap samples
+    ---
+    return: dict{'raw', 'mean', 'std', 'CI_lower', 'CI_upper', 'n_bootstrap'}
+    '''
+    if warm_start_coef is not None:
+        kwargs = {**kwargs, 'init_coef': warm_start_coef}
+
+    # Chunks of samples, each with its own independent seed
+    chunk_sizes = [chunk_size] * (n_bootstrap // chunk_size) + ([n_bootstrap % chunk_size] if n_bootstrap % chunk_size else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    
+    # Chunks are run in rounds (one chunk per worker) so that we can check the CI between rounds
+    n_per_round = n_pool_workers(pool, n_workers)
+    shared = SharedDataset(if_share = pool != '', data = np.asarray(data), Y = np.asarray(Y))
     
-    # Get bootstrap mean, std, and CI
-    bs = {'raw': outputs,
-          'mean': np.mean(outputs, axis=0),
-          'std': np.std(outputs, axis=0),
-          'CI_lower': np.percentile(outputs, 2.5, axis=0),
-          'CI_upper': np.percentile(outputs, 97.5, axis=0)}
+    outputs = []
+    last_CI = None
+    for start in range(0, len(chunk_sizes), n_per_round):
+        this_round = range(start, min(start + n_per_round, len(chunk_sizes)))
+        if pool == '':
+            outputs.extend(_bootstrap_chunk(func, data, Y, seeds[i], chunk_sizes[i], kwargs, batch_size) for i in this_round)
+        else:
+            results = [pool.apply_async(_bootstrap_chunk, args=(func, shared['data'], shared['Y'], seeds[i], chunk_sizes[i], kwargs, batch_size)) 
+                       for i in this_round]
+            outputs.extend(result.get() for result in results)
+        
+        if CI_tol is not None:
+            done = np.vstack(outputs)
+            CI = np.percentile(done, [2.5, 97.5], axis=0)
+            if last_CI is not None and len(done) >= min_bootstrap and np.max(np.abs(CI - last_CI)) < CI_tol:
+                break
+            last_CI = CI
     
-    return bs
+    shared.close()
+
+    return _bootstrap_summary(np.vstack(outputs))
     
     
 def decode_betas(coef):
@@ -165,10 +434,13 @@ def decode_betas(coef):
     return b_RewC, b_UnrC, b_C, bias
 
 
-def logistic_regression_bootstrap(data, Y, n_bootstrap=1000, **kwargs):
+def logistic_regression_bootstrap(data, Y, n_bootstrap=1000, pool='', CI_tol=None, seed=None, batch_size=10, n_workers=None, **kwargs):
     '''
-    1. use cross-validataion to determine the best L2 penality parameter, C
-    2. use bootstrap to determine the CI and std
+    1. use cross-validataion to determine the best L2 penality parameter, C (kwargs go to logistic_regression_CV)
+    2. use bootstrap to determine the CI and std, refitting with the same solver and penalty (kwargs 'solver', 'penalty')
+       With liblinear and L2 (the default), the samples are fitted batch_size at a time by logistic_regression_batch 
+       (the same objective; samples it can't converge are refitted with liblinear), all warm-started from the full-data 
+       coefficients. Otherwise, one by one by logistic_regression. pool, n_workers, CI_tol and seed go to bootstrap()
     '''
     
     # Cross validation
@@ -183,7 +455,11 @@ def logistic_regression_bootstrap(data, Y, n_bootstrap=1000, **kwargs):
     
     # Bootstrap
     if n_bootstrap > 0:
-        bs = bootstrap(logistic_regression, data, Y, n_bootstrap=n_bootstrap, C=best_C[0], **kwargs)
+        fit_kwargs = {key: kwargs[key] for key in ('solver', 'penalty') if key in kwargs}
+        if_batch = fit_kwargs.get('solver', 'liblinear') == 'liblinear' and fit_kwargs.get('penalty', 'l2') == 'l2'
+        bs = bootstrap(logistic_regression_batch if if_batch else logistic_regression, data, Y, n_bootstrap=n_bootstrap, C=best_C[0], 
+                       pool=pool, n_workers=n_workers, CI_tol=CI_tol, seed=seed, warm_start_coef=para_mean, 
+                       batch_size=batch_size if if_batch else None, **({} if if_batch else fit_kwargs))
         
         logistic_reg.coefs_bootstrap = bs
         (logistic_reg.b_RewC_CI, 
@@ -6,6 +6,7 @@
 # =============================================================================
 
 import numpy as np
+from types import SimpleNamespace
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 # import plotly.express as px
@@ -170,7 +171,7 @@ def plot_one_session(bandit, fig='', plottype='2lickport'):
     
 def plot_all_reps(results_all_reps):
     
-    if_restless = 'restless' in results_all_reps['bandits_all_sessions'][0].task
+    if_restless = 'restless' in results_all_reps['task']
     
     fig = plt.figure(figsize=(15*1, 4.5*2))
         
@@ -179,7 +180,7 @@ def plot_all_reps(results_all_reps):
                                                                     results_all_reps['n_reps'], 
                                                                     results_all_reps['n_blocks'], 
                                                                     results_all_reps['n_trials'], 
-                                                                    results_all_reps['bandits_all_sessions'][0].sigma                                                                
+                                                                    results_all_reps['sigma']                                                                
                                                                     ), fontsize = 15)
     else:
         fig.text(0.05,0.94,'%s\n%g sessions, %g blocks, %g trials, p_override = %s' % (results_all_reps['description'], 
@@ -216,9 +217,9 @@ def plot_all_reps(results_all_reps):
     xx = np.linspace(-1, 1, 100)
     yy = []
     
-    for bandit in results_all_reps['bandits_all_sessions']:
-        yy.append(sigmoid(xx, *bandit.psychometric_popt, a=1, b=0))
-        ax1.plot(xx, yy[-1], 'k-', alpha=0.1)  # Fitting from other sessions
+    popt = results_all_reps['psychometric_popt_per_session']
+    yy = sigmoid(xx, popt[:, 0:1], popt[:, 1:2], a=1, b=0)
+    ax1.plot(xx, yy.T, 'k-', alpha=0.1)  # Fitting from other sessions
     
     ax1.plot(xx, np.mean(yy, axis=0), 'k', lw=4)   # Average fitting
     
@@ -232,38 +233,27 @@ def plot_all_reps(results_all_reps):
             'p_switch_lose_R',
             )
     
-    # Fake group data to reuse the plotting function 
-    p_wsls = results_all_reps['bandits_all_sessions'][0].p_wsls
-    
-    for name in p_wsls.keys():
-        if '_CI' in name: continue
-        
-        cache = []
-        for bandit in results_all_reps['bandits_all_sessions']:
-            cache.append(bandit.p_wsls[name])
-        
-        p_wsls[name] = np.mean(cache)
-        p_wsls[name + '_CI'] = np.std(cache, axis=0)/np.sqrt(results_all_reps['n_reps'])
+    # Fake group data to reuse the plotting function: mean +/- sem across sessions
+    p_wsls = {}
+    for name, p_each in results_all_reps['p_wsls_per_session'].items():
+        if '_CI' in name or name == 'session_num': continue
+        p_wsls[name] = np.mean(p_each)
+        p_wsls[name + '_CI'] = np.std(p_each)/np.sqrt(results_all_reps['n_reps'])
     
     plot_wsls(p_wsls, ax=ax2)
     
     # == 4. Plot all logistic regressions ==
-    if_logistic = hasattr(results_all_reps['bandits_all_sessions'][0], 'logistic_reg')
+    if_logistic = 'logistic_betas_per_session' in results_all_reps
     
     if if_logistic:
         ax2 = fig.get_axes()[3]
         
         # Fake a CV class using fittings across simulation runs 
-        logistic_reg = results_all_reps['bandits_all_sessions'][0].logistic_reg
-        
-        cache = {}
+        logistic_reg = SimpleNamespace()
         betas = ['b_RewC', 'b_UnrC', 'b_C', 'bias']
         
         for beta in betas:
-            cache = []
-            for bandit in results_all_reps['bandits_all_sessions']:
-                cache.append(getattr(bandit.logistic_reg, beta)[0, :])
-            
+            cache = results_all_reps['logistic_betas_per_session'][beta]
             mean = np.mean(cache, axis=0)
             sem = np.std(cache, axis=0) / np.sqrt(results_all_reps['n_reps']) * 1.96
             setattr(logistic_reg, beta, np.atleast_2d(mean))
@@ -279,7 +269,7 @@ def plot_all_reps(results_all_reps):
         ax2.set(title='')
             
     
-    # # == 2. Blockwise matching ==
+    # # == 2. Blockwise matching == (results_all_reps['blockwise_stats'] is not computed any more, see run_sessions_parallel)
     # c_frac, inc_frac, c_log_ratio, inc_log_ratio, rtn_log_ratio = results_all_reps['blockwise_stats']
     
     # gs = GridSpec(2,3, wspace=0.3, hspace=0.5, bottom=0.13)    
@@ -406,9 +396,9 @@ def plot_para_scan(results_para_scan, para_to_scan, if_baited = True, p_reward_s
         para_diff = np.diff(para_range)
         if_log = para_diff[0] != para_diff[1]
         
-        paras_foraging_efficiency = results_para_scan['foraging_efficiency_per_session']
-        fe_mean = np.mean(paras_foraging_efficiency, axis = 1)
-        fe_CI95 = 1.96 * np.std(paras_foraging_efficiency, axis = 1) / np.sqrt(n_reps)
+        paras_foraging_efficiency = results_para_scan['foraging_efficiency_per_session']   # nan for sessions not run (adaptive replication)
+        fe_mean = np.nanmean(paras_foraging_efficiency, axis = 1)
+        fe_CI95 = 1.96 * np.nanstd(paras_foraging_efficiency, axis = 1) / np.sqrt(np.sum(~np.isnan(paras_foraging_efficiency), axis = 1))
 
         # matching_slope = results_para_scan['linear_fit_log_income_ratio'][:,3,0]  # "Slope" in Iigaya 2019
         # matching_slope_CI95 = results_para_scan['linear_fit_log_income_ratio'][:,3,1]
@@ -485,7 +475,7 @@ def plot_para_scan(results_para_scan, para_to_scan, if_baited = True, p_reward_s
         
         # Reshape the results to 2-D
         paras_foraging_efficiency = results_para_scan['foraging_efficiency_per_session']
-        fe_mean = np.mean(paras_foraging_efficiency, axis = 1).reshape(len(para_ranges[0]), len(para_ranges[1]))
+        fe_mean = np.nanmean(paras_foraging_efficiency, axis = 1).reshape(len(para_ranges[0]), len(para_ranges[1]))
         matching_slope = results_para_scan['linear_fit_log_income_ratio'][:,3,0].reshape(len(para_ranges[0]), len(para_ranges[1]))
         
         # === Plotting ===
@@ -614,11 +604,11 @@ def plot_model_compet(model_compet_results, model_compet_settings, n_reps, basel
     plt.text(0, 1, '100% = IdealpHatOptimal (theor.)', color = 'k')
  
     # Baseline foragers
-    # baseline_models = ['IdealpHatOptimal','IdealpHatGreedy','pMatching','IdealpGreedy','Random']
-    markers = ['*','*','s','^','X']
-    sizes = [20,15,10,13,13]
+    markers = {'IdealpHatOptimal': '*', 'IdealpHatGreedy': '*', 'pMatching': 's', 'IdealpGreedy': '^', 'Random': 'X'}
+    sizes = {'IdealpHatOptimal': 20, 'IdealpHatGreedy': 15, 'pMatching': 10, 'IdealpGreedy': 13, 'Random': 13}
 
-    for bm_name, bm_eff, bm_ms, bm_marker, bm_size in zip(baselines[0],baselines[1],baselines[2],markers,sizes):
+    for bm_name, bm_eff, bm_ms in zip(baselines[0],baselines[1],baselines[2]):
+        bm_marker, bm_size = markers.get(bm_name, 'o'), sizes.get(bm_name, 10)
         if bm_name in ['Random','IdealpHatOptimal']:
             plt.fill_between([0,1], bm_eff[0] - bm_eff[1], bm_eff[0] + bm_eff[1], color = 'k', alpha = 0.2)
 
@@ -4,10 +4,8 @@ Created on Fri May  8 23:00:16 2020
 
 @author: Han
 """
+import math
 import numpy as np
-import seaborn as sns
-import matplotlib
-from scipy.optimize import curve_fit
 
 
 def softmax(x, softmax_temperature, bias = 0):
@@ -18,26 +16,75 @@ def softmax(x, softmax_temperature, bias = 0):
     else:
         X = np.sum(x/softmax_temperature, axis=0) + bias  # Allow more than one kernels (e.g., choice kernel)
     
-    max_temp = np.max(X)
+    if len(X) == 2:   # Fast path for two arms (called on every trial)
+        X_0, X_1 = X.tolist()
+        if max(X_0, X_1) <= 700:
+            d = X_1 - X_0
+            p_0 = 1 / (1 + math.exp(d)) if d < 700 else math.exp(-d)
+            p_1 = 1 / (1 + math.exp(-d)) if d > -700 else math.exp(d)   # Not 1 - p_0, which would lose tiny probabilities
+            return np.array([p_0, p_1])
     
-    if max_temp > 700: # To prevent explosion of EXP
-        greedy = np.zeros(len(x))
-        greedy[np.random.choice(np.where(X == np.max(X))[0])] = 1
-        return greedy
-    else:   # Normal softmax
-        return np.exp(X)/np.sum(np.exp(X))  # Accept np.
+    return softmax_batch(X[np.newaxis, :])[0]
+
+def softmax_batch(X):
+    '''
+    Softmax of already scaled values X [N, K] along the last axis --> choice probabilities [N, K]
+    K = 2 takes the logistic shortcut. As in softmax(), a row with max(X) > 700 becomes greedy (ties broken at random)
+    '''
+    X = np.asarray(X, dtype=float)
+    
+    if X.shape[-1] == 2:
+        ps = np.stack([logistic_2arm(X[..., 0], X[..., 1], if_greedy=False), 
+                       logistic_2arm(X[..., 1], X[..., 0], if_greedy=False)], axis=-1)
+    else:
+        exp_X = np.exp(X - np.max(X, axis=-1, keepdims=True))
+        ps = exp_X / np.sum(exp_X, axis=-1, keepdims=True)
+    
+    overflow = np.max(X, axis=-1) > 700   # To prevent explosion of EXP (in the old implementation)
+    for idx in zip(*np.nonzero(overflow)):
+        ps[idx] = 0
+        ps[idx][np.random.choice(np.where(X[idx] == np.max(X[idx]))[0])] = 1
+        
+    return ps
+
+def logistic_2arm(X_0, X_1, if_greedy=True):
+    '''
+    p(choose 0) of a 2-arm softmax with scaled values X_0, X_1 (arrays of any broadcastable shapes)
+    if_greedy: same overflow rule as softmax() (max > 700 --> greedy), but ties get 0.5 instead of a random pick
+    '''
+    p_0 = np.exp(-np.logaddexp(0, X_1 - X_0))   # = 1 / (1 + exp(X_1 - X_0)) without overflow
+    
+    if if_greedy:
+        greedy = np.maximum(X_0, X_1) > 700
+        if np.any(greedy):
+            p_0 = np.where(greedy, (X_0 > X_1) + 0.5 * (X_0 == X_1), p_0)
+    return p_0
     
 def choose_ps(ps):
     '''
     "Poisson"-choice process
     '''
-    ps = ps/np.sum(ps)
-    return np.max(np.argwhere(np.hstack([-1e-16, np.cumsum(ps)]) < np.random.rand()))
+    if len(ps) == 2:   # Fast path for two arms
+        p_0, p_1 = ps[0], ps[1]
+        return int(p_0 < np.random.rand() * (p_0 + p_1))
+    return choose_ps_batch(np.asarray(ps)[np.newaxis, :], np.random.rand(1))[0]
+
+def choose_ps_batch(ps, u=None):
+    '''
+    Inverse-CDF sampling of one choice per row of ps [N, K] (rows need not be normalized)
+    u: uniform random numbers [N] (default: np.random.rand(N))
+    '''
+    cum_ps = np.cumsum(ps, axis=-1)
+    if u is None: u = np.random.rand(*cum_ps.shape[:-1])
+    return np.sum(cum_ps < (u * cum_ps[..., -1])[..., np.newaxis], axis=-1)
 
 def seaborn_style():
     """
     Set seaborn style for plotting figures
     """
+    import seaborn as sns   # Plotting libs are imported on first use to keep the compute path light
+    import matplotlib
+    
     sns.set(style="ticks", context="paper", font_scale=1.4)
     # sns.set(style="ticks", context="talk", font_scale=2)
     sns.despine(trim=True)
@@ -50,32 +97,93 @@ def moving_average(a, n=3) :
     return ret[n - 1:] / n
 
 
-def fit_sigmoid_p_choice(p_reward, choice, win=10, stepsize=None):
+def windowed_p_choice(p_reward, choice, win=10, stepsize=None):
+    '''
+    Mean p_R - p_L and fraction of right choices in windows of win trials (every stepsize trials), from cumulative sums.
+    p_reward: [..., 2, n_trials]; choice: [..., n_trials] (leading dimensions = sessions)
+    ---
+    return: mean_p_diff, mean_choice_R_frac, both [..., n_windows]
+    '''
+    p_reward, choice = np.asarray(p_reward, dtype=float), np.asarray(choice)
     if stepsize is None: stepsize = win
-    start_trial = 0
-    mean_p_diff = []
-    mean_choice_R_frac = []
+    starts = np.arange(0, min(choice.shape[-1], p_reward.shape[-1]) - win + 1, stepsize)
+    
+    def window_sums(x):
+        cum = np.concatenate([np.zeros(x.shape[:-1] + (1,)), np.cumsum(x, axis=-1)], axis=-1)
+        return cum[..., starts + win] - cum[..., starts]
+    
+    mean_p_diff = window_sums(p_reward[..., 1, :] - p_reward[..., 0, :]) / win
+    mean_choice_R_frac = window_sums((choice == 1).astype(float)) / win
+    return mean_p_diff, mean_choice_R_frac
 
-    while start_trial + win <= len(choice):
-        end_trial = start_trial + win
+
+def fit_sigmoid_batch(x, y, p0=(0, 1), max_iter=200, tol=1e-10):
+    '''
+    Least-squares fit of y = sigmoid(x, x0, k, a=1, b=0) for a stack of independent problems at once,
+    with a vectorized Levenberg-Marquardt (each row has its own damping).
+    Same minimum as curve_fit(..., method='lm'), which fit_sigmoid_p_choice used to run session by session.
+    x, y: [n_sessions, n_points]
+    ---
+    return: popt [n_sessions, 2] (x0, k), pcov [n_sessions, 2, 2] (scaled as in curve_fit)
+    '''
+    x, y = np.atleast_2d(x), np.atleast_2d(y)
+    n_sessions, n_points = x.shape
+    
+    def residual_and_jacobian(popt):
+        x0, k = popt[:, :1], popt[:, 1:]
+        with np.errstate(over='ignore'):
+            f = 1 / (1 + np.exp(-k * (x - x0)))
+        df = f * (1 - f)
+        jac = np.stack([-k * df, (x - x0) * df], axis=-1)   # [n_sessions, n_points, 2]
+        return y - f, jac
+    
+    popt = np.tile(np.asarray(p0, dtype=float), (n_sessions, 1))
+    damping = np.full(n_sessions, 1e-3)
+    residual, jac = residual_and_jacobian(popt)
+    ssr = np.sum(residual ** 2, axis=1)
+    active = np.ones(n_sessions, dtype=bool)
+    
+    for _ in range(max_iter):
+        jtj = np.einsum('spi,spj->sij', jac, jac)
+        jtr = np.einsum('spi,sp->si', jac, residual)
+        
+        lhs = jtj + damping[:, None, None] * (jtj * np.eye(2) + 1e-12 * np.eye(2))
+        step = np.linalg.solve(lhs, jtr[..., None])[..., 0]
+        step[~active] = 0
+        
+        new_popt = popt + step
+        new_residual, new_jac = residual_and_jacobian(new_popt)
+        new_ssr = np.sum(new_residual ** 2, axis=1)
         
-        mean_p_diff.append(np.mean(np.diff(p_reward[:, start_trial:end_trial], axis=0)))
-        mean_choice_R_frac.append(np.sum(choice[start_trial:end_trial] == 1) / win)
+        better = active & (new_ssr <= ssr)
+        converged = better & (ssr - new_ssr <= tol * (1 + ssr))
         
-        start_trial += stepsize
+        popt[better], residual[better], jac[better] = new_popt[better], new_residual[better], new_jac[better]
+        ssr = np.where(better, new_ssr, ssr)
+        damping = np.where(better, damping / 10, np.minimum(damping * 10, 1e10))
         
-    mean_p_diff = np.array(mean_p_diff)
-    mean_choice_R_frac = np.array(mean_choice_R_frac)
+        active &= ~converged & (damping < 1e10)
+        if not np.any(active):
+            break
+    
+    # Covariance as curve_fit(absolute_sigma=False): inv(J'J) * SSR / (n - 2)
+    jtj = np.einsum('spi,spj->sij', jac, jac)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pcov = np.linalg.pinv(jtj) * (ssr / (n_points - 2))[:, None, None] if n_points > 2 \
+               else np.full((n_sessions, 2, 2), np.inf)
+    return popt, pcov
 
-    p0 = [0, 1, 1, 0]
 
-    popt, pcov = curve_fit(lambda x, x0, k: sigmoid(x, x0, k, a=1, b=0), 
-                        mean_p_diff, 
-                        mean_choice_R_frac, 
-                        p0[:2], 
-                        method='lm',
-                        maxfev=10000)
+def fit_sigmoid_p_choice(p_reward, choice, win=10, stepsize=None):
+    '''
+    Psychometric curve (choice_R fraction vs. p_R - p_L in windows of win trials)
+    p_reward: [2, n_trials], choice: [n_trials]; or a stack of sessions [n_sessions, 2, n_trials], [n_sessions, n_trials]
+    '''
+    mean_p_diff, mean_choice_R_frac = windowed_p_choice(p_reward, choice, win, stepsize)
+    popt, pcov = fit_sigmoid_batch(mean_p_diff, mean_choice_R_frac, p0=[0, 1])
     
+    if np.ndim(choice) == 1:
+        popt, pcov = popt[0], pcov[0]
     return popt, pcov, mean_p_diff, mean_choice_R_frac
 
 def sigmoid(x, x0, k, a, b):
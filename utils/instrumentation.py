@@ -0,0 +1,247 @@
+'''
+Opt-in counters and timers for the hot paths
+
+Off by default (every hook is then a no-op). Turn it on for a whole run with an environment variable,
+
+    FORAGING_PROFILE=profile/ python forage.py fit --data export --workers 8
+    FORAGING_PROFILE=profile/ python utils/run_fit_behavior.py
+
+or with forage.py --profile DIR, or instrumentation.enable(folder) *before* the worker pool is created.
+
+Each process (the main one and every pool worker) accumulates {stage: [count, seconds, bytes]} and dumps it to
+<folder>/<run>_<host>_<pid>.json: at most every FLUSH_INTERVAL seconds while running, and when the process exits
+(pool workers don't run atexit, so a multiprocessing Finalize is used there). The files of one run are then merged:
+
+    python -m utils.instrumentation profile/            # Print the table and save profile/<run>_report.json
+    instrumentation.report('profile/')                  # Same, returns the dict
+
+Stages recorded so far:
+    negLL_func, simulate, generate_p_reward, fit_bandit, DE_generation (time between two DE callbacks),
+    run_one_session, shared_memory_copy, ipc_pickle (arguments of tasks sent to WorkerPool; measured by pickling
+    them once more in the parent), pool_task:<func> (time spent inside pool workers), disk_write
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import pickle
+import atexit
+import functools
+from multiprocessing import util
+
+ENV_VAR = 'FORAGING_PROFILE'
+ENV_RUN = 'FORAGING_PROFILE_RUN'   # Shared by the main process and its workers
+FLUSH_INTERVAL = 10   # secs
+
+_folder = os.environ.get(ENV_VAR) or None
+_stats = {}   # {stage: [count, seconds, bytes]}
+_started = time.time()
+_last_flush = time.time()
+_finalizer_pid = None
+
+
+def enable(folder):
+    '''
+    Start recording in this process and in all processes started from it afterwards
+    '''
+    global _folder
+    _folder = folder
+    os.makedirs(folder, exist_ok = True)
+    os.environ[ENV_VAR] = folder
+    _run_id()
+
+def enabled():
+    return _folder is not None
+
+def _run_id():
+    if ENV_RUN not in os.environ:
+        os.environ[ENV_RUN] = time.strftime('%Y%m%d-%H%M%S') + '-%g' % os.getpid()
+    return os.environ[ENV_RUN]
+
+def _after_fork():
+    # A forked worker starts with a copy of the parent's counters; they must not be counted twice
+    global _stats, _started, _last_flush, _finalizer_pid
+    _stats, _started, _last_flush, _finalizer_pid = {}, time.time(), time.time(), None
+
+if hasattr(os, 'register_at_fork'):   # POSIX only; spawned workers (Windows) start from a fresh interpreter anyway
+    os.register_at_fork(after_in_child = _after_fork)
+
+
+# =============================================================================
+#   Recording
+# =============================================================================
+
+def add(stage, seconds, count = 1, nbytes = 0):
+    global _finalizer_pid
+    if _folder is None: return
+
+    entry = _stats.get(stage)
+    if entry is None:
+        entry = _stats[stage] = [0, 0.0, 0]
+    entry[0] += count
+    entry[1] += seconds
+    entry[2] += nbytes
+
+    if _finalizer_pid != os.getpid():   # First record in this process (Process._bootstrap drops finalizers registered earlier)
+        _finalizer_pid = os.getpid()
+        util.Finalize(None, flush, exitpriority = 10)
+    if time.time() - _last_flush > FLUSH_INTERVAL:
+        flush()
+
+class _Timer:
+    __slots__ = ('stage', 'nbytes', 'start')
+
+    def __init__(self, stage, nbytes = 0):
+        self.stage, self.nbytes = stage, nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        add(self.stage, time.perf_counter() - self.start, nbytes = self.nbytes)
+
+class _NullTimer:
+    nbytes = 0
+    def __enter__(self): return self
+    def __exit__(self, *args): pass
+
+_NULL_TIMER = _NullTimer()
+
+def timed(stage, nbytes = 0):
+    '''
+    with timed('disk_write') as t:
+        ...
+        t.nbytes = os.path.getsize(path)    # Optional
+    '''
+    return _Timer(stage, nbytes) if _folder is not None else _NULL_TIMER
+
+def instrument(stage = None):
+    '''
+    Decorator version of timed(). The check is done at call time, so enable() works after import.
+    '''
+    def decorator(func):
+        name = stage or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _folder is None:
+                return func(*args, **kwargs)
+            with _Timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def de_generation_timer(callback = None):
+    '''
+    Wrap a DE callback (or None) so that the time between two calls (= one generation) is recorded as 'DE_generation'.
+    Returns the callback unchanged when disabled.
+    '''
+    if _folder is None: return callback
+    last = [time.perf_counter()]
+
+    def timed_callback(x, *args, **kwargs):
+        now = time.perf_counter()
+        add('DE_generation', now - last[0])
+        last[0] = now
+        if callback is not None:
+            return callback(x, *args, **kwargs)
+
+    return timed_callback
+
+def pickled_size(obj):
+    '''
+    Time and size of pickling obj, recorded as 'ipc_pickle'
+    '''
+    if _folder is None: return 0
+    start = time.perf_counter()
+    try:
+        nbytes = len(pickle.dumps(obj, protocol = pickle.HIGHEST_PROTOCOL))
+    except Exception:   # Unpicklable things fail later in the pool anyway
+        return 0
+    add('ipc_pickle', time.perf_counter() - start, nbytes = nbytes)
+    return nbytes
+
+def timed_call(stage, func, *args, **kwargs):
+    ''' func(*args, **kwargs) recorded as stage (picklable, for pool tasks) '''
+    with timed(stage):
+        return func(*args, **kwargs)
+
+
+# =============================================================================
+#   Dumping and merging
+# =============================================================================
+
+def stats():
+    return {stage: list(entry) for stage, entry in _stats.items()}
+
+def reset():
+    _stats.clear()
+
+def flush():
+    '''
+    Write this process's counters to its own file (overwritten every time; counters are cumulative)
+    '''
+    global _last_flush
+    _last_flush = time.time()
+    if _folder is None or not _stats: return
+
+    path = os.path.join(_folder, '%s_%s_%g.json' % (_run_id(), socket.gethostname(), os.getpid()))
+    content = {'run': _run_id(), 'host': socket.gethostname(), 'pid': os.getpid(), 'argv': sys.argv,
+               'started': _started, 'updated': time.time(), 'stats': stats()}
+    os.makedirs(_folder, exist_ok = True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(content, f)
+    os.replace(tmp, path)
+
+atexit.register(flush)
+
+def report(folder = None, run = None, if_print = True, if_save = True):
+    '''
+    Merge the per-process files of one run (default: the latest one in folder) into
+    {'run', 'n_processes', 'wall_time', 'stages': {stage: {'count', 'seconds', 'mean_ms', 'bytes', 'n_processes'}}}
+    '''
+    folder = folder or _folder
+    if folder == _folder: flush()   # Include this process
+
+    files = []
+    for name in os.listdir(folder):
+        if name.endswith('.json') and not name.endswith('_report.json'):
+            with open(os.path.join(folder, name)) as f:
+                files.append(json.load(f))
+    if run is None and files:
+        run = max(files, key = lambda x: x['updated'])['run']
+    files = [x for x in files if x['run'] == run]
+
+    stages = {}
+    for this in files:
+        for stage, (count, seconds, nbytes) in this['stats'].items():
+            merged = stages.setdefault(stage, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'n_processes': 0})
+            merged['count'] += count
+            merged['seconds'] += seconds
+            merged['bytes'] += nbytes
+            merged['n_processes'] += 1
+    for merged in stages.values():
+        merged['mean_ms'] = 1000 * merged['seconds'] / merged['count'] if merged['count'] else 0
+
+    result = {'run': run, 'n_processes': len(files),
+              'wall_time': max(x['updated'] for x in files) - min(x['started'] for x in files) if files else 0,
+              'stages': dict(sorted(stages.items(), key = lambda x: - x[1]['seconds']))}
+
+    if if_print:
+        print('=== Run %s: %g processes, wall time %.1f s (times are summed over processes) ===' % (run, len(files), result['wall_time']))
+        print('%-40s %10s %12s %10s %12s %6s' % ('stage', 'count', 'total (s)', 'mean (ms)', 'MB', 'procs'))
+        for stage, x in result['stages'].items():
+            print('%-40s %10g %12.2f %10.3f %12.2f %6g' % (stage, x['count'], x['seconds'], x['mean_ms'], x['bytes'] / 1e6, x['n_processes']))
+    if if_save and files:
+        with open(os.path.join(folder, '%s_report.json' % run), 'w') as f:
+            json.dump(result, f, indent = 1)
+
+    return result
+
+
+if __name__ == '__main__':
+    report(sys.argv[1] if len(sys.argv) > 1 else _folder)
@@ -0,0 +1,434 @@
+'''
+Job queue for the heavy fitting workloads
+
+Tasks are small JSON specs (which task, which file, which models...). They are enqueued to a broker once,
+and any number of workers (on this or other machines) pull tasks from the broker and write results to a ResultStore.
+The same workload can therefore run on a laptop (one worker) or a cluster (many workers) without editing scripts.
+
+Supported tasks:
+    'fit':  fit_each_mice() for one mouse              --> <save_prefix>_<file>
+    'cv':   patch_cross_validation_each_mice()        --> <save_prefix>CV_patched_<file>
+    'recovery': one cell (true model, run) of the confusion matrix --> confusion_<digest of models, n_trials>_<true_model>_<run>
+    'dynamic_learning_rate': fit_dynamic_learning_rate_each_mice() for one mouse --> <save_prefix>_<file>
+    'scan': para_scan() of one forager    --> <save_prefix>_<forager>_<para names>_<digest of the spec>
+    'optimize': para_optimize() of one forager  --> <save_prefix>_<forager>_<digest of the spec>
+
+Every result is saved together with the spec that produced it ('task_spec'), and resuming only skips a task
+whose saved spec is the same as the new one (result_is_current). The fit / cv keys keep the plain file names
+that process_all_mice etc. look for, so a run with other settings and the same prefix overwrites them instead of being skipped.
+
+Usage:
+    broker = SQLiteBroker('../results/queue.sqlite')
+    enqueue_fit_all_mice(broker, '../export/', models = [1, 9])
+
+    # On this node (could be many processes)
+    run_worker(broker, ResultStore('../results/model_comparison/'), pool = pool)
+
+The queue is a SQLite file (SQLiteBroker), which only processes on the machine that has it can open safely.
+Workers on other machines reach it over HTTP: broker_server(broker, host, port).serve_forever() on that machine
+(forage.py serve), and HTTPBroker('http://host:port') instead of SQLiteBroker on the others. Results are still written
+by each worker to its ResultStore, so for a multi-machine run the store must be a shared folder (NFS, cluster scratch...).
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import hashlib
+import importlib
+import traceback
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+from utils.results_store import ResultStore
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class SQLiteBroker:
+    '''
+    The queue itself: a table of tasks in one SQLite file. Safe for many worker processes on the machine that has the file
+    (not over a network file system, whose locking SQLite can't rely on); other machines go through serve_broker / HTTPBroker
+    '''
+
+    def __init__(self, db_file, max_attempts=3, timeout=60):
+        self.db_file = db_file
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                spec TEXT NOT NULL,
+                                status TEXT NOT NULL,
+                                worker TEXT,
+                                attempts INTEGER DEFAULT 0,
+                                error TEXT,
+                                created REAL,
+                                started REAL,
+                                finished REAL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_status ON tasks (status, id)')
+
+    def _connect(self):
+        # isolation_level=None --> we manage transactions ourselves (BEGIN IMMEDIATE locks the db for claiming)
+        return sqlite3.connect(self.db_file, timeout=self.timeout, isolation_level=None)
+
+    def enqueue(self, spec):
+        with self._connect() as conn:
+            cur = conn.execute('INSERT INTO tasks (spec, status, created) VALUES (?, ?, ?)',
+                               (json.dumps(spec), PENDING, time.time()))
+            return cur.lastrowid
+
+    def enqueue_many(self, specs):
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            ids = [conn.execute('INSERT INTO tasks (spec, status, created) VALUES (?, ?, ?)',
+                                (json.dumps(spec), PENDING, time.time())).lastrowid for spec in specs]
+            conn.execute('COMMIT')
+        return ids
+
+    def claim(self, worker_id):
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')   # Only one worker can claim at a time
+            row = conn.execute('SELECT id, spec FROM tasks WHERE status = ? ORDER BY id LIMIT 1', (PENDING,)).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None
+            conn.execute('UPDATE tasks SET status = ?, worker = ?, attempts = attempts + 1, started = ? WHERE id = ?',
+                         (RUNNING, worker_id, time.time(), row[0]))
+            conn.execute('COMMIT')
+        return row[0], json.loads(row[1])
+
+    def complete(self, task_id):
+        with self._connect() as conn:
+            conn.execute('UPDATE tasks SET status = ?, finished = ?, error = NULL WHERE id = ?', (DONE, time.time(), task_id))
+
+    def fail(self, task_id, error):
+        ''' Put the task back to the queue unless it has failed max_attempts times '''
+        with self._connect() as conn:
+            conn.execute('UPDATE tasks SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, error = ?, finished = ? WHERE id = ?',
+                         (self.max_attempts, PENDING, FAILED, error, time.time(), task_id))
+
+    def requeue_stale(self, older_than):
+        '''
+        Requeue running tasks whose worker died (started more than `older_than` secs ago).
+        Same rule as fail(): a task that has already killed max_attempts workers (OOM, segfault...) is marked as failed
+        '''
+        with self._connect() as conn:
+            cur = conn.execute('UPDATE tasks SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, error = ?, finished = ? '
+                               'WHERE status = ? AND started < ?',
+                               (self.max_attempts, PENDING, FAILED, 'Worker died (stale for more than %g secs)' % older_than, time.time(),
+                                RUNNING, time.time() - older_than))
+            return cur.rowcount
+
+    def counts(self):
+        with self._connect() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        return {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0, **dict(rows)}
+
+    def failed_tasks(self):
+        with self._connect() as conn:
+            rows = conn.execute('SELECT id, spec, error FROM tasks WHERE status = ?', (FAILED,)).fetchall()
+        return [(task_id, json.loads(spec), error) for task_id, spec, error in rows]
+
+
+# Methods of a broker that HTTPBroker can call remotely
+BROKER_METHODS = ['enqueue', 'enqueue_many', 'claim', 'complete', 'fail', 'requeue_stale', 'counts', 'failed_tasks']
+
+def broker_server(broker, host = '127.0.0.1', port = 8765):
+    '''
+    HTTP server that exposes broker (a SQLiteBroker on this machine) to HTTPBroker clients on other machines.
+    Run it with .serve_forever(). Each request is one method call: POST /<method> with the JSON list of arguments.
+    There is no authentication, so bind it to a trusted (cluster) network only.
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            method = self.path.strip('/')
+            if method not in BROKER_METHODS:
+                self.send_error(404, 'Unknown broker method: %s' % method)
+                return
+            args = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'[]')
+            try:
+                body = json.dumps(getattr(broker, method)(*args)).encode()
+            except Exception:
+                self.send_error(500, traceback.format_exc().splitlines()[-1])
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):   # Every claim would print a line
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+class HTTPBroker:
+    '''
+    Client of a broker_server (e.g. HTTPBroker('http://head-node:8765')), with the same methods as SQLiteBroker
+    '''
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _call(self, method, *args):
+        request = urllib.request.Request('%s/%s' % (self.url, method), data=json.dumps(args).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def enqueue(self, spec):
+        return self._call('enqueue', spec)
+
+    def enqueue_many(self, specs):
+        return self._call('enqueue_many', specs)
+
+    def claim(self, worker_id):
+        job = self._call('claim', worker_id)
+        return None if job is None else tuple(job)
+
+    def complete(self, task_id):
+        self._call('complete', task_id)
+
+    def fail(self, task_id, error):
+        self._call('fail', task_id, error)
+
+    def requeue_stale(self, older_than):
+        return self._call('requeue_stale', older_than)
+
+    def counts(self):
+        return self._call('counts')
+
+    def failed_tasks(self):
+        return [tuple(task) for task in self._call('failed_tasks')]
+
+
+def open_broker(queue):
+    '''
+    --queue of forage.py: 'http://host:port' --> HTTPBroker; anything else is the file of a SQLiteBroker
+    '''
+    if queue.startswith(('http://', 'https://')):
+        return HTTPBroker(queue)
+    return SQLiteBroker(queue)
+
+
+# =============================================================================
+#   Task specs
+# =============================================================================
+
+def _list_files(path):
+    files = []
+    for r, _, f in os.walk(path):
+        for file in f:
+            files.append(os.path.join(r, file))
+    return sorted(files)
+
+def _to_json_models(models):
+    # np.int64 etc. are not JSON serializable
+    if models is None:
+        return None
+    return [int(m) if isinstance(m, (int, np.integer)) else m for m in models]
+
+def spec_digest(obj):
+    ''' Short stable hash of (nested) task settings, used in result keys so that different settings never share a key '''
+    return hashlib.sha1(json.dumps(obj, sort_keys = True, default = lambda x: np.asarray(x).tolist()).encode()).hexdigest()[:10]
+
+def code_digest(modules):
+    ''' Short hash of the source files of modules (names or module objects), so that results cached by an older version are not reused '''
+    sha = hashlib.sha1()
+    for module in modules:
+        module = importlib.import_module(module) if isinstance(module, str) else module
+        with open(module.__file__, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()[:10]
+
+def confusion_key(models, n_trials, true_model, run):
+    return 'confusion_%s_%g_%g' % (spec_digest({'models': _to_json_models(models), 'n_trials': int(n_trials)}), true_model, run)
+
+def fit_all_mice_specs(path, save_prefix = 'model_comparison', models = None, if_session_wise = True, mice = None):
+    return [{'task': 'fit', 'file': file, 'models': _to_json_models(models), 'if_session_wise': if_session_wise,
+             'key': save_prefix + '_%s' % os.path.basename(file)}
+            for file in _list_files(path) if mice is None or os.path.basename(file).split('.')[0] in mice]
+
+def patch_cross_validation_specs(raw_path, result_to_patch, cross_validation_model_num = [15], k_fold = 2, mice = None):
+    '''
+    result_to_patch: prefix of the fitted results, e.g. '../results/model_comparison/model_comparison_'
+    '''
+    return [{'task': 'cv', 'file': result_to_patch + os.path.basename(file), 'models': _to_json_models(cross_validation_model_num),
+             'k_fold': k_fold, 'key': os.path.basename(result_to_patch) + 'CV_patched_' + os.path.basename(file)}
+            for file in _list_files(raw_path) if mice is None or os.path.basename(file).split('.')[0] in mice]
+
+def confusion_matrix_specs(models = [1,2,3,4,5,6,7,8], n_runs = 2, n_trials = 1000):
+    return [{'task': 'recovery', 'models': _to_json_models(models), 'true_model': mm, 'run': rr, 'n_trials': n_trials,
+             'key': confusion_key(models, n_trials, mm, rr)}
+            for rr in range(n_runs) for mm in range(len(models))]
+
+def dynamic_learning_rate_all_mice_specs(path, save_prefix = 'dynamic_learning_rate', mice = None):
+    return [{'task': 'dynamic_learning_rate', 'file': file, 'key': save_prefix + '_%s' % os.path.basename(file)}
+            for file in _list_files(path) if mice is None or os.path.basename(file).split('.')[0] in mice]
+
+def para_scan_specs(forager, para_to_scan, n_reps = 500, save_prefix = 'para_scan', **kwargs):
+    '''
+    para_to_scan: {para_name: [values]} (any number of parameters, full grid); kwargs are passed to para_scan() (task, if_baited, fixed paras...)
+    '''
+    para_to_scan = {name: [float(v) for v in values] for name, values in para_to_scan.items()}
+    spec = {'task': 'scan', 'forager': forager, 'para_to_scan': para_to_scan, 'n_reps': n_reps, 'kwargs': kwargs}
+    spec['key'] = '%s_%s_%s_%s' % (save_prefix, forager, '_'.join(para_to_scan.keys()), spec_digest(spec))
+    return [spec]
+
+def para_optimize_specs(forager, n_reps_per_iter = 200, save_prefix = 'para_optimize', **kwargs):
+    spec = {'task': 'optimize', 'forager': forager, 'n_reps_per_iter': n_reps_per_iter, 'kwargs': kwargs}
+    spec['key'] = '%s_%s_%s' % (save_prefix, forager, spec_digest(spec))
+    return [spec]
+
+def enqueue_fit_all_mice(broker, path, **kwargs):
+    return broker.enqueue_many(fit_all_mice_specs(path, **kwargs))
+
+def enqueue_patch_cross_validation(broker, raw_path, result_to_patch, **kwargs):
+    return broker.enqueue_many(patch_cross_validation_specs(raw_path, result_to_patch, **kwargs))
+
+def enqueue_confusion_matrix(broker, **kwargs):
+    return broker.enqueue_many(confusion_matrix_specs(**kwargs))
+
+def enqueue_dynamic_learning_rate_all_mice(broker, path, **kwargs):
+    return broker.enqueue_many(dynamic_learning_rate_all_mice_specs(path, **kwargs))
+
+
+# =============================================================================
+#   Task handlers (imports are local so that a worker only loads what it needs)
+# =============================================================================
+
+def _run_fit(spec, store, pool):
+    from utils.run_fit_behavior import fit_each_mice
+    data = np.load(spec['file'])
+    results_each_mice = fit_each_mice(data, file_name = os.path.basename(spec['file']), pool = pool, models = spec['models'],
+                                      if_session_wise = spec.get('if_session_wise', True), if_verbose = False)
+    store.save(spec['key'], results_each_mice = results_each_mice, task_spec = json.dumps(spec))
+
+def _run_cv(spec, store, pool):
+    from utils.run_fit_behavior import patch_cross_validation_each_mice
+    results_each_mice = np.load(spec['file'], allow_pickle=True).f.results_each_mice.item()
+    results_each_mice = patch_cross_validation_each_mice(results_each_mice, spec['models'], k_fold = spec.get('k_fold', 2), pool = pool)
+    store.save(spec['key'], results_each_mice = results_each_mice, task_spec = json.dumps(spec))
+
+def _run_recovery(spec, store, pool):
+    from models.bandit_model_comparison import MODELS
+    from utils.run_model_recovery import confusion_matrix_each_run
+    models = [MODELS[i-1] for i in spec['models']] if type(spec['models'][0]) is int else spec['models']
+    results_this = confusion_matrix_each_run(models, spec['true_model'], n_trials = spec['n_trials'], pool = pool)
+    results_this['para_notation'] = np.array(results_this['para_notation'])
+    store.save(spec['key'], **results_this, task_spec = json.dumps(spec))
+
+def _run_dynamic_learning_rate(spec, store, pool):
+    from utils.run_fit_behavior import fit_dynamic_learning_rate_each_mice
+    data = np.load(spec['file'])
+    results_each_mice = fit_dynamic_learning_rate_each_mice(data, file_name = os.path.basename(spec['file']), pool = pool, if_verbose = False)
+    store.save(spec['key'], results_each_mice = results_each_mice, task_spec = json.dumps(spec))
+
+def _run_scan(spec, store, pool):
+    from utils.run_foraging_testbed import para_scan
+    results_para_scan = para_scan(spec['forager'], spec['para_to_scan'], n_reps = spec['n_reps'], pool = pool, if_plot = False, **spec['kwargs'])
+    store.save(spec['key'], results_para_scan = results_para_scan, para_to_scan = spec['para_to_scan'], task_spec = json.dumps(spec))
+
+def _run_optimize(spec, store, pool):
+    from utils.run_foraging_testbed import para_optimize
+    opti_para = para_optimize(spec['forager'], n_reps_per_iter = spec['n_reps_per_iter'], pool = pool, if_plot = False, **spec['kwargs'])
+    store.save(spec['key'], x = opti_para.x, fun = opti_para.fun, opti_names = np.array(opti_para.opti_names), task_spec = json.dumps(spec))
+
+TASK_HANDLERS = {'fit': _run_fit,
+                 'cv': _run_cv,
+                 'recovery': _run_recovery,
+                 'dynamic_learning_rate': _run_dynamic_learning_rate,
+                 'scan': _run_scan,
+                 'optimize': _run_optimize,
+                 }
+
+def run_task(spec, store, pool = ''):
+    TASK_HANDLERS[spec['task']](spec, store, pool)
+
+def result_is_current(store, spec):
+    '''
+    The result of this task is in the store and was produced by the same spec (results without a saved spec are not trusted)
+    '''
+    if not store.exists(spec['key']): return False
+    saved = store.read(spec['key'], 'task_spec')
+    return saved is not None and spec_digest(json.loads(saved)) == spec_digest(spec)
+
+
+def run_worker(broker, store, pool = '', max_tasks = None, if_wait = False, poll_interval = 10, if_skip_existing = False):
+    '''
+    Pull tasks from the broker until the queue is empty (or max_tasks is reached).
+    if_wait: keep polling for new tasks instead of exiting when the queue is empty
+    if_skip_existing: mark a task as done without running it if its result is already in the store
+                      and was produced by the same spec (resume)
+    '''
+    worker_id = '%s:%g' % (socket.gethostname(), os.getpid())
+    n_done = 0
+
+    while max_tasks is None or n_done < max_tasks:
+        job = broker.claim(worker_id)
+
+        if job is None:
+            if not if_wait: break
+            time.sleep(poll_interval)
+            continue
+
+        task_id, spec = job
+
+        if if_skip_existing and result_is_current(store, spec):
+            broker.complete(task_id)
+            continue
+
+        print('=== [%s] Task %g: %s (%s) ===' % (worker_id, task_id, spec['task'], spec['key']))
+        sys.stdout.flush()
+        start = time.time()
+
+        try:
+            run_task(spec, store, pool)
+            broker.complete(task_id)
+            print('Task %g done in %g mins!\n' % (task_id, (time.time() - start)/60))
+        except Exception:
+            broker.fail(task_id, traceback.format_exc())
+            print('Task %g: SOMETHING WENT WRONG!!\n%s' % (task_id, traceback.format_exc()))
+
+        n_done += 1
+
+    return n_done
+
+
+def collect_confusion_matrix(store, models = [1,2,3,4,5,6,7,8], n_runs = 2, n_trials = 1000):
+    '''
+    Assemble the 'recovery' results in the store into the same confusion_results dict as compute_confusion_matrix()
+    (missing cells are left as nan)
+    '''
+    from models.bandit_model_comparison import MODELS
+    from utils.run_model_recovery import summarize_confusion_matrix
+
+    keys = [[confusion_key(models, n_trials, mm, rr) for rr in range(n_runs)] for mm in range(len(models))]
+    if type(models[0]) is int:
+        models = [MODELS[i-1] for i in models]
+    n_models = len(models)
+
+    confusion_results = {'models': models, 'n_runs': n_runs, 'n_trials': n_trials}
+    for idx in ['AIC', 'BIC', 'log10_BF_AIC', 'log10_BF_BIC', 'best_model_AIC', 'best_model_BIC']:
+        confusion_results['raw_' + idx] = np.full([n_models, n_models, n_runs], np.nan)
+
+    for rr in range(n_runs):
+        for mm in range(n_models):
+            key = keys[mm][rr]
+            if not store.exists(key): continue
+
+            results_this = store.load(key)
+            for idx in ['AIC', 'BIC', 'log10_BF_AIC', 'log10_BF_BIC', 'best_model_AIC', 'best_model_BIC']:
+                confusion_results['raw_' + idx][mm, :, rr] = results_this[idx]
+            confusion_results['models_notations'] = list(results_this['para_notation'])
+
+    return summarize_confusion_matrix(confusion_results)
@@ -730,89 +730,98 @@ def plot_example_sessions(result_path = "..\\results\\model_comparison\\w_wo_bia
         plot_runlength_Lau2005(df_run_length_Lau, block_partitions)
         
     
-def analyze_runlength_Lau2005(choice_history, p_reward, min_trial = 50, block_partitions = [70, 70]):
+def analyze_runlength_Lau2005(choice_history, p_reward, min_trial = 50, block_partitions = [70, 70], session_num = None):
     '''
     Runlength analysis in Fig.5, Lau2005
+    Returns [first half, second half] (see runlength_Lau2005_table; session_num allows many concatenated sessions at once)
     '''
-    #%%
-    df_run_length_Lau = [pd.DataFrame(), pd.DataFrame()]  # First half, Second half
-    
-    p_reward_ratio = p_reward[1]/p_reward[0] # R/L
-    block_starts = np.where(np.diff(np.hstack((-999, p_reward_ratio, 999))))[0]
+    df = runlength_Lau2005_table(choice_history, p_reward, block_partitions = block_partitions, session_num = session_num)
+    columns = ['m_star', 'p_base_ratio', 'choice_ratio', 'mean_runlength_rich', 'mean_runlength_lean', 'trial_num']
+    return [df.loc[df.half == pp, columns].reset_index(drop = True) for pp in (0, 1)]
 
-    # For each block
-    for bb in range(len(block_starts)-1):
-        select_this_block = range(block_starts[bb],block_starts[bb+1])
-        this_block_choice = choice_history[0, select_this_block]
-        # print(len(this_session_choice))
-        this_block_p_base_ratio = p_reward_ratio[select_this_block][0]
-        
-        # Flip choices such that 1 = rich arm, 0 = lean arm
-        if this_block_p_base_ratio < 1: # if rich arm = Left
-            this_block_choice = 1 - this_block_choice
-            
-        # Define block partitions
-        block_len = len(this_block_choice)
-        
-        if block_len < 30: continue  # Exclude too short blocks
-        
-        select_trials = [this_block_choice[:int(block_partitions[0]/100* block_len)],
-                         this_block_choice[int(((1-block_partitions[0]/100) * block_len)):]]
-        
-        for pp, this_half_choice in enumerate(select_trials):
-            
-            # Get runlength for the best (rich) and the worst (lean) arm
-            # These two magic lines below are correct, believe it or not :)
-            this_runlength_rich =  np.diff(np.where(np.hstack((999,np.diff(np.where(this_half_choice==1)[0]),999))>1))[0]
-            this_runlength_lean = np.diff(np.where(np.hstack((999,np.diff(np.where(this_half_choice==0)[0]),999))>1))[0]
-            # assert(np.sum(this_runlength_rich) == np.sum(this_half_choice == 1))
-            # assert(np.sum(this_runlength_lean) == np.sum(this_half_choice == 0))
-
-            # Remove the first and the last run (due to slicing of the blocks/halves)
-            if this_half_choice[0] == 1:
-                this_runlength_rich = this_runlength_rich[1:]
-            else:
-                this_runlength_lean = this_runlength_lean[1:]
-            
-            if this_half_choice[-1] == 1:
-                this_runlength_rich = this_runlength_rich[:-1]
-            else:
-                this_runlength_lean = this_runlength_lean[:-1]
-            
-            # Some facts
-            n_choice_rich = np.sum(this_half_choice == 1)  # In the sense of ground truth
-            n_choice_lean = np.sum(this_half_choice == 0)
-            
-            if n_choice_rich * n_choice_lean == 0:
-                this_choice_ratio = np.inf
-            else:
-                # In terms of ground-truth rich (could be smaller than 1, meaning that the animal chose the wrong arm)
-                this_choice_ratio = n_choice_rich / n_choice_lean    
 
-                # Align everything to subjective rich (always larger than 1. I believe Hattori should have used this)
-                if this_choice_ratio < 1: 
-                    this_choice_ratio = 1/this_choice_ratio
-                    this_runlength_rich, this_runlength_lean = this_runlength_lean, this_runlength_rich
-            
-            if this_block_p_base_ratio == 1:
-                this_m_star = 1
-            else:
-                p_rich = max(p_reward[:,select_this_block[0]])
-                p_lean = min(p_reward[:,select_this_block[0]])
-                this_m_star = np.floor(np.log(1-p_rich)/np.log(1-p_lean)) # Ideal-p-hat-greed
-                
-            if len(this_runlength_rich) * len(this_runlength_lean) == 0: continue   # Exclude extreme bias block
-               
-            df_this_half = pd.Series(dict(m_star = this_m_star,
-                                     p_base_ratio = this_block_p_base_ratio,
-                                     choice_ratio = this_choice_ratio,
-                                     mean_runlength_rich = np.mean(this_runlength_rich),
-                                     mean_runlength_lean = np.mean(this_runlength_lean), 
-                                     trial_num = len(this_half_choice)))
-            
-            df_run_length_Lau[pp] = df_run_length_Lau[pp].append(df_this_half, ignore_index=True)
-        
-    return df_run_length_Lau
+def runlength_Lau2005_table(choice_history, p_reward, block_partitions = [70, 70], session_num = None, min_block_length = 30):
+    '''
+    Run lengths on the rich and lean arms of all blocks (of many sessions) in one pass, one row per (block, half):
+        'session_num', 'block', 'half' (0: first block_partitions[0]% of the block, 1: last block_partitions[1]%), 
+        'm_star', 'p_base_ratio', 'choice_ratio', 'mean_runlength_rich', 'mean_runlength_lean', 'trial_num'
+    
+    Choices are flipped such that 1 = rich arm, 0 = lean arm. In each half, the first and the last runs are removed (due to slicing of the blocks/halves), 
+    and rich / lean are then swapped if the lean arm was chosen more (aligned to the subjective rich, so choice_ratio >= 1).
+    Blocks shorter than min_block_length, and halves without any rich or lean run left (extreme bias), are excluded.
+    '''
+    choice = np.asarray(choice_history)[0]
+    session_num = np.zeros(len(choice)) if session_num is None else np.asarray(session_num)
+    p_reward_ratio = p_reward[1] / p_reward[0] # R/L
+    
+    # -- Blocks: p_reward_ratio changes, or a new session --
+    new_block = np.r_[True, (np.diff(p_reward_ratio) != 0) | (np.diff(session_num) != 0)]
+    block_starts = np.flatnonzero(new_block)
+    block_len = np.diff(np.r_[block_starts, len(choice)])
+    keep = block_len >= min_block_length  # Exclude too short blocks
+    block_idx, block_starts, block_len = np.flatnonzero(keep), block_starts[keep], block_len[keep]
+    
+    # Flip choices such that 1 = rich arm, 0 = lean arm (if rich arm = Left)
+    choice_rich = np.where(p_reward_ratio < 1, 1 - choice, choice)
+    
+    # -- Halves: [first, last) of each (block, half) --
+    half_start = np.r_[block_starts, block_starts + ((1 - block_partitions[1]/100) * block_len).astype(int)]
+    half_end = np.r_[block_starts + (block_partitions[0]/100 * block_len).astype(int), block_starts + block_len]
+    half_len = half_end - half_start
+    n_halves = len(half_start)
+    
+    # All halves concatenated (they may overlap) --> run-length encoding with runs broken at the borders of halves
+    half_of_trial = np.repeat(np.arange(n_halves), half_len)
+    trial = half_start[half_of_trial] + np.arange(np.sum(half_len)) - np.repeat(np.cumsum(half_len) - half_len, half_len)
+    c = choice_rich[trial]
+    
+    run_first = np.r_[True, (np.diff(c) != 0) | (np.diff(half_of_trial) != 0)]
+    run_start = np.flatnonzero(run_first)
+    run_length = np.diff(np.r_[run_start, len(c)])
+    run_value, run_half = c[run_start], half_of_trial[run_start]
+    
+    # Remove the first and the last run of each half
+    interior = np.r_[False, run_half[1:] == run_half[:-1]] & np.r_[run_half[:-1] == run_half[1:], False]
+    
+    def mean_runs(value):
+        this = interior & (run_value == value)
+        n_runs = np.bincount(run_half[this], minlength = n_halves)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return np.bincount(run_half[this], weights = run_length[this], minlength = n_halves) / n_runs, n_runs
+    
+    mean_rich, n_runs_rich = mean_runs(1)
+    mean_lean, n_runs_lean = mean_runs(0)
+    
+    # -- Some facts --
+    n_choice_rich = np.bincount(half_of_trial, weights = c, minlength = n_halves)  # In the sense of ground truth
+    n_choice_lean = half_len - n_choice_rich
+    
+    # In terms of ground-truth rich (could be smaller than 1, meaning that the animal chose the wrong arm), or inf if one arm only
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        choice_ratio = np.where(n_choice_rich * n_choice_lean == 0, np.inf, n_choice_rich / n_choice_lean)
+    # Align everything to subjective rich (always larger than 1. I believe Hattori should have used this)
+    swap = choice_ratio < 1
+    choice_ratio[swap] = 1 / choice_ratio[swap]
+    mean_rich, mean_lean = np.where(swap, mean_lean, mean_rich), np.where(swap, mean_rich, mean_lean)
+    
+    p_base_ratio = np.tile(p_reward_ratio[block_starts], 2)
+    p_rich = np.tile(np.max(p_reward[:, block_starts], axis = 0), 2)
+    p_lean = np.tile(np.min(p_reward[:, block_starts], axis = 0), 2)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        m_star = np.where(p_base_ratio == 1, 1, np.floor(np.log(1 - p_rich) / np.log(1 - p_lean)))  # Ideal-p-hat-greed
+    
+    df = pd.DataFrame(dict(session_num = np.tile(session_num[block_starts], 2),
+                           block = np.tile(block_idx, 2),
+                           half = np.repeat([0, 1], len(block_starts)),
+                           m_star = m_star.astype(float),
+                           p_base_ratio = p_base_ratio.astype(float),
+                           choice_ratio = choice_ratio.astype(float),
+                           mean_runlength_rich = mean_rich,
+                           mean_runlength_lean = mean_lean, 
+                           trial_num = half_len.astype(float)))
+    
+    df = df[(n_runs_rich * n_runs_lean) > 0]   # Exclude extreme bias block
+    return df.sort_values(['half', 'block'], kind = 'stable').reset_index(drop = True)
 
 
 #%% Compute mean_runlength_Bernoulli
@@ -0,0 +1,66 @@
+'''
+A minimal file-backed results store
+
+Every result is one compressed .npz file under a root folder, keyed by its file name.
+Files are written in the same format as before (e.g. `results_each_mice` saved with np.savez_compressed),
+so they can still be read back with np.load(..., allow_pickle=True) by process_all_mice etc.
+
+    store = ResultStore('../results/model_comparison/')
+    store.save('model_comparison_FOR01.npz', results_each_mice = results_each_mice)
+    store.load('model_comparison_FOR01.npz')['results_each_mice']
+'''
+
+import os
+import numpy as np
+
+from utils.instrumentation import timed
+
+
+class ResultStore:
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        if not key.endswith('.npz'):
+            key = key + '.npz'
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def keys(self, prefix=''):
+        return sorted(f for f in os.listdir(self.root) if f.endswith('.npz') and f.startswith(prefix))
+
+    def save(self, key, **arrays):
+        '''
+        Write to a temporary file first and then rename, so that a killed worker never leaves a half-written result
+        (which would otherwise be skipped as "done" when resuming)
+        '''
+        path = self.path(key)
+        tmp = path + '.%s.tmp' % os.getpid()
+        with timed('disk_write') as timer:
+            with open(tmp, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp, path)
+            timer.nbytes = os.path.getsize(path)
+        return path
+
+    def read(self, key, name, default=None):
+        '''
+        Only one array of a result (np.load reads the members of an .npz lazily), or default if it is not there
+        '''
+        with np.load(self.path(key), allow_pickle=True) as data:
+            if name not in data.files:
+                return default
+            value = data[name]
+            return value.item() if value.shape == () else value
+
+    def load(self, key):
+        '''
+        Return a dict. 0-d object arrays (pickled dicts / classes) are unwrapped by .item()
+        '''
+        with np.load(self.path(key), allow_pickle=True) as data:
+            return {name: data[name].item() if data[name].dtype == object and data[name].shape == () else data[name]
+                    for name in data.files}
@@ -8,6 +8,7 @@ Created on Wed Apr 15 21:33:33 2020
 import numpy as np
 import multiprocessing as mp
 import time
+import warnings
 import sys, os
 from tqdm import tqdm
 import pandas as pd
@@ -17,6 +18,9 @@ from scipy.stats import pearsonr
 
 from utils.helper_func import moving_average
 from models.bandit_model_comparison import BanditModelComparison
+from utils.worker_pool import get_pool, close_pool
+from utils.instrumentation import timed
+from utils.table_builder import TableBuilder
 from utils.plot_mice import plot_each_mice, analyze_runlength_Lau2005, plot_runlength_Lau2005, plot_example_sessions, plot_group_results, plot_block_switch
 from models.dynamic_learning_rate import fit_dynamic_learning_rate_session, fit_dynamic_learning_rate_session_no_bias_free_Q_0
 
@@ -93,7 +97,8 @@ def fit_all_mice(path, save_prefix = 'model_comparison', pool = '', models = Non
             # Do it
             try:
                 results_each_mice = fit_each_mice(data, file_name = file, pool = pool, models = models, if_session_wise = True, if_verbose = False)
-                np.savez_compressed( path + save_prefix + '_%s' % file, results_each_mice = results_each_mice)
+                with timed('disk_write'):
+                    np.savez_compressed( path + save_prefix + '_%s' % file, results_each_mice = results_each_mice)
                 print('Mice %s done in %g mins!\n' % (file, (time.time() - start)/60))
             except:
                 print('SOMETHING WENT WRONG!!')
@@ -171,7 +176,8 @@ def combine_group_results(raw_path = "..\\export\\", result_path = "..\\results\
                 
             # -- Save data --
             results_each_mice = {'model_comparison_grand': new_grand_mc, 'model_comparison_session_wise': new_session_wise_mc}
-            np.savez_compressed( result_path + save_prefix + file, results_each_mice = results_each_mice)
+            with timed('disk_write'):
+                np.savez_compressed( result_path + save_prefix + file, results_each_mice = results_each_mice)
             print('%s + %s: Combined!' %(combine_prefix[0] + file, combine_prefix[1] + file))
             
 def get_p_hat_greedy(p_reward):
@@ -320,9 +326,9 @@ def process_all_mice(result_path = "..\\results\\model_comparison\\", combine_pr
     #%%
     listOfFiles = os.listdir(result_path)
     
-    results_all_mice = pd.DataFrame()
-    df_raw_LPT_AICs = pd.DataFrame()
-    df_block_switch_all_mice = pd.DataFrame()
+    results_all_mice = TableBuilder()
+    df_raw_LPT_AICs = TableBuilder()
+    df_block_switch_all_mice = TableBuilder()
     
     n_mice = 0
     
@@ -377,7 +383,7 @@ def process_all_mice(result_path = "..\\results\\model_comparison\\", combine_pr
         # df_this[' $b_L$'] = df_this[' $b_L$'] * df_this[' $\sigma$']
         
         # Save dataframe of this mice into a HUGE dataframe
-        results_all_mice = results_all_mice.append(df_this)
+        results_all_mice.add_frame(df_this)
         
         # == df_2. Raw_AIC ==
         df_this = pd.DataFrame({'mice': mice_name,
@@ -385,15 +391,17 @@ def process_all_mice(result_path = "..\\results\\model_comparison\\", combine_pr
                                 'session_number': group_result_this['session_number'],
                                  })
         df_this = pd.concat([df_this, pd.DataFrame(group_result_this['LPT_AIC'].T, columns = group_result_this['para_notation'])], axis = 1)
-        df_raw_LPT_AICs = df_raw_LPT_AICs.append(df_this)
+        df_raw_LPT_AICs.add_frame(df_this)
         
         # -- Block switch --
         df_block_switch_this = group_result_this['df_block_switch_this_mouse']
         if df_block_switch_this is not None:
             df_block_switch_this['mice'] = mice_name   
             df_block_switch_this.insert(0, 'mice', df_block_switch_this.pop('mice'))  # Move 'mice' to the first column
-            df_block_switch_all_mice = df_block_switch_all_mice.append(df_block_switch_this)
+            df_block_switch_all_mice.add_frame(df_block_switch_this)
         
+    results_all_mice, df_raw_LPT_AICs, df_block_switch_all_mice = results_all_mice.build(), df_raw_LPT_AICs.build(), df_block_switch_all_mice.build()
+    
     # Add some more stuffs for convenience
     group_results = {'results_all_mice': results_all_mice, 'raw_LPT_AICs': df_raw_LPT_AICs}    
     if if_hattori_Fig1I:
@@ -411,7 +419,8 @@ def process_all_mice(result_path = "..\\results\\model_comparison\\", combine_pr
     group_results['block_switch_para'] = group_result_this['block_switch_para']
     
     # Save group results to file
-    np.savez_compressed(result_path + group_results_name_to_save, group_results = group_results)
+    with timed('disk_write'):
+        np.savez_compressed(result_path + group_results_name_to_save, group_results = group_results)
     
     # results_all_mice.to_pickle(result_path + 'results_all_mice.pkl')
     print('Group results saved: %s!' %(result_path + group_results_name_to_save))
@@ -475,20 +484,20 @@ def analyze_runlength(result_path = "..\\results\\model_comparison\\", combine_p
         
         for this_session_idxs, this_marker in zip(grand_session_idxs, grand_session_idxs_markers):
             
-            df_run_length_Lau_all = [pd.DataFrame(), pd.DataFrame()] # First and last trials in each block
-            
+            # Concatenate the sessions and do the runlength analysis of all of them at once
+            choice_history, p_reward, session_num = [], [], []
             for this_idx in this_session_idxs:
                 #%%
                 this_class = data_raw['model_comparison_session_wise'][this_idx - 1]
                 this_session_num = df_this[df_this.session_idx == this_idx].session_number.values
                 
-                p_reward = data_raw['model_comparison_grand'].p_reward[:, data_raw['model_comparison_grand'].session_num == this_session_num]
+                choice_history.append(this_class.fit_choice_history)
+                p_reward.append(data_raw['model_comparison_grand'].p_reward[:, data_raw['model_comparison_grand'].session_num == this_session_num])
+                session_num.append(np.full(this_class.fit_choice_history.shape[1], this_idx))
                 
-                # Runlength analysis
-                this_df_run_length_Lau = analyze_runlength_Lau2005(this_class.fit_choice_history, p_reward, block_partitions = block_partitions)
-                
-                for i in [0,1]:
-                    df_run_length_Lau_all[i] = df_run_length_Lau_all[i].append(this_df_run_length_Lau[i])
+            # First and last trials in each block
+            df_run_length_Lau_all = analyze_runlength_Lau2005(np.hstack(choice_history), np.hstack(p_reward), block_partitions = block_partitions,
+                                                              session_num = np.hstack(session_num))
                 
             fig = plot_runlength_Lau2005(df_run_length_Lau_all, block_partitions)
             fig.text(0.1, 0.92, this_marker + ', mean foraging eff. = %g%%, %g blocks' %\
@@ -561,12 +570,19 @@ def fit_dynamic_learning_rate_each_mice(data, if_verbose = True, file_name = '',
      
     unique_session = np.unique(session_num)
     
-    for ss in tqdm(unique_session, desc = 'Session-wise', total = len(unique_session)):
-        choice_history_this = choice_history[:, session_num == ss]
-        reward_history_this = reward_history[:, session_num == ss]
-            
-        dynamic_learning_rate_this = fit_dynamic_learning_rate_session(choice_history_this, reward_history_this, pool = pool)
-        dynamic_learning_rate_results.append(dynamic_learning_rate_this)
+    if pool == '':
+        for ss in tqdm(unique_session, desc = 'Session-wise', total = len(unique_session)):
+            choice_history_this = choice_history[:, session_num == ss]
+            reward_history_this = reward_history[:, session_num == ss]
+                
+            dynamic_learning_rate_this = fit_dynamic_learning_rate_session(choice_history_this, reward_history_this)
+            dynamic_learning_rate_results.append(dynamic_learning_rate_this)
+    else:
+        # Windows within a session are chained, so parallelize over sessions instead
+        result_ids = [pool.apply_async(fit_dynamic_learning_rate_session, args = (choice_history[:, session_num == ss], reward_history[:, session_num == ss])) 
+                      for ss in unique_session]
+        for result_id in tqdm(result_ids, desc = 'Session-wise', total = len(unique_session)):
+            dynamic_learning_rate_results.append(result_id.get())
         
     # -- Save data aligned with block start --
     #TODO
@@ -587,7 +603,8 @@ def fit_dynamic_learning_rate_all_mice(path, save_prefix = 'dynamic_learning_rat
             # Do it
             try:
                 results_each_mice = fit_dynamic_learning_rate_each_mice(data, file_name = file, pool = pool, if_verbose = False)
-                np.savez_compressed( path + save_prefix + '_%s' % file, results_each_mice = results_each_mice)
+                with timed('disk_write'):
+                    np.savez_compressed( path + save_prefix + '_%s' % file, results_each_mice = results_each_mice)
                 print('Mice %s done in %g mins!\n' % (file, (time.time() - start)/60))
             except:
                 print('SOMETHING WENT WRONG!!')
@@ -665,74 +682,85 @@ def fit_dynamic_learning_rate_RW1972(slide_win = 10, fixed_sigma_bias = 'none',
     
     
 def align_block_switch_each_mouse(session_num, p_reward, choice_history, min_block_length = 30, prev_align = 30, next_align = 80, norm_trial = 10):
-        
-    #%% -- Get the choice matrix --
-    df_this_mouse = pd.DataFrame()
-     
-    unique_session = np.unique(session_num)
+    '''
+    Choices around all valid block switches (both blocks >= min_block_length) of all sessions, found in one pass over the concatenated sessions.
+    Rows of choice_matrix are aligned at the switch (column prev_align), nan-padded outside the two blocks, 
+    and flipped if p_R decreases so that "lean -> rich" is always "0 -> 1".
+    choice_norm_matrix: scaled so that the mean of the norm_trial trials before the switch is 0 and that of the last norm_trial trials is 1
+    '''
+    # Sessions must be contiguous (stable, so the trial order within each session is kept)
+    order = np.argsort(session_num, kind = 'stable')
+    session_num = np.asarray(session_num)[order]
+    choice = np.asarray(choice_history)[0, order].astype(float)
+    p_R = np.asarray(p_reward)[1, order]
+    n_trials = len(choice)
+    
+    #%% -- Blocks of all sessions: a block starts where p_R changes or where a session starts --
+    session_start = np.r_[True, session_num[1:] != session_num[:-1]]
+    block_start = np.flatnonzero(session_start | np.r_[True, np.diff(p_R) != 0])
+    block_length = np.diff(np.r_[block_start, n_trials])
+    
+    # Block switches = block starts within a session; valid if both neighboring blocks are long enough
+    next_block = np.flatnonzero(~session_start[block_start])
+    prev_length, next_length = block_length[next_block - 1], block_length[next_block]
+    valid = np.minimum(prev_length, next_length) >= min_block_length
+    prev_length, next_length = prev_length[valid], next_length[valid]
+    t_align = block_start[next_block[valid]]   # Over the concatenated sessions
+    
+    first_trial_of_session = np.flatnonzero(session_start)
+    block_switch = t_align - first_trial_of_session[np.searchsorted(first_trial_of_session, t_align, side = 'right') - 1]
+    prev_p_R, next_p_R = p_R[t_align - 1], p_R[t_align]
+    
+    #%% -- Get the choice matrix: [n_switches, prev_align + next_align] --
+    offset = np.arange(-prev_align, next_align)
+    prev_valid_n = np.minimum(prev_align, prev_length)
+    next_valid_n = np.minimum(next_align, next_length)
+    in_window = (offset >= -prev_valid_n[:, None]) & (offset < next_valid_n[:, None])
+    
+    choice_matrix = np.where(in_window, choice[np.clip(t_align[:, None] + offset, 0, n_trials - 1)], np.nan)
+    # To ensure "lean -> rich" is always aligned with "0->1", flip choice sign if p_R decreases after block switch
+    flip = next_p_R < prev_p_R
+    choice_matrix[flip] = 1 - choice_matrix[flip]
+    
+    # -- Normalized choice --
+    last_trials = np.clip(prev_align + next_valid_n[:, None] - norm_trial + np.arange(norm_trial), 0, None)
+    with warnings.catch_warnings(), np.errstate(invalid = 'ignore', divide = 'ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        norm_to_zero = np.nanmean(choice_matrix[:, prev_align - norm_trial : prev_align], axis = 1)  # norm_trial trials before block switch
+        norm_to_one = np.nanmean(np.take_along_axis(choice_matrix, last_trials, axis = 1), axis = 1)   # norm_trial trials at the last of the window
+        scale = norm_to_one - norm_to_zero
+        choice_norm_matrix = np.where((scale > 0)[:, None], (choice_matrix - norm_to_zero[:, None]) / scale[:, None], np.nan)  # No normalized choice if <= 0
+    
+    return pd.DataFrame({'session_num': session_num[t_align],
+                         'block_switch': block_switch,
+                         'prev_length': prev_length,
+                         'next_length': next_length,
+                         'prev_p_R': prev_p_R,
+                         'next_p_R': next_p_R,
+                         'change_p_R': np.abs(prev_p_R - next_p_R),
+                         'choice_matrix': choice_matrix.tolist(),
+                         'choice_norm_matrix': choice_norm_matrix.tolist()})
+
+#%%    
+def patch_cross_validation_each_mice(results_each_mice, cross_validation_model_num = [15], k_fold = 2, pool = ''):
     
-    for ss in unique_session:
-        df_this_session = {}
-        
-        choice_this_session = choice_history[0, session_num == ss]
-        p_R_this_session = p_reward[1, session_num == ss]
-        
-        block_switch_at = np.where(np.diff(p_R_this_session))[0] + 1
-        if block_switch_at.size == 0:  
-            continue
-        else:
-            block_length = np.hstack([block_switch_at[0], np.diff(np.hstack([block_switch_at, len(choice_this_session)]))])
-        
-        # Find valid block switches
-        valid = np.min([block_length[:-1], block_length[1:]], axis=0) >= min_block_length
-        df_this_session['session_num'] = [ss] * np.sum(valid)
-        df_this_session['block_switch'] = block_switch_at[valid]
-        df_this_session['prev_length'] = block_length[:-1][valid]
-        df_this_session['next_length'] = block_length[1:][valid]
-        df_this_session['prev_p_R'] = p_R_this_session[df_this_session['block_switch'] - 1]
-        df_this_session['next_p_R'] = p_R_this_session[df_this_session['block_switch']]
-        df_this_session['change_p_R'] = np.abs(df_this_session['prev_p_R'] - df_this_session['next_p_R'])
-
-        choice_matrix = np.full([len(df_this_session['block_switch']), prev_align + next_align], np.nan)
-        choice_norm_matrix = choice_matrix.copy()
-        
-        # For each valid block switch
-        for i, t_align in enumerate(df_this_session['block_switch']):
-            
-            prev_valid_n = min(prev_align, df_this_session['prev_length'][i])
-            next_valid_n = min(next_align, df_this_session['next_length'][i])
-            t_start = t_align - prev_valid_n
-            t_end = t_align + next_valid_n
-                
-            # Get choice
-            choice_selected = choice_this_session[t_start : t_end]
-            # To ensure "lean -> rich" is always aligned with "0->1", flip choice sign if p_R decreases after block switch
-            if df_this_session['next_p_R'][i] < df_this_session['prev_p_R'][i]: 
-                choice_selected = 1 - choice_selected
-            choice_matrix[i, prev_align - prev_valid_n : prev_align + next_valid_n] = choice_selected
-            
-            # choice_smoothed = moving_average(choice_selected, smooth_factor)
-            # choice_smoothed_matrix [i, prev_align - prev_valid_n : prev_align + next_valid_n] = choice_smoothed
-            
-            # -- Normalized choice --
-            norm_to_zero = np.mean(choice_selected[prev_align - norm_trial : prev_align]) # norm_trial trials before block switch
-            norm_to_one = np.mean(choice_selected[-norm_trial:])   # norm_trial trials at the last of the choice_selected
-            if norm_to_one - norm_to_zero > 0:
-                choice_norm = (choice_selected - norm_to_zero) / (norm_to_one - norm_to_zero)
-                choice_norm_matrix[i, prev_align - prev_valid_n : prev_align + next_valid_n] = choice_norm
-            else:
-                pass   # No normalized choice for this switch
-            
-        # Save to dataframe
-        df_this_session['choice_matrix'] = choice_matrix.tolist()
-        df_this_session['choice_norm_matrix'] = choice_norm_matrix.tolist()
-        df_this_session = pd.DataFrame(df_this_session)  # Turn to df
-        df_this_mouse = df_this_mouse.append(df_this_session)  # Save to this mouse
+    model_comparison_session_wise = results_each_mice['model_comparison_session_wise']
+    
+    for result_each_session in tqdm(model_comparison_session_wise, desc = 'CV for each session', total = len(model_comparison_session_wise)):
         
-        #%%
-    return df_this_mouse
+        # Cross-validation
+        choice_history_this = result_each_session.fit_choice_history
+        reward_history_this = result_each_session.fit_reward_history
+        CV_this = BanditModelComparison(choice_history_this, reward_history_this, models = cross_validation_model_num)
+        CV_this.cross_validate(pool = pool, k_fold = k_fold, if_verbose = False)
+        
+        # Update model_comparison_results
+        # Since result_each_session is a "reference", this line automatically update the original results_each_mice
+        result_each_session.prediction_accuracy_CV = CV_this.prediction_accuracy_CV
+        
+    # I only patch cross validation for each session, not grand fitting. So it's enough.
+    return results_each_mice
 
-#%%    
 def patch_cross_validation(raw_path = '..\\export\\', result_to_patch = "..\\results\\model_comparison\\model_comparison_",
                            cross_validation_model_num = [15], pool = ''):
     
@@ -746,22 +774,10 @@ def patch_cross_validation(raw_path = '..\\export\\', result_to_patch = "..\\res
             data = np.load(result_this, allow_pickle=True)
             
             results_each_mice = data.f.results_each_mice.item()
-            model_comparison_session_wise = results_each_mice['model_comparison_session_wise']
+            results_each_mice = patch_cross_validation_each_mice(results_each_mice, cross_validation_model_num, pool = pool)
             
-            for result_each_session in tqdm(model_comparison_session_wise, desc = 'CV for each session', total = len(model_comparison_session_wise)):
-                
-                # Cross-validation
-                choice_history_this = result_each_session.fit_choice_history
-                reward_history_this = result_each_session.fit_reward_history
-                CV_this = BanditModelComparison(choice_history_this, reward_history_this, models = cross_validation_model_num)
-                CV_this.cross_validate(pool = pool, k_fold = 2, if_verbose = False)
-                
-                # Update model_comparison_results
-                # Since result_each_session is a "reference", this line automatically update the original results_each_mice
-                result_each_session.prediction_accuracy_CV = CV_this.prediction_accuracy_CV
-                
-            # I only patch cross validation for each session, not grand fitting. So it's enough.
-            np.savez_compressed( result_to_patch + 'CV_patched_' + mouse, results_each_mice = results_each_mice)
+            with timed('disk_write'):
+                np.savez_compressed( result_to_patch + 'CV_patched_' + mouse, results_each_mice = results_each_mice)
             print('CV_patched!')
             
     return                 
@@ -770,7 +786,7 @@ def patch_cross_validation(raw_path = '..\\export\\', result_to_patch = "..\\res
 if __name__ == '__main__':
     
     n_worker = 8
-    pool = mp.Pool(processes = n_worker)
+    pool = get_pool(n_workers = n_worker)   # One pool for the whole run (DE reuses it instead of creating its own)
     
     # ---
     # data = np.load("..\\export\\FOR01.npz")
@@ -839,5 +855,4 @@ if __name__ == '__main__':
     # Negative control of constant learning rate
     # fit_dynamic_learning_rate_RW1972(slide_win = 40, method = 'nonDE', pool = '')
     
-    pool.close()   # Just a good practice
-    pool.join()
+    close_pool()   # Just a good practice
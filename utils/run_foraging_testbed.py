@@ -14,6 +14,9 @@ from tqdm import tqdm  # For progress bar. HH
 import time
 import multiprocessing as mp
 import copy
+import itertools
+import warnings
+from types import SimpleNamespace
 import statsmodels.api as sm
 import scipy.optimize as optimize
 
@@ -30,7 +33,12 @@ from models.bandit_model import BanditModelRestless as BanditRestless
 
 from utils.foraging_testbed_plots import plot_all_reps, plot_para_scan, plot_model_compet, plot_one_session
 from utils.helper_func import fit_sigmoid_p_choice
-from utils.descriptive_analysis import prepare_logistic, logistic_regression, logistic_regression_CV, win_stay_lose_shift
+from utils.descriptive_analysis import (prepare_logistic, logistic_regression, logistic_regression_CV, logistic_regression_batch,
+                                        decode_betas, win_stay_lose_shift, wsls_counts_grouped, wsls_from_counts)
+from utils.worker_pool import get_pool, close_pool, n_pool_workers
+from utils.results_store import ResultStore
+from utils.job_queue import spec_digest, code_digest
+from utils.instrumentation import instrument, timed
 
 methods = [ 
             # 'serial',
@@ -44,15 +52,17 @@ global_n_trials = 1000
 global_n_reps = 500
 
 
-def run_one_session(bandit, para_scan = False, para_optim = False, if_logistic=True):     
+@instrument()
+def run_one_session(bandit, para_scan = False, para_optim = False, if_logistic=True, if_descriptive=True):     
     # =============================================================================
     # Simulate one session
     # =============================================================================
-    bandit.reset()
-    for t in range(bandit.n_trials):        
-        # Loop: (Act --> Reward & New state)
-        action = bandit.act()
-        bandit.step(action)
+    with timed('simulate'):
+        bandit.reset()
+        for t in range(bandit.n_trials):        
+            # Loop: (Act --> Reward & New state)
+            action = bandit.act()
+            bandit.step(action)
         
     # =============================================================================
     # Compute results for this session
@@ -61,21 +71,16 @@ def run_one_session(bandit, para_scan = False, para_optim = False, if_logistic=T
     bandit.compute_foraging_eff(para_optim)   
    
     if not para_optim and not para_scan:
-        # -- 1. Psychometric curve --
-        p_reward = bandit.p_reward
-        choice = bandit.choice_history[0]
-
-        bandit.psychometric_win = 10
-        popt, _, mean_p_diff, mean_choice_R_frac = fit_sigmoid_p_choice(p_reward, choice, win=bandit.psychometric_win)
-        
-        bandit.psychometric_popt = popt
-        bandit.psychometric_mean_p_diff = mean_p_diff
-        bandit.psychometric_mean_choice_R_frac = mean_choice_R_frac
-        
-        # -- 2. WSLS --
+        # (run_sessions_parallel turns off if_descriptive and if_logistic, and does them for all sessions at once)
         choice = bandit.choice_history[0]   # choice: [0, 1, 1, 0]
         reward = np.sum(bandit.reward_history, axis=0)      # reward: [0, 0, 0, 1]
-        bandit.p_wsls = win_stay_lose_shift(choice, reward)
+
+        if if_descriptive:
+            # -- 1. Psychometric curve --
+            fit_psychometric_all_sessions([bandit])
+            
+            # -- 2. WSLS --
+            bandit.p_wsls = win_stay_lose_shift(choice, reward)
         
         if if_logistic:
             # -- 3. Logistic regression --
@@ -189,184 +194,197 @@ def run_one_session(bandit, para_scan = False, para_optim = False, if_logistic=T
     return bandit   # For apply_async, in-place change is impossible since each worker uses "bandit" as 
                     # an independent local object. So I have to return "bandit" explicitly
 
-def run_sessions_parallel(bandit, n_reps = global_n_reps, pool = '', para_optim = False, if_plot = True, if_logistic=True):  
+def fit_psychometric_all_sessions(bandits, win = 10):
+    '''
+    Psychometric curve of a list of finished sessions (sessions of the same length are fitted as one batch)
+    '''
+    n_trials = np.array([bb.choice_history.shape[1] for bb in bandits])
+    
+    for n in np.unique(n_trials):
+        batch = [bb for bb, nn in zip(bandits, n_trials) if nn == n]
+        p_reward = np.stack([bb.p_reward[:, :n] for bb in batch])
+        choice = np.stack([bb.choice_history[0] for bb in batch])
+        popt, _, mean_p_diff, mean_choice_R_frac = fit_sigmoid_p_choice(p_reward, choice, win=win)
+        
+        for ss, bb in enumerate(batch):
+            bb.psychometric_win = win
+            bb.psychometric_popt = popt[ss]
+            bb.psychometric_mean_p_diff = mean_p_diff[ss]
+            bb.psychometric_mean_choice_R_frac = mean_choice_R_frac[ss]
+
+def fit_logistic_all_sessions(bandits, trials_back = 20, batch_size = 100):
+    '''
+    Same as the logistic regression in run_one_session, but for a list of finished sessions at once
+    (batched Newton; see logistic_regression_batch). Sessions of different lengths are zero-padded.
+    '''
+    for start in range(0, len(bandits), batch_size):
+        batch = bandits[start : start + batch_size]
+        prepared = [prepare_logistic(bb.choice_history[0], np.sum(bb.reward_history, axis=0), trials_back=trials_back) for bb in batch]
+        
+        n_rows = max(len(Y) for _, Y in prepared)
+        data = np.zeros([len(batch), n_rows, 3 * trials_back])
+        Y = np.zeros([len(batch), n_rows])
+        weight = np.zeros([len(batch), n_rows])
+        for ss, (data_this, Y_this) in enumerate(prepared):
+            data[ss, :len(Y_this)], Y[ss, :len(Y_this)], weight[ss, :len(Y_this)] = data_this, Y_this, 1
+        
+        output, _ = logistic_regression_batch(data, Y, C=1, sample_weight=weight)
+        
+        for bb, out in zip(batch, output):
+            # Only the fitted betas are used downstream (plot_one_session, plot_all_reps)
+            b_RewC, b_UnrC, b_C, bias = decode_betas(out)
+            bb.logistic_reg = SimpleNamespace(coef_=out[None, :-1], intercept_=out[-1:], 
+                                              b_RewC=b_RewC, b_UnrC=b_UnrC, b_C=b_C, bias=bias)
+
+def run_sessions_parallel(bandit, n_reps = global_n_reps, pool = '', para_optim = False, if_plot = True, if_logistic=True,
+                          n_example_sessions = 10, batch_size = 500):  
     # =============================================================================
     # Run simulations with the same bandit (para_scan = 0) or a list of bandits (para_scan = 1), in serial or in parallel, repeating n_reps.
+    #
+    # Sessions are run in batches of batch_size and each batch is summarized as soon as it is finished (efficiency, matching slope, 
+    # and if not para_scan / para_optim, psychometric fit, logistic betas, WSLS and stay durations), then dropped. Only the first 
+    # n_example_sessions finished bandits are kept in results_all_sessions['bandits_all_sessions'], so memory does not grow with n_reps.
     # =============================================================================
     if isinstance(bandit, list):  # Whether we're doing a parameter scan.
         para_scan = 1
     else:
         para_scan = 0
         bandit = [bandit]   # For backward compatibility
-   
-    # Generate a series of deepcopys of bandit to make them independent!!
-    bandits_all_sessions = []
-    for bb in bandit:
-        [bandits_all_sessions.append(copy.deepcopy(bb)) for ss in range(n_reps)]
-        
-    if pool == '':  # Serial computing (for debugging)
-        start = time.time()         
-        
-        if not para_optim:  # Progress bar
-            for ss, bb in tqdm(enumerate(bandits_all_sessions), total = len(bandits_all_sessions), desc='serial'):     # trange: progress bar. HH
-                run_one_session(bb, para_scan, para_optim, if_logistic)     # There is no need to assign back the resulting bandit. (Modified inside run_one_session())
-        else:
-            for ss, bb in enumerate(bandits_all_sessions):     # trange: progress bar. HH
-                run_one_session(bb, para_scan, para_optim, if_logistic)     # There is no need to assign back the resulting bandit. (Modified inside run_one_session())
-            
-                
-        if not para_optim: print('--- serial finished in %g s ---' % (time.time()-start))
-        
-    else:    # Parallel computing using multiprocessing.apply_async()
-        start = time.time()
-        
-        # Note the "," in (bb,). See here https://stackoverflow.com/questions/29585910/why-is-multiprocessings-apply-async-so-picky
-        result_ids = [pool.apply_async(run_one_session, args = (bb, para_scan, para_optim, if_logistic)) for bb in bandits_all_sessions]  
-                        
-        if not para_optim:  # Progress bar
-            for ss, result_id in tqdm(enumerate(result_ids), total = len(bandits_all_sessions), desc='apply_async'):
-                # For apply_async, the assignment is required, because the bb passed to the workers are local independent copys.
-                bandits_all_sessions[ss] = result_id.get()  
-        else:
-            for ss, result_id in enumerate(result_ids):
-                # For apply_async, the assignment is required, because the bb passed to the workers are local independent copys.
-                bandits_all_sessions[ss] = result_id.get()
-            
-        # if not para_optim: print('--- apply_async finished in %g s---' % (time.time()-start), flush=True)
-        
+    
+    if_summary = not (para_scan or para_optim)
+    n_unique_bandits = len(bandit)
+    if if_plot and if_summary: n_example_sessions = max(n_example_sessions, 1)   # plot_all_reps is built around an example session
+    
+    # Session ss is the (ss % n_reps)-th repetition of bandit[ss // n_reps]. 
+    # The deepcopys (to make them independent!!) are only made when their batch is started
+    batches = [np.arange(start, min(start + batch_size, n_unique_bandits * n_reps)) for start in range(0, n_unique_bandits * n_reps, batch_size)]
+
     # =============================================================================
-    # Compute summarizing results for all sessions
+    # Summarizing results, accumulated batch by batch
     # =============================================================================
     results_all_sessions = dict()
-    stay_duration_hist_bins = np.arange(21) + 0.5
-    n_unique_bandits = len(bandit)
-    
     results_all_sessions['foraging_efficiency_per_session'] = np.zeros([n_unique_bandits, n_reps])
     
-    if not (para_scan or para_optim):
+    if if_summary:
+        stay_duration_hist_bins = np.arange(21) + 0.5
         results_all_sessions['stay_duration_hist'] = np.zeros(len(stay_duration_hist_bins)-1)
-        
-        # if bandit[0].forager == 'IdealOptimal':
-        #     results_all_sessions['matching_slope_IdealOptimal_theoretical_per_session'] = np.zeros(n_reps)
+        results_all_sessions['psychometric_popt_per_session'] = np.full([n_reps, 2], np.nan)
+        if if_logistic: results_all_sessions['logistic_betas_per_session'] = {}   # {'b_RewC': [n_reps, trials_back], ...}
+        wsls_k, wsls_n = {}, {}   # Event counts of each session (see wsls_counts_grouped)
     
     if not para_optim:
         results_all_sessions['linear_fit_log_income_ratio'] = np.zeros([n_unique_bandits, 4, 2])
         results_all_sessions['linear_fit_log_income_ratio'][:] = np.nan
         results_all_sessions['linear_fit_income_per_session'] = np.zeros([n_unique_bandits, n_reps])
         results_all_sessions['linear_fit_return_per_session'] = np.zeros([n_unique_bandits, n_reps])
+    
+    example_sessions = []
+    n_blocks_now = 0
+    
+    start = time.time()
+    progress = tqdm(total = n_unique_bandits * n_reps, desc = 'serial' if pool == '' else 'apply_async', disable = para_optim)   # Progress bar
+    
+    if pool != '' and batches:    # Parallel computing using multiprocessing.apply_async()
+        # Note the "," in (bb,). See here https://stackoverflow.com/questions/29585910/why-is-multiprocessings-apply-async-so-picky
+        result_ids = [pool.apply_async(run_one_session, args = (copy.deepcopy(bandit[ss // n_reps]), para_scan, para_optim, False, False)) 
+                      for ss in batches[0]]
+    
+    for batch_idx, batch in enumerate(batches):
+        finished = []
         
-    # Loop over all unique bandits
-    for unique_idx in range(n_unique_bandits):
-        
-        sessions_for_this_bandit = bandits_all_sessions [unique_idx * n_reps : (unique_idx + 1) * n_reps]
-        
-        n_blocks_now = 0    
-        for ss, bb in enumerate(sessions_for_this_bandit): n_blocks_now += bb.n_blocks
-        blockwise_stats_this_bandit = np.zeros([5, n_blocks_now])   # [choice_frac, reward_frac, log_choice_ratio, log_reward_ratio]
-        
-        # --- Loop over repetitions ---
-        n_blocks_now = 0        
-        for ss, bb in enumerate(sessions_for_this_bandit):
-            # Session-wise
-            results_all_sessions['foraging_efficiency_per_session'][unique_idx,ss] = bb.foraging_efficiency
+        if pool == '':  # Serial computing (for debugging)
+            for ss in batch:
+                finished.append(run_one_session(copy.deepcopy(bandit[ss // n_reps]), para_scan, para_optim, if_logistic = False, if_descriptive = False))
+                progress.update()
+        else:
+            # Submit the next batch first so that the workers are kept busy while this one is summarized
+            next_ids = [pool.apply_async(run_one_session, args = (copy.deepcopy(bandit[ss // n_reps]), para_scan, para_optim, False, False)) 
+                        for ss in (batches[batch_idx + 1] if batch_idx + 1 < len(batches) else [])]
+            for result_id in result_ids:
+                # For apply_async, the assignment is required, because the bb passed to the workers are local independent copys.
+                finished.append(result_id.get())
+                progress.update()
+            result_ids = next_ids
+        
+        # -- Session-wise --
+        unique_idx, rep_idx = np.divmod(batch, n_reps)
+        results_all_sessions['foraging_efficiency_per_session'][unique_idx, rep_idx] = [bb.foraging_efficiency for bb in finished]
+        n_blocks_now += sum(bb.n_blocks for bb in finished)
+        
+        if not para_optim:
+            # Session-wise matching slope for model competition
+            results_all_sessions['linear_fit_income_per_session'][unique_idx, rep_idx] = [matching_slope_session(bb) for bb in finished]
+        
+        if if_summary:   # Only one unique bandit here, so rep_idx is also the session number
+            # All sessions of the batch are fitted together (cheaper than one scipy / sklearn fit per session in the workers)
+            fit_psychometric_all_sessions(finished)
+            results_all_sessions['psychometric_popt_per_session'][rep_idx] = [bb.psychometric_popt for bb in finished]
             
-            if not (para_scan or para_optim):
-                pass
-                # results_all_sessions['stay_duration_hist'] += np.histogram(bb.stay_durations, bins = stay_duration_hist_bins)[0]
-                
-                # if bandit[0].forager == 'IdealOptimal':
-                #     results_all_sessions['matching_slope_IdealOptimal_theoretical_per_session'][ss] = bb.matching_slope_IdealOptimal_theoretical
-
-            if not para_optim:
-                pass
-                
-                # results_all_sessions['linear_fit_income_per_session'][unique_idx,ss] = bb.linear_fit_income_per_session # Add session-wise matching slope for model competition
-                # results_all_sessions['linear_fit_return_per_session'][unique_idx,ss] = bb.linear_fit_return_per_session # Matching slope from log_return_ratio
-
-                # blockwise_stats_this_bandit[:, n_blocks_now : n_blocks_now + bb.n_blocks] =  \
-                #     np.vstack([bb.blockwise_choice_fraction, 
-                #                bb.blockwise_income_fraction, 
-                #                bb.blockwise_log_choice_ratio, 
-                #                bb.blockwise_log_income_ratio,
-                #                bb.blockwise_log_return_ratio])  # Add the last one. Mar.5, 2020
-                # n_blocks_now += bb.n_blocks
+            if if_logistic: 
+                fit_logistic_all_sessions(finished)
+                betas = results_all_sessions['logistic_betas_per_session']
+                for beta in ('b_RewC', 'b_UnrC', 'b_C', 'bias'):
+                    this = np.array([getattr(bb.logistic_reg, beta)[0, :] for bb in finished])
+                    betas.setdefault(beta, np.full([n_reps, this.shape[1]], np.nan))[rep_idx] = this
             
-        if not para_optim and not para_scan:   # For para_optim, we don't need this. For para_scan, I decided to use session-wise matching index.
+            # WSLS counts of the batch in one pass
+            choice_all = np.concatenate([bb.choice_history[0] for bb in finished])
+            reward_all = np.concatenate([np.sum(bb.reward_history, axis=0) for bb in finished])
+            session_num = np.repeat(rep_idx, [bb.choice_history.shape[1] for bb in finished])
+            _, k_each, n_each = wsls_counts_grouped(choice_all, reward_all, session_num)
+            for name in k_each:
+                wsls_k.setdefault(name, np.zeros(n_reps))[rep_idx] = k_each[name]
+                wsls_n.setdefault(name, np.zeros(n_reps))[rep_idx] = n_each[name]
             
-            pass
+            # Stay durations: a run ends where the choice changes or where a session ends
+            run_ends = np.flatnonzero(np.append((np.diff(choice_all) != 0) | (np.diff(session_num) != 0), True))
+            results_all_sessions['stay_duration_hist'] += np.histogram(np.diff(run_ends, prepend = -1), bins = stay_duration_hist_bins)[0]
         
-            # --- Linear regression on log_ratios (moved here) ---
-            # c_log_ratio = blockwise_stats_this_bandit[2,:]
-            # inc_log_ratio = blockwise_stats_this_bandit[3,:]
-                
-            # c_fraction = blockwise_stats_this_bandit[0,:]
-            # inc_fraction = blockwise_stats_this_bandit[1,:]
-            
-            # if bandit[0].forager not in ['AlwaysLEFT','IdealpGreedy'] and np.sum(~np.isnan(inc_log_ratio)) > 10:  # Use log_ratio
-            #     x = inc_log_ratio[~np.isnan(inc_log_ratio)]
-            #     y = c_log_ratio[~np.isnan(c_log_ratio)]
-                
-            #     # Linear regression
-            #     model = sm.OLS(y, sm.add_constant(x)).fit()
-                
-            #     intercept, a = model.params  # "a, b" in Corrado 2005
-            #     b = np.exp(intercept)
-            #     intercept_CI95, a_CI95  = np.diff(model.conf_int(), axis=1)/2
-            #     a_CI95 = a_CI95[0]
-            #     r_square, p = (model.rsquared, model.pvalues)
-                
-            #     # From log ratio to fraction
-            #     slope = 4*a*b/(1+b)**2   #　"Slope" in Iigaya 2019: linear fitting of fractional choice vs fractional reward. By derivation  
-            #     slope_CI95 = a_CI95*4*b/(1+b)**2
-               
-            #     results_all_sessions['linear_fit_log_income_ratio'][unique_idx,:,:] = [a, a_CI95], [b, np.nan],[r_square, p[1]],[slope, slope_CI95]
-                
-            # elif np.sum(~np.isnan(inc_fraction)) > 5:   # Otherwise, use fraction (only this way can we get a matching slope for ideal_greedy and forager with extreme bias)
-            
-            #     x = inc_fraction[~np.isnan(inc_fraction)]
-            #     y = c_fraction[~np.isnan(c_fraction)]
-                
-            #     # Linear regression
-            #     model = sm.OLS(y, sm.add_constant(x)).fit()
-                
-            #     try:
-            #         intercept, a = model.params
-            #         intercept_CI95, a_CI95  = np.diff(model.conf_int(), axis=1)/2
-            #         results_all_sessions['linear_fit_log_income_ratio'][unique_idx,:,:] = [np.nan, np.nan], [np.nan, np.nan],[np.nan, np.nan],[a, a_CI95]
-            #     except:
-            #         pass
+        example_sessions += finished[:max(n_example_sessions - len(example_sessions), 0)]
+        del finished
+    
+    progress.close()
+    if pool == '' and not para_optim: print('--- serial finished in %g s ---' % (time.time()-start))
+    
+    if if_summary:
+        results_all_sessions['p_wsls_per_session'], results_all_sessions['p_wsls_pooled'] = wsls_from_counts(np.arange(n_reps), wsls_k, wsls_n)
+        
+        # if bandit[0].forager == 'IdealOptimal':
+        #     results_all_sessions['matching_slope_IdealOptimal_theoretical_per_session'] = np.zeros(n_reps)
+    
+    # The blockwise linear regression on log_ratios (Corrado 2005) was replaced by the session-wise matching slope (matching_slope_session),
+    # and the block-wise stats it used ('blockwise_stats') are not computed any more
             
     if not para_scan:    
         results_all_sessions['foraging_efficiency'] = np.array([np.mean(results_all_sessions['foraging_efficiency_per_session']),
                                                       1.96 * np.std(results_all_sessions['foraging_efficiency_per_session'])/np.sqrt(n_reps)])
         
-        results_all_sessions['blockwise_stats'] = blockwise_stats_this_bandit # We need this only when not para_scan
-        
         # if bandit[0].forager == 'IdealOptimal':        
         #     results_all_sessions['matching_slope_IdealOptimal_theoretical'] = np.mean(results_all_sessions['matching_slope_IdealOptimal_theoretical_per_session'])
 
     # Basic info
     results_all_sessions['n_reps'] = n_reps
-    results_all_sessions['forager'] = bandits_all_sessions[0].forager
-    results_all_sessions['if_baited'] = bandits_all_sessions[0].if_baited
-    results_all_sessions['if_varying_amplitude'] = bandits_all_sessions[0].if_varying_amplitude
-    results_all_sessions['p_reward_sum'] = bandits_all_sessions[0].p_reward_sum
-    results_all_sessions['p_reward_pairs'] = bandits_all_sessions[0].p_reward_pairs
+    results_all_sessions['forager'] = bandit[0].forager
+    results_all_sessions['task'] = bandit[0].task
+    if 'restless' in bandit[0].task: results_all_sessions['sigma'] = bandit[0].sigma
+    results_all_sessions['if_baited'] = bandit[0].if_baited
+    results_all_sessions['if_varying_amplitude'] = bandit[0].if_varying_amplitude
+    results_all_sessions['p_reward_sum'] = bandit[0].p_reward_sum
+    results_all_sessions['p_reward_pairs'] = bandit[0].p_reward_pairs
     
+    # Example sessions (e.g. for FullStateQ, or runlength_anlaysis_Lau)
+    results_all_sessions['bandits_all_sessions'] = example_sessions
     
     # If not in para_scan, plot summary statistics over repeated sessions for the SAME bandit
-    if if_plot and not (para_scan or para_optim):
+    if if_plot and if_summary:
         results_all_sessions['n_trials'] = n_reps * bandit[0].n_trials
         results_all_sessions['n_blocks'] = n_blocks_now
-        results_all_sessions['description'] = bandits_all_sessions[0].description
-        results_all_sessions['example_session'] = bandits_all_sessions[0]
-        
-        # For runlength_anlaysis_Lau
-        results_all_sessions['choice_history'] = np.hstack([bb.choice_history for bb in bandits_all_sessions])
-        results_all_sessions['p_reward'] = np.hstack([bb.p_reward for bb in bandits_all_sessions])
+        results_all_sessions['description'] = bandit[0].description
+        results_all_sessions['example_session'] = example_sessions[0]
         
-        # For FullStateQ
-        results_all_sessions['bandits_all_sessions'] = bandits_all_sessions
+        # For runlength_anlaysis_Lau (example sessions only)
+        results_all_sessions['choice_history'] = np.hstack([bb.choice_history for bb in example_sessions])
+        results_all_sessions['p_reward'] = np.hstack([bb.p_reward for bb in example_sessions])
         
         plot_all_reps(results_all_sessions) 
     
@@ -377,58 +395,199 @@ def run_sessions_parallel(bandit, n_reps = global_n_reps, pool = '', para_optim
 
 
 # =============================================================================
-#  1-D or 2-D manual parameter scan
+#  N-D manual parameter scan
 # =============================================================================
+def matching_slope_session(bandit):
+    '''
+    Matching slope of one session ("slope" in Iigaya 2019): linear fit of blockwise choice fraction vs. income fraction (of RIGHT).
+    Blocks without any reward are dropped; nan if less than 3 blocks are left (or no block structure, e.g. restless bandit)
+    '''
+    n_trials = bandit.n_trials
+    block_starts = np.unique(np.r_[0, np.cumsum(bandit.block_size)[:-1]]).astype(int) if len(bandit.block_size) else []
+    block_starts = block_starts[block_starts < n_trials] if len(block_starts) else block_starts
+    if len(block_starts) < 3: return np.nan
+    
+    choice = bandit.choice_history[0, :n_trials]
+    reward = bandit.reward_history[:, :n_trials]
+    block_len = np.diff(np.r_[block_starts, n_trials])
+    
+    choice_frac = np.add.reduceat(choice == RIGHT, block_starts) / block_len
+    income_R = np.add.reduceat(reward[RIGHT], block_starts)
+    income = income_R + np.add.reduceat(reward[LEFT], block_starts)
+    
+    valid = income > 0
+    if np.sum(valid) < 3: return np.nan
+    x, y = income_R[valid] / income[valid], choice_frac[valid]
+    
+    x_var = np.var(x)
+    return np.mean((x - x.mean()) * (y - y.mean())) / x_var if x_var > 0 else np.nan
+
+# Per-session statistics collected by para_scan_nd (extra_stats can be any of them)
+SESSION_STATS = {'foraging_efficiency': lambda bb: bb.foraging_efficiency,
+                 'matching_slope': matching_slope_session,
+                 'reward_rate': lambda bb: np.sum(bb.reward_history[:, :bb.n_trials]) / bb.n_trials,
+                 'choice_fraction_R': lambda bb: np.mean(bb.choice_history[0, :bb.n_trials] == RIGHT),
+                 'p_switch': lambda bb: np.mean(np.diff(bb.choice_history[0, :bb.n_trials]) != 0),
+                 }
+
+def make_bandit(forager, task = 'Bandit_block', if_baited = True, p_reward_sum = 0.45, p_reward_pairs = None, **kwargs_all):
+    if task == 'Bandit_block':
+        return Bandit(forager = forager, if_baited = if_baited, p_reward_sum = p_reward_sum, p_reward_pairs = p_reward_pairs, **kwargs_all)
+    elif task == 'Bandit_restless':
+        return BanditRestless(forager = forager, **kwargs_all)
+
+def run_scan_unit(bandit_kwargs, n_sessions, stats, seeds = None):
+    '''
+    One unit of para_scan_nd: n_sessions repetitions of one grid cell --> {stat: [n_sessions]}
+    The bandit is built here from its kwargs, so only a small dict goes to the worker
+    seeds: None or [n_sessions, 2] (p_reward seed, agent seed) of each session (see crn_seeds)
+    '''
+    template = make_bandit(**bandit_kwargs)
+    results = {stat: np.zeros(n_sessions) for stat in stats}
+    
+    for ss in range(n_sessions):
+        bb = copy.deepcopy(template)
+        if seeds is not None:
+            bb.p_reward_seed_override, bb.agent_seed_override = int(seeds[ss][0]), int(seeds[ss][1])
+        run_one_session(bb, para_scan = True)
+        for stat in stats:
+            results[stat][ss] = SESSION_STATS[stat](bb)
+            
+    return results
+
+def run_units(units, stats, pool = '', desc = ''):
+    '''
+    units: [(bandit_kwargs, n_sessions, seeds)] --> [{stat: [n_sessions]}] in the same order, in serial or on the pool
+    '''
+    if pool == '':
+        outputs = (run_scan_unit(bandit_kwargs, n_sessions, stats, seeds) for bandit_kwargs, n_sessions, seeds in units)
+    else:
+        result_ids = [pool.apply_async(run_scan_unit, args = (bandit_kwargs, n_sessions, stats, seeds)) for bandit_kwargs, n_sessions, seeds in units]
+        outputs = (result_id.get() for result_id in result_ids)
+    
+    return list(tqdm(outputs, total = len(units), desc = desc, disable = desc == ''))
+
+def crn_seeds(n_sessions, seed = 20200303):
+    '''
+    Common random numbers: [n_sessions, 2] (p_reward seed, agent seed) of each session, shared by all candidates,
+    so that differences between candidates are not buried in the session-to-session noise
+    '''
+    return np.random.SeedSequence(seed).generate_state(2 * n_sessions).reshape(n_sessions, 2).astype(np.int64)
+
+def para_scan_nd(forager, para_grid, task='Bandit_block', 
+                 n_reps = global_n_reps, pool = '', rep_chunk = None, extra_stats = (),
+                 ci_target = None, min_reps = 20,
+                 if_baited = True, p_reward_sum = 0.45, p_reward_pairs = None, **kwargs):
+    '''
+    Scan over the full grid of any number of parameters, e.g.
+        para_grid = {'learn_rate_rew': np.linspace(0, 1, 11), 'learn_rate_unrew': np.linspace(0, 1, 11), 'softmax_temperature': [0.1, 0.2, 0.5]}
+    
+    The work is split into units of (one grid cell x rep_chunk repetitions) which are spread over the pool 
+    (by default, rep_chunk gives ~4 units per worker, and is at most n_reps).
+    
+    Adaptive replication (ci_target is not None): repetitions are run in rounds, and a cell stops as soon as the 95% CI 
+    half-width of its foraging efficiency is below ci_target (or it has n_reps sessions). The first round has min_reps sessions per cell;
+    later rounds aim at the number of sessions that the current std says are needed (at least min_reps more).
+    
+    Returns a dict with
+        'dims': parameter names, 'coords': {name: values}, 'shape': grid shape, 'n_reps_used': [*shape]
+        '<stat>': [*shape, n_reps] (one value per session; nan for sessions not run), '<stat>_mean' and '<stat>_CI95': [*shape]
+    for stat in 'foraging_efficiency', 'matching_slope' and extra_stats (see SESSION_STATS)
+    '''
+    return para_scan_batch([(forager, para_grid, kwargs)], task = task, n_reps = n_reps, pool = pool, rep_chunk = rep_chunk, 
+                           extra_stats = extra_stats, ci_target = ci_target, min_reps = min_reps,
+                           if_baited = if_baited, p_reward_sum = p_reward_sum, p_reward_pairs = p_reward_pairs)[0]
+
+def para_scan_batch(scans, task='Bandit_block', 
+                    n_reps = global_n_reps, pool = '', rep_chunk = None, extra_stats = (),
+                    ci_target = None, min_reps = 20,
+                    if_baited = True, p_reward_sum = 0.45, p_reward_pairs = None, **kwargs):
+    '''
+    Several scans run as one sharded workload: scans = [(forager, para_grid, fixed_paras), ...] (kwargs are fixed for all of them).
+    The cells of all scans are pooled together, so the units of small scans (e.g. 0-D baselines) fill the pool
+    along with those of the big ones instead of waiting for them. Returns a list of para_scan_nd results, one per scan.
+    '''
+    stats = ['foraging_efficiency', 'matching_slope', *[stat for stat in extra_stats if stat not in ('foraging_efficiency', 'matching_slope')]]
+    n_workers = n_pool_workers(pool)
+    
+    # Cells are in C order within each scan (the last parameter changes fastest, as the nested loops of the old para_scan)
+    scans_info, cell_kwargs = [], []
+    for forager, para_grid, fixed_paras in scans:
+        coords = {name: list(values) for name, values in para_grid.items()}
+        shape = tuple(len(values) for values in coords.values())
+        scans_info.append((forager, list(para_grid.keys()), coords, shape, {**fixed_paras, **kwargs}, len(cell_kwargs)))
+        cell_kwargs += [{'forager': forager, 'task': task, 'if_baited': if_baited, 'p_reward_sum': p_reward_sum, 'p_reward_pairs': p_reward_pairs,
+                         **dict(zip(coords.keys(), values)), **fixed_paras, **kwargs} for values in itertools.product(*coords.values())]
+    n_cells = len(cell_kwargs)
+    
+    per_session = {stat: np.full([n_cells, n_reps], np.nan) for stat in stats}
+    n_done = np.zeros(n_cells, dtype = int)
+    cells_todo = np.arange(n_cells)
+    n_this_round = np.full(n_cells, n_reps if ci_target is None else min(min_reps, n_reps))
+    
+    while len(cells_todo):
+        # == Units of this round: (cell, start, size) ==
+        chunk = rep_chunk or int(np.clip(np.ceil(np.sum(n_this_round[cells_todo]) / (4 * n_workers)), 1, n_reps))
+        units = [(cell, start, min(chunk, n_done[cell] + n_this_round[cell] - start)) 
+                 for cell in cells_todo for start in range(n_done[cell], n_done[cell] + n_this_round[cell], chunk)]
+        outputs = run_units([(cell_kwargs[cell], size, None) for cell, _, size in units], stats, pool = pool,
+                            desc = 'para_scan (%g cells)' % len(cells_todo))
+            
+        for (cell, start, size), output in zip(units, outputs):
+            for stat in stats:
+                per_session[stat][cell, start : start + size] = output[stat]
+        n_done[cells_todo] += n_this_round[cells_todo]
+        
+        if ci_target is None: break
+        
+        # == Which cells need more sessions, and how many ==
+        fe_std = np.nanstd(per_session['foraging_efficiency'][cells_todo], axis = 1)
+        ci_half_width = 1.96 * fe_std / np.sqrt(n_done[cells_todo])
+        cells_todo = cells_todo[(ci_half_width > ci_target) & (n_done[cells_todo] < n_reps)]
+        
+        n_needed = np.ceil((1.96 * np.nanstd(per_session['foraging_efficiency'][cells_todo], axis = 1) / ci_target) ** 2).astype(int)
+        n_this_round[cells_todo] = np.clip(n_needed - n_done[cells_todo], min_reps, n_reps - n_done[cells_todo])
+    
+    # == Result tensors of each scan ==
+    results_all_scans = []
+    for forager, dims, coords, shape, fixed_paras, first_cell in scans_info:
+        cells = slice(first_cell, first_cell + int(np.prod(shape)))
+        results_scan = {'forager': forager, 'task': task, 'n_reps': n_reps, 'dims': dims, 'coords': coords, 'shape': shape,
+                        'n_reps_used': n_done[cells].reshape(shape), 'ci_target': ci_target, 'fixed_paras': fixed_paras, 
+                        'if_baited': if_baited, 'p_reward_sum': p_reward_sum, 'p_reward_pairs': p_reward_pairs}
+        
+        for stat in stats:
+            this = per_session[stat][cells].reshape(*shape, n_reps)
+            results_scan[stat] = this
+            with warnings.catch_warnings(), np.errstate(invalid = 'ignore', divide = 'ignore'):
+                warnings.simplefilter('ignore', RuntimeWarning)   # Cells without any valid session (e.g. matching slope) --> nan
+                results_scan[stat + '_mean'] = np.nanmean(this, axis = -1)
+                results_scan[stat + '_CI95'] = 1.96 * np.nanstd(this, axis = -1) / np.sqrt(np.sum(~np.isnan(this), axis = -1))
+        
+        results_all_scans.append(results_scan)
+        
+    return results_all_scans
+
 def para_scan(forager, para_to_scan, task='Bandit_block', 
-              n_reps = global_n_reps, pool = '', 
+              n_reps = global_n_reps, pool = '', ci_target = None, min_reps = 20,
               if_plot = True, if_baited = True, 
               p_reward_sum = 0.45, p_reward_pairs = None, **kwargs):
-    
-    # == Turn para_to_scan into list of Bandits ==
-    n_nest = len(para_to_scan)
-    bandits_to_scan = []
-    
-    if n_nest == 1:
-        para_name, para_range = list(para_to_scan.items())[0]
-        
-        for pp in para_range:
-            kwargs_all = {**{para_name:pp}, **kwargs}   # All parameters
-            
-            if task == 'Bandit_block':
-                bandits_to_scan.append(Bandit(forager = forager, if_baited = if_baited,  
-                                            p_reward_sum = p_reward_sum, 
-                                            p_reward_pairs = p_reward_pairs, 
-                                            **kwargs_all))   # Append to the list
-            elif task == 'Bandit_restless':
-                bandits_to_scan.append(BanditRestless(forager = forager, 
-                                                        **kwargs_all))   # Append to the list
-            
-    elif n_nest == 2:
-        para_names = list(para_to_scan.keys())
-        para_ranges = list(para_to_scan.values())
-        
-        for pp_1 in para_ranges[0]:
-            for pp_2 in para_ranges[1]:
-                
-                # if forager == 'Hattori2019':    # Stupid workaround...
-                #     kwargs_all = {'step_sizes': [pp_1, pp_2], **kwargs}
-                    
-                # else:   
-                    
-                kwargs_all = {**{para_names[0]: pp_1, para_names[1]: pp_2}, **kwargs}
-                    
-                if task == 'Bandit_block':
-                    bandits_to_scan.append(Bandit(forager = forager, 
-                                                  if_baited = if_baited, 
-                                                  p_reward_sum = p_reward_sum, 
-                                                  p_reward_pairs = p_reward_pairs,
-                                                  **kwargs_all))   # Append to the list
-                elif task == 'Bandit_restless':
-                    bandits_to_scan.append(BanditRestless(forager = forager, 
-                                                          **kwargs_all))   # Append to the list
-            
-    results_para_scan = run_sessions_parallel(bandits_to_scan, n_reps = n_reps, pool = pool)
-    if if_plot: plot_para_scan(results_para_scan, para_to_scan, if_baited = if_baited, p_reward_sum = p_reward_sum, p_reward_pairs = p_reward_pairs, **kwargs)
+    '''
+    para_scan_nd + the flattened [n_cells, n_reps] results used by plot_para_scan and model_compet (only 1-D or 2-D scans are plotted)
+    With ci_target, n_reps is the maximum number of sessions per cell (see para_scan_nd)
+    '''
+    results_para_scan = para_scan_nd(forager, para_to_scan, task = task, n_reps = n_reps, pool = pool, ci_target = ci_target, min_reps = min_reps,
+                                     if_baited = if_baited, p_reward_sum = p_reward_sum, p_reward_pairs = p_reward_pairs, **kwargs)
+    
+    n_cells = int(np.prod(results_para_scan['shape']))
+    results_para_scan['foraging_efficiency_per_session'] = results_para_scan['foraging_efficiency'].reshape(n_cells, n_reps)
+    results_para_scan['linear_fit_income_per_session'] = results_para_scan['matching_slope'].reshape(n_cells, n_reps)
+    results_para_scan['linear_fit_log_income_ratio'] = np.full([n_cells, 4, 2], np.nan)   # [:, 3, :] = matching slope and its CI95
+    results_para_scan['linear_fit_log_income_ratio'][:, 3, 0] = results_para_scan['matching_slope_mean'].ravel()
+    results_para_scan['linear_fit_log_income_ratio'][:, 3, 1] = results_para_scan['matching_slope_CI95'].ravel()
+    
+    if if_plot and len(para_to_scan) <= 2: 
+        plot_para_scan(results_para_scan, para_to_scan, if_baited = if_baited, p_reward_sum = p_reward_sum, p_reward_pairs = p_reward_pairs, **kwargs)
             
     return results_para_scan
 
@@ -478,11 +637,127 @@ def score_func(opti_value, *argss):
     
     return score
 
+def score_func_population(opti_values, *argss):
+    '''
+    score_func of a whole DE generation at once (differential_evolution(vectorized = True)): [n_paras, S] --> [S], or [n_paras] --> scalar
+    All S x n_reps_per_iter sessions go to the pool as one batch of units, and are reduced per candidate afterwards
+    (instead of one fan-out / fan-in barrier per candidate)
+    '''
+    forager, opti_names, n_reps_per_iter, if_baited, p_reward_sum, p_reward_pairs, if_varying_amplitude, pool, task, kwargs = argss
+    opti_values = np.asarray(opti_values)
+    population = opti_values.T if opti_values.ndim == 2 else opti_values[np.newaxis, :]
+    
+    candidate_kwargs = [{'task': task, 'if_baited': if_baited, 'p_reward_sum': p_reward_sum, 'p_reward_pairs': p_reward_pairs, 
+                         'p_reward_seed_override': 20200303,  # The same reward schedule for fair comparison
+                         'if_varying_amplitude': if_varying_amplitude, 'if_para_optim': True, 
+                         **generate_kwargs(forager, opti_names, x), **kwargs} for x in population]
+    
+    chunk = int(np.clip(np.ceil(len(population) * n_reps_per_iter / (4 * n_pool_workers(pool))), 1, n_reps_per_iter))
+    units = [(ii, min(chunk, n_reps_per_iter - start)) for ii in range(len(population)) for start in range(0, n_reps_per_iter, chunk)]
+    outputs = run_units([(candidate_kwargs[ii], size, None) for ii, size in units], ['foraging_efficiency'], pool = pool)
+    
+    efficiency_sum = np.zeros(len(population))
+    for (ii, _), output in zip(units, outputs):
+        efficiency_sum[ii] += np.sum(output['foraging_efficiency'])
+        
+    scores = - efficiency_sum / n_reps_per_iter  # Negative efficiency as cost function
+    return scores if opti_values.ndim == 2 else scores[0]
+
+
+def para_optimize_halving(forager, opti_names, bounds, n_candidates = 64, eta = 3, min_reps = 20, max_reps = 500,
+                          refine = 'Nelder-Mead', refine_reps = None, refine_maxfev = None, seed = 20200303, pool = '', 
+                          task = 'Bandit_block', if_baited = True, p_reward_sum = 0.45, p_reward_pairs = None, if_varying_amplitude = False, 
+                          **kwargs):
+    '''
+    Noise-aware optimization of foraging efficiency
+    
+    1. Successive halving: n_candidates quasi-random (Latin hypercube) parameter sets are all run for min_reps sessions; 
+       the best 1/eta survive and get eta times more sessions, and so on, until one is left or max_reps is reached.
+       Session i of every candidate uses the same p_reward schedule AND the same agent noise (common random numbers, crn_seeds),
+       so candidates are compared on identical sessions, and the sessions of earlier rounds are reused.
+    2. refine = 'Nelder-Mead' (or None): local search from the winner. With the seeds fixed, the efficiency over refine_reps sessions 
+       (default: the sessions of the last round) is a deterministic function of the parameters, which a simplex search can handle.
+    
+    Returns an OptimizeResult with x, fun (= - efficiency), opti_names, n_sessions (total simulated), and the rounds in 'history'
+    '''
+    from scipy.stats import qmc
+    
+    lb, ub = (np.array(bounds.lb), np.array(bounds.ub)) if isinstance(bounds, optimize.Bounds) else np.array(bounds).T
+    candidates = qmc.scale(qmc.LatinHypercube(d = len(opti_names), seed = seed).random(n_candidates), lb, ub)
+    seeds = crn_seeds(max_reps, seed)
+    n_workers = n_pool_workers(pool)
+    n_sessions_total = 0
+    
+    def bandit_kwargs(x):
+        return {'task': task, 'if_baited': if_baited, 'p_reward_sum': p_reward_sum, 'p_reward_pairs': p_reward_pairs, 
+                'if_varying_amplitude': if_varying_amplitude, 'if_para_optim': True, **generate_kwargs(forager, opti_names, x), **kwargs}
+    
+    def run_sessions(xs, start, stop):
+        ''' Efficiency of each x in xs for sessions [start, stop) --> [len(xs), stop - start] '''
+        nonlocal n_sessions_total
+        chunk = int(np.clip(np.ceil(len(xs) * (stop - start) / (4 * n_workers)), 1, stop - start))
+        units = [(ii, ss, min(ss + chunk, stop)) for ii in range(len(xs)) for ss in range(start, stop, chunk)]
+        outputs = run_units([(bandit_kwargs(xs[ii]), s1 - s0, seeds[s0:s1]) for ii, s0, s1 in units], ['foraging_efficiency'], pool = pool)
+        
+        efficiency = np.zeros([len(xs), stop - start])
+        for (ii, s0, s1), output in zip(units, outputs):
+            efficiency[ii, s0 - start : s1 - start] = output['foraging_efficiency']
+        n_sessions_total += len(xs) * (stop - start)
+        return efficiency
+    
+    # == 1. Successive halving ==
+    efficiency = np.full([n_candidates, max_reps], np.nan)
+    alive = np.arange(n_candidates)
+    n_done, n_next = 0, min(min_reps, max_reps)
+    history = []
+    
+    while True:
+        efficiency[alive, n_done:n_next] = run_sessions(candidates[alive], n_done, n_next)
+        n_done = n_next
+        mean_eff = np.mean(efficiency[alive, :n_done], axis = 1)
+        history.append({'candidates': candidates[alive], 'n_reps': n_done, 'efficiency': mean_eff})
+        print('  halving: %3g candidates x %4g sessions, best efficiency = %.4f' % (len(alive), n_done, np.max(mean_eff)))
+        
+        if len(alive) == 1 or n_done >= max_reps: break
+        alive = alive[np.argsort(- mean_eff)[: max(1, int(np.ceil(len(alive) / eta)))]]
+        n_next = min(n_done * eta, max_reps)
+        
+    best = alive[np.argmax(mean_eff)]
+    x_best, fun_best = candidates[best], - np.max(mean_eff)
+    
+    # == 2. Local refinement on fixed sessions ==
+    if refine:
+        refine_reps = min(refine_reps or n_done, max_reps)
+        cache = {tuple(np.round(x_best, 12)): fun_best} if refine_reps == n_done else {}
+        
+        def neg_efficiency(x):
+            key = tuple(np.round(x, 12))
+            if key not in cache:
+                cache[key] = - np.mean(run_sessions(np.array([x]), 0, refine_reps))
+            return cache[key]
+        
+        refined = optimize.minimize(neg_efficiency, x_best, method = refine, bounds = optimize.Bounds(lb, ub), 
+                                    options = {'maxfev': refine_maxfev or 20 * len(opti_names), 'xatol': 1e-3, 'fatol': 1e-4})
+        fun_start = neg_efficiency(x_best)   # The winner on the same sessions
+        if refined.fun < fun_start:
+            x_best, fun_best = refined.x, refined.fun
+        history.append({'refine': refine, 'n_reps': refine_reps, 'nfev': refined.nfev, 'fun_start': fun_start, 'fun': refined.fun})
+        print('  %s on %g sessions: efficiency %.4f --> %.4f (%g evaluations)' % (refine, refine_reps, -fun_start, -refined.fun, refined.nfev))
+    
+    return optimize.OptimizeResult(x = x_best, fun = fun_best, opti_names = opti_names, n_sessions = n_sessions_total, 
+                                   history = history, method = 'halving')
+
 
 def para_optimize(forager, n_reps_per_iter = 200, opti_names = '', bounds = '', pool = '', 
                   if_baited = True, p_reward_sum = 0.45, p_reward_pairs = None, if_varying_amplitude = False, 
-                  task='Bandit_block', 
+                  task='Bandit_block', if_plot = True, method = 'DE', halving_settings = {},
                   **kwargs):
+    '''
+    method = 'DE': differential evolution (n_reps_per_iter sessions per candidate, same p_reward schedule for all sessions),
+                   a whole generation at a time (score_func_population)
+    method = 'halving': successive halving with common random numbers (see para_optimize_halving; n_reps_per_iter is the maximum
+                        number of sessions per candidate, halving_settings are passed to it)
+    '''
     
     start = time.time()
     
@@ -497,7 +772,7 @@ def para_optimize(forager, n_reps_per_iter = 200, opti_names = '', bounds = '',
             bounds = optimize.Bounds([1,0],[100,1])
     
         elif forager == 'Bari2019':
-            opti_names = ['step_sizes','forget_rate','softmax_temperature']
+            opti_names = ['learn_rate','forget_rate','softmax_temperature']
             bounds = optimize.Bounds([0.01,0,0.01],[0.5,0.2,1])
             
         elif forager == 'Corrado2005':
@@ -509,7 +784,7 @@ def para_optimize(forager, n_reps_per_iter = 200, opti_names = '', bounds = '',
             bounds = optimize.Bounds([1,10,0.1],[10,50,1])
     
         elif forager == 'Hattori2019':
-            opti_names = ['step_size_unrew', 'step_size_rew', 'forget_rate', 'softmax_temperature']
+            opti_names = ['learn_rate_unrew', 'learn_rate_rew', 'forget_rate', 'softmax_temperature']
             bounds = optimize.Bounds([0.01,0.01, 0, 0.1],[0.5, 0.5, 0.5, 1])
             
         elif forager == 'PatternMelioration':
@@ -533,13 +808,18 @@ def para_optimize(forager, n_reps_per_iter = 200, opti_names = '', bounds = '',
             bounds = optimize.Bounds([0.005, 0.01, 0, 2],[1, 1, 1, 20])
 
         
-    # Parameter optimization with DE    
-    opti_para = optimize.differential_evolution(func = score_func, 
-                                                args = (forager, opti_names, n_reps_per_iter, if_baited, p_reward_sum, p_reward_pairs, 
-                                                        if_varying_amplitude, pool, task, kwargs), 
-                                                bounds = bounds, 
-                                                workers = 1, disp=True, strategy = 'best1bin',
-                                                mutation=(0.5, 1), recombination = 0.7, popsize = 20)
+    if method == 'halving':
+        opti_para = para_optimize_halving(forager, opti_names, bounds, max_reps = n_reps_per_iter, pool = pool, task = task,
+                                          if_baited = if_baited, p_reward_sum = p_reward_sum, p_reward_pairs = p_reward_pairs, 
+                                          if_varying_amplitude = if_varying_amplitude, **halving_settings, **kwargs)
+    else:
+        # Parameter optimization with DE (one batch of sessions per generation, see score_func_population)
+        opti_para = optimize.differential_evolution(func = score_func_population, 
+                                                    args = (forager, opti_names, n_reps_per_iter, if_baited, p_reward_sum, p_reward_pairs, 
+                                                            if_varying_amplitude, pool, task, kwargs), 
+                                                    bounds = bounds, 
+                                                    vectorized = True, updating = 'deferred', disp=True, strategy = 'best1bin',
+                                                    mutation=(0.5, 1), recombination = 0.7, popsize = 20)
 
     # Rerun using the optimized parameters
     kwargs_all = generate_kwargs(forager, opti_names, opti_para.x)
@@ -549,8 +829,9 @@ def para_optimize(forager, n_reps_per_iter = 200, opti_names = '', bounds = '',
     bandit = bandit_to_use(if_baited = if_baited, p_reward_sum = p_reward_sum, 
                     p_reward_pairs = p_reward_pairs, if_varying_amplitude = if_varying_amplitude, **kwargs_all)
     
-    run_sessions_parallel(bandit, n_reps = 500, pool = pool)
+    run_sessions_parallel(bandit, n_reps = 500, pool = pool, if_plot = if_plot)
                           
+    opti_para.opti_names = opti_names
     print(opti_para)
     print(opti_names)
     
@@ -561,25 +842,65 @@ def para_optimize(forager, n_reps_per_iter = 200, opti_names = '', bounds = '',
 # =============================================================================
 #   Model competition (for performance, NOT model comparison for fitting data) 
 # ===============================================================================
+# Source whose changes can change a model_compet result (part of its cache keys)
+MODEL_COMPET_CODE = ['models.bandit_model', 'models.random_walk', 'utils.helper_func', __name__]
+
 def model_compet(model_compet_settings, task='Bandit_block',
-                 n_reps = 200, pool = '', if_baited = True, p_reward_sum = 0.45, p_reward_pairs = None):
+                 n_reps = 200, pool = '', if_baited = True, p_reward_sum = 0.45, p_reward_pairs = None,
+                 ci_target = None, min_reps = 20, n_trials = 1000,
+                 store = None, if_rerun = False, if_plot = True):
+    '''
+    With ci_target, each parameter set (and baseline) runs until the 95% CI half-width of its foraging efficiency < ci_target,
+    with at most n_reps sessions (see para_scan_nd)
+    
+    All settings and baselines are run as one workload (para_scan_batch). Caching is opt-in: with a store (a ResultStore or its folder,
+    e.g. '../results/model_compet/'),
+        - each baseline is saved under 'baseline_<forager>_<hash of the task parameters>' and reused by later calls with the same task;
+        - the whole competition is saved under 'model_compet_<hash of all arguments>' (returned as 'key'), and the same call 
+          only loads and replots it (unless if_rerun). See also replot_model_compet(key).
+    Both hashes include the source of the simulation code (MODEL_COMPET_CODE), so nothing is reused after the models change.
+    '''
+    store = ResultStore(store) if isinstance(store, str) else store
     
-    model_compet_results = []   # Foraging efficiency mean
+    # Run baseline models: random, ideal_greedy, and ideal-p^-optimal
+    baseline_models = ['IdealpHatOptimal',
+                       'IdealpHatGreedy','pMatching',
+                       #'IdealpGreedy',
+                       'Random'] \
+                      if task == 'Bandit_block'\
+                      else ['Random']
     
-    for this_setting in model_compet_settings:
-        
-        forager = this_setting['forager']
-        para_to_scan = this_setting['para_to_scan']
-        para_to_fix = this_setting['para_to_fix']
+    task_paras = {'task': task, 'if_baited': if_baited, 'p_reward_sum': p_reward_sum, 'p_reward_pairs': p_reward_pairs, 'n_trials': n_trials,
+                  'n_reps': n_reps, 'ci_target': ci_target, 'min_reps': min_reps, 'code': code_digest(MODEL_COMPET_CODE)}
+    key = 'model_compet_%s' % spec_digest({'model_compet_settings': model_compet_settings, **task_paras})
     
-        # Run simulation
-        results_para_scan = para_scan(forager, para_to_scan, **para_to_fix , task=task,
-                                      if_baited = if_baited, p_reward_sum = p_reward_sum, p_reward_pairs = p_reward_pairs, n_reps = n_reps, pool = pool, if_plot = False)
-        
-        # Fetch data
-        paras_foraging_efficiency = results_para_scan['foraging_efficiency_per_session']
-        fe_mean = np.mean(paras_foraging_efficiency, axis = 1)
-        fe_CI95 = 1.96 * np.std(paras_foraging_efficiency, axis = 1) / np.sqrt(n_reps)
+    if store is not None and store.exists(key) and not if_rerun:
+        print('--- model_compet: loaded %s from %s ---' % (key, store.root))
+        return replot_model_compet(key, store) if if_plot else {**store.load(key)['model_compet'], 'key': key}
+    
+    # == Settings and uncached baselines, as one sharded workload ==
+    scans = [(this_setting['forager'], this_setting['para_to_scan'], {'n_trials': n_trials, **this_setting['para_to_fix']}) 
+             for this_setting in model_compet_settings]
+    
+    baseline_keys = {bm: 'baseline_%s_%s' % (bm, spec_digest(task_paras)) for bm in baseline_models}
+    baseline_results = {bm: store.load(baseline_keys[bm])['results_scan'] for bm in baseline_models 
+                        if store is not None and store.exists(baseline_keys[bm]) and not if_rerun}
+    baselines_to_run = [bm for bm in baseline_models if bm not in baseline_results]
+    scans += [(bm, {}, {'n_trials': n_trials}) for bm in baselines_to_run]   # A 0-D scan = one cell
+    
+    results_all_scans = para_scan_batch(scans, task = task, n_reps = n_reps, pool = pool, ci_target = ci_target, min_reps = min_reps,
+                                        if_baited = if_baited, p_reward_sum = p_reward_sum, p_reward_pairs = p_reward_pairs)
+    
+    for bm, results in zip(baselines_to_run, results_all_scans[len(model_compet_settings):]):
+        baseline_results[bm] = results
+        if store is not None: store.save(baseline_keys[bm], results_scan = results, task_paras = task_paras)
+    
+    # == Fetch data ==
+    model_compet_results = []   # Foraging efficiency mean
+    
+    for results_para_scan in results_all_scans[:len(model_compet_settings)]:
+        fe_mean = results_para_scan['foraging_efficiency_mean'].ravel()
+        fe_CI95 = results_para_scan['foraging_efficiency_CI95'].ravel()
 
         # matching_slope = results_para_scan['linear_fit_log_income_ratio'][:,3,0]  # "Slope" in Iigaya 2019
         # matching_slope_CI95 = results_para_scan['linear_fit_log_income_ratio'][:,3,1]
@@ -587,45 +908,41 @@ def model_compet(model_compet_settings, task='Bandit_block',
         # For model competition, it is unfair that I group all blocks over all sessions and then fit the line once.
         # Because this would lead to a very small slope_CI95 that may mask the high variability of matching slope due to extreme biases in never-explore regime.
         # I should compute a macthing slope for each session and then calculate the CI95 using the same way as foraging efficiency. 
-        paras_matching_slope = results_para_scan['linear_fit_income_per_session']
-        ms_mean = np.nanmean(paras_matching_slope, axis = 1)
-        ms_CI95 = 1.96 * np.nanstd(paras_matching_slope, axis = 1) / np.sqrt(n_reps)
+        ms_mean = results_para_scan['matching_slope_mean'].ravel()
+        ms_CI95 = results_para_scan['matching_slope_CI95'].ravel()
 
         # Cache data
         model_compet_results.append(np.vstack((fe_mean, fe_CI95, ms_mean, ms_CI95)))
         
-    # Run baseline models: random, ideal_greedy, and ideal-p^-optimal
-    baseline_models = [#'IdealpHatOptimal',
-                       'IdealpHatGreedy','pMatching',
-                       #'IdealpGreedy',
-                       'Random'] \
-                      if task == 'Bandit_block'\
-                      else ['Random']
     baseline_eff = []
     baseline_ms = []
     
     for bm in baseline_models:
-        
-        bandit_to_use = Bandit if task == 'Bandit_block' else BanditRestless
-        bandit = bandit_to_use(forager = bm, if_baited = if_baited, p_reward_sum = p_reward_sum, p_reward_pairs = p_reward_pairs)
-        
-        results = run_sessions_parallel(bandit, n_reps = n_reps, if_plot = False, pool = pool)
-        
-        paras_matching_slope = results['linear_fit_income_per_session']
-        ms_mean = np.nanmean(paras_matching_slope, axis = 1)
-        ms_CI95 = 1.96 * np.nanstd(paras_matching_slope, axis = 1) / np.sqrt(n_reps)
-
-        baseline_eff.append(results['foraging_efficiency'])
-        baseline_ms.append([ms_mean, ms_CI95])
+        results = baseline_results[bm]
+        baseline_eff.append(np.array([results['foraging_efficiency_mean'], results['foraging_efficiency_CI95']]))
+        baseline_ms.append([np.atleast_1d(results['matching_slope_mean']), np.atleast_1d(results['matching_slope_CI95'])])
         
         # if bm == 'IdealOptimal':
         #     ms_IO_analytical = results['matching_slope_IdealOptimal_theoretical']   # Analytical matching slope of IdealOptimal
     
-    plot_model_compet(model_compet_results, model_compet_settings, n_reps, 
-                      [baseline_models, baseline_eff, baseline_ms], # , ms_IO_analytical], 
-                      if_baited = if_baited, p_reward_sum = p_reward_sum, p_reward_pairs = p_reward_pairs)
-    
+    # Everything plot_model_compet needs
+    compet = {'model_compet_results': model_compet_results, 'model_compet_settings': model_compet_settings, 'n_reps': n_reps, 
+              'baselines': [baseline_models, baseline_eff, baseline_ms], # , ms_IO_analytical], 
+              'if_baited': if_baited, 'p_reward_sum': p_reward_sum, 'p_reward_pairs': p_reward_pairs}
+    if store is not None: store.save(key, model_compet = compet)
     
+    if if_plot: plot_model_compet(**compet)
+    return {**compet, 'key': key}
+
+def replot_model_compet(key, store = '../results/model_compet/'):
+    '''
+    Plot a saved model_compet without any simulation
+    '''
+    store = ResultStore(store) if isinstance(store, str) else store
+    compet = store.load(key)['model_compet']
+    plot_model_compet(**compet)
+    return {**compet, 'key': key}
+
 #
 def sandro():
     
@@ -697,7 +1014,7 @@ if __name__ == '__main__':  # This line is essential for apply_async to run in W
    
     if 'apply_async' in methods:
         n_worker = int(mp.cpu_count())  # Optimal number = number of physical cores
-        pool = mp.Pool(processes = n_worker)
+        pool = get_pool(n_workers = n_worker)
         
     # =============================================================================
     #     Play with the model manually
@@ -1008,5 +1325,4 @@ if __name__ == '__main__':  # This line is essential for apply_async to run in W
     
     #%% Clear up
     if pool != '':
-        pool.close()   # Just a good practice
-        pool.join()
+        close_pool()   # Just a good practice
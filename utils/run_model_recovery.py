@@ -15,6 +15,8 @@ import sys
 from models.bandit_model import BanditModel
 from models.bandit_model_comparison import BanditModelComparison, MODELS
 from models.fitting_functions import fit_bandit, negLL_func
+from utils.shared_dataset import SharedDataset
+from utils.worker_pool import get_pool, close_pool
 from utils.plot_fitting import *
    
 def fit_para_recovery(forager, para_names, para_bounds, true_paras = None, n_models = 10, n_trials = 1000, 
@@ -113,8 +115,8 @@ def compute_LL_surface(forager, para_names, para_bounds, true_para,
     if n_grids is None:
         n_grids = [[20,20]] * len(para_names)
     
-    n_worker = int(mp.cpu_count())
-    pool_surface = mp.Pool(processes = n_worker)
+    # Use the given pool or the shared one for the surface (which is embarrassingly parallel even if the fitting is not)
+    pool_surface = pool if pool != '' else get_pool()
     para_grids = []
     
     # === 1. Generate fake data; make sure the true_paras are exactly on the grid ===
@@ -142,6 +144,7 @@ def compute_LL_surface(forager, para_names, para_bounds, true_para,
     # print('Adjusted true para on grid: %s' % np.round(true_para,3))
     choice_history, reward_history, p_reward = generate_fake_data(forager, para_names, true_para, n_trials, **kwargs)
     session_num = np.zeros_like(choice_history)[0]  # Regard as one session
+    data = SharedDataset(choice_history = choice_history, reward_history = reward_history, session_num = session_num)
 
     # === 4. Do fitting only once ===
     if fit_method == 'DE':
@@ -182,7 +185,8 @@ def compute_LL_surface(forager, para_names, para_bounds, true_para,
         # -- In parallel --
         pool_results = []
         for x,y in zip(np.nditer(pp1),np.nditer(pp2)):
-            pool_results.append(pool_surface.apply_async(negLL_func, args = ([x, y], forager, [para_names[para_2d[0]], para_names[para_2d[1]]], choice_history, reward_history, session_num, para_fixed, [])))
+            pool_results.append(pool_surface.apply_async(negLL_func, args = ([x, y], forager, [para_names[para_2d[0]], para_names[para_2d[1]]], 
+                                                                             data['choice_history'], data['reward_history'], data['session_num'], para_fixed, [])))
             
         # Must use two separate for loops, one for assigning and one for harvesting!   
         for nn,rr in tqdm(enumerate(pool_results), total = n_scan_paras, desc='LL_surface pair #%g' % ppp):
@@ -203,8 +207,7 @@ def compute_LL_surface(forager, para_names, para_bounds, true_para,
         LLsurfaces.append(LLs)
  
     
-    pool_surface.close()
-    pool_surface.join()
+    data.close()
 
     
     # Plot LL surface and fitting history
@@ -237,41 +240,60 @@ def compute_confusion_matrix(models = [1,2,3,4,5,6,7,8], n_runs = 2, n_trials =
     
     # == Simulation ==
     for rr in tqdm(range(n_runs), total = n_runs, desc = 'Runs'):
-        for mm, this_model in enumerate(models):
-            this_forager, this_para_names = this_model[0], this_model[1]
-            
-            # Generate para
-            this_true_para = []
-            for pp in this_para_names:
-                this_true_para.append(generate_random_para(this_forager, pp))
-            
-            # Generate fake data
-            choice_history, reward_history, p_reward = generate_fake_data(this_forager, this_para_names, this_true_para, n_trials = n_trials)
-            
-            # Do model comparison
-            model_comparison = BanditModelComparison(choice_history, reward_history, p_reward , models = models)
-            model_comparison.fit(pool = pool, if_verbose = False)
+        for mm in range(n_models):
+            results_this = confusion_matrix_each_run(models, mm, n_trials = n_trials, pool = pool)
             
             # Save data
             for idx in confusion_idx:
-                confusion_results['raw_' + idx][mm, :, rr] = model_comparison.results[idx]
+                confusion_results['raw_' + idx][mm, :, rr] = results_this[idx]
     
         # == Average across runs till now ==
-        for idx in confusion_idx:
-            confusion_results['confusion_' + idx] = np.nanmean(confusion_results['raw_' + idx], axis = 2)
-        
-        # == Compute inversion matrix ==
-        confusion_results['inversion_best_model_AIC'] = confusion_results['confusion_best_model_AIC'] / (1e-10 + np.sum(confusion_results['confusion_best_model_AIC'], axis = 0)) 
-        confusion_results['inversion_best_model_BIC'] = confusion_results['confusion_best_model_BIC'] / (1e-10 + np.sum(confusion_results['confusion_best_model_BIC'], axis = 0))
+        summarize_confusion_matrix(confusion_results)
         
         # == Save data (after each run) ==
-        confusion_results['models_notations'] = model_comparison.results.para_notation
+        confusion_results['models_notations'] = results_this['para_notation']
         if save_file == '':
             save_file = "confusion_results_%s_%s.p" % (n_runs, n_trials)
         
         pickle.dump(confusion_results, open(save_folder+save_file, "wb"))
         
     return
+
+def confusion_matrix_each_run(models, true_model_idx, n_trials = 1000, pool = ''):
+    '''
+    One cell of the confusion matrix: simulate models[true_model_idx] with random paras and fit all models to it
+    '''
+    this_forager, this_para_names = models[true_model_idx][0], models[true_model_idx][1]
+    
+    # Generate para
+    this_true_para = []
+    for pp in this_para_names:
+        this_true_para.append(generate_random_para(this_forager, pp))
+    
+    # Generate fake data
+    choice_history, reward_history, p_reward = generate_fake_data(this_forager, this_para_names, this_true_para, n_trials = n_trials)
+    
+    # Do model comparison
+    model_comparison = BanditModelComparison(choice_history, reward_history, p_reward , models = models)
+    model_comparison.fit(pool = pool, if_verbose = False)
+    
+    results_this = {idx: np.array(model_comparison.results[idx]) for idx in ['AIC', 'BIC', 'log10_BF_AIC', 'log10_BF_BIC', 'best_model_AIC', 'best_model_BIC']}
+    results_this['para_notation'] = model_comparison.results.para_notation
+    results_this['true_para'] = np.array(this_true_para)
+    
+    return results_this
+
+def summarize_confusion_matrix(confusion_results):
+    '''
+    Average across runs till now and compute the inversion matrix (in place)
+    '''
+    for idx in ['AIC', 'BIC', 'log10_BF_AIC', 'log10_BF_BIC', 'best_model_AIC', 'best_model_BIC']:
+        confusion_results['confusion_' + idx] = np.nanmean(confusion_results['raw_' + idx], axis = 2)
+    
+    confusion_results['inversion_best_model_AIC'] = confusion_results['confusion_best_model_AIC'] / (1e-10 + np.sum(confusion_results['confusion_best_model_AIC'], axis = 0)) 
+    confusion_results['inversion_best_model_BIC'] = confusion_results['confusion_best_model_BIC'] / (1e-10 + np.sum(confusion_results['confusion_best_model_BIC'], axis = 0))
+    
+    return confusion_results
         
 def generate_random_para(forager, para_name):
     # With slightly narrower range than fitting bounds in BanditModelComparison
@@ -302,7 +324,7 @@ if __name__ == '__main__':
     # - Speed: L-BFGS-B = SLSQP  >> TNC >>> trust-constr
     
     n_worker = int(mp.cpu_count()/2)
-    pool = mp.Pool(processes = n_worker)
+    pool = get_pool(n_workers = n_worker)   # Shared by everything below
     
     #%% --- Use async to run multiple initializations ---
     # Para recovery
@@ -664,8 +686,7 @@ if __name__ == '__main__':
     # plot_confusion_matrix(confusion_results)
     
     #%%
-    pool.close()   # Just a good practice
-    pool.join()
+    close_pool()   # Just a good practice
 
     
     
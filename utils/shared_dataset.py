@@ -0,0 +1,135 @@
+'''
+Shared-memory transport of datasets to pool workers
+
+Instead of pickling choice_history, reward_history etc. into every apply_async task or DE evaluation,
+the arrays are copied once into multiprocessing.shared_memory, and only small handles (name, shape, dtype)
+are sent to the workers. A worker attaches each segment on first use and caches the view,
+so the later tasks with the same dataset cost nothing.
+
+    with SharedDataset(choice_history = choice_history, reward_history = reward_history) as data:
+        pool.apply_async(func, args = (data['choice_history'], data['reward_history']))
+
+    # In the worker
+    choice_history = resolve(choice_history)   # ndarray handles pass through untouched
+
+The owner process (the one who created the SharedDataset) unlinks the segments on close().
+'''
+
+import os
+import sys
+import ctypes
+import weakref
+from collections import namedtuple, OrderedDict
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+from utils.instrumentation import timed
+
+# Picklable handle of an array in shared memory
+SharedArray = namedtuple('SharedArray', ['name', 'shape', 'dtype'])
+
+# Per-process cache of attached segments {name: ndarray}
+_attached = OrderedDict()
+MAX_ATTACHED = 16   # Older datasets are detached when a worker has seen more than this
+
+
+def _attach_untracked(name):
+    '''
+    Attach an existing segment without leaving it registered to the resource_tracker
+    (otherwise, on Python < 3.13, the tracker would unlink the segment, or complain about leaking it, when a worker exits)
+    '''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name = name, track = False)
+
+    shm = shared_memory.SharedMemory(name = name)
+    if os.name == 'posix':   # Only POSIX segments are registered
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+class _Mapping:
+    '''
+    The owner (numpy base) of every array made from one attached segment. Views and slices of those arrays keep it alive,
+    so once the last of them (including the cached one) is gone, it is collected and the segment is closed.
+    (Arrays made directly from shm.buf can't be tracked like this: recent numpy releases the buffer export right away,
+    so shm.close() would succeed and unmap memory still in use.)
+    '''
+    def __init__(self, shm, shape, dtype, readonly = True):
+        buffer = ctypes.c_char.from_buffer(shm.buf)
+        address = ctypes.addressof(buffer)
+        del buffer   # Only the address is kept; the mapping stays until shm.close()
+        self.__array_interface__ = {'data': (address, readonly), 'shape': tuple(shape), 'typestr': np.dtype(dtype).str, 'version': 3}
+        weakref.finalize(self, shm.close)
+
+def _map(shm, shape, dtype, readonly = True):
+    return np.asarray(_Mapping(shm, shape, dtype, readonly))
+
+def _evict(name):
+    _attached.pop(name)   # Closed as soon as no view of it is left in this process (maybe right now)
+
+def resolve(x):
+    '''
+    SharedArray --> (read-only) ndarray view of the shared memory; anything else is returned as is
+    '''
+    if not isinstance(x, SharedArray):
+        return x
+
+    if x.name in _attached:
+        _attached.move_to_end(x.name)
+        return _attached[x.name]
+
+    array = _map(_attach_untracked(x.name), x.shape, x.dtype)
+
+    _attached[x.name] = array
+    while len(_attached) > MAX_ATTACHED:
+        _evict(next(iter(_attached)))
+
+    return array
+
+
+class SharedDataset:
+    '''
+    Owner of a group of arrays in shared memory.
+    Non-array values (None, lists...) and arrays that are already SharedArray handles are passed through as they are.
+    if_share = False makes it a no-op (e.g., in serial mode), so that callers don't need two code paths.
+    '''
+    def __init__(self, if_share = True, **arrays):
+        self.handles = {}
+        self._owned = []
+
+        for key, value in arrays.items():
+            if if_share and isinstance(value, np.ndarray) and value.size > 0:
+                value = np.ascontiguousarray(value)
+                with timed('shared_memory_copy', nbytes = value.nbytes):
+                    shm = shared_memory.SharedMemory(create = True, size = value.nbytes)
+                    shared = _map(shm, value.shape, value.dtype, readonly = False)
+                    shared[:] = value
+                    shared.flags.writeable = False
+
+                handle = SharedArray(shm.name, value.shape, value.dtype.str)
+                _attached[shm.name] = shared   # The owner resolves its own handles without re-attaching
+                self._owned.append(shm)
+                self.handles[key] = handle
+            else:
+                self.handles[key] = value
+
+    def __getitem__(self, key):
+        return self.handles[key]
+
+    def close(self):
+        for shm in self._owned:
+            if shm.name in _attached:
+                _evict(shm.name)
+            if sys.version_info < (3, 13) and os.name == 'posix':
+                resource_tracker.register(shm._name, 'shared_memory')   # A worker sharing our tracker may have unregistered it
+            shm.unlink()
+        self._owned = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if self._owned: self.close()
@@ -0,0 +1,57 @@
+'''
+Build a DataFrame once from pieces collected in a loop
+
+Growing a DataFrame with df.append / pd.concat inside a loop copies the whole table at every step (quadratic),
+and DataFrame.append is gone in pandas 2. Collect the pieces here instead and materialize them once at the end:
+
+    table = TableBuilder()
+    for mm, model in enumerate(models):
+        table.add_row({'model': forager, 'AIC': AIC, 'para_fitted': x}, index = mm + 1)   # One row (cells may be lists/arrays)
+        table.add_frame(df_this)                                                           # Or a whole chunk
+    df = table.build()
+
+Consecutive rows are turned into one frame, and all frames are concatenated in a single pd.concat,
+so the result is the same as the old chain of appends (columns in order of appearance, original indices kept).
+'''
+
+import pandas as pd
+
+
+class TableBuilder:
+
+    def __init__(self):
+        self._chunks = []   # DataFrames, or [rows, index] for a run of add_row calls
+
+    def add_row(self, row, index = None):
+        '''
+        row: {column: value}, where a value is stored as-is in one cell (so lists and arrays are fine).
+        index: label of this row (default: its position in the run of rows)
+        '''
+        if not self._chunks or isinstance(self._chunks[-1], pd.DataFrame):
+            self._chunks.append([[], []])
+        rows, indices = self._chunks[-1]
+        rows.append(row)
+        indices.append(index)
+
+    def add_frame(self, df):
+        '''
+        df: a DataFrame, or {column: array} of equal-length columns
+        '''
+        if not isinstance(df, pd.DataFrame):
+            df = pd.DataFrame(df)
+        self._chunks.append(df)
+
+    def __len__(self):
+        return sum(len(chunk) if isinstance(chunk, pd.DataFrame) else len(chunk[0]) for chunk in self._chunks)
+
+    def build(self, ignore_index = False):
+        frames = []
+        for chunk in self._chunks:
+            if isinstance(chunk, pd.DataFrame):
+                frames.append(chunk)
+            else:
+                rows, indices = chunk
+                frames.append(pd.DataFrame.from_records(rows, index = None if None in indices else indices))
+
+        if not frames: return pd.DataFrame()
+        return pd.concat(frames, ignore_index = ignore_index)
@@ -0,0 +1,90 @@
+'''
+A long-lived worker pool shared by the whole library
+
+Before, every DE fit with workers = cpu_count() spun up (and tore down) its own pool, and so did compute_LL_surface,
+i.e., hundreds of times in a single fit_all_mice run. Now one pool is created on first use and kept until exit:
+
+    from utils.worker_pool import get_pool
+    pool = get_pool()          # Same object every time
+    fit_bandit(..., pool = pool)
+
+Workers import the compute modules once in the initializer, and keep the shared-memory datasets they have seen
+attached (see utils/shared_dataset.py), so consecutive tasks on the same mouse pay nothing for setup.
+'''
+
+import atexit
+import importlib
+import multiprocessing as mp
+import multiprocessing.pool
+
+from utils import instrumentation
+
+# Modules that every task needs. Importing them in the initializer moves the cost out of the first task.
+WARM_MODULES = ['numpy', 'scipy.optimize', 'models.bandit_model', 'models.fitting_functions', 'utils.shared_dataset']
+
+_pool = None
+
+
+def _init_worker(warm_modules):
+    for module in warm_modules:
+        importlib.import_module(module)
+
+class WorkerPool(multiprocessing.pool.Pool):
+    '''
+    multiprocessing Pool whose workers are warmed up on start. Can be used anywhere a mp.Pool was used.
+    '''
+    def __init__(self, processes = None, warm_modules = WARM_MODULES, context = None):
+        super().__init__(processes = processes, initializer = _init_worker, initargs = (warm_modules,), context = context)
+        self.n_workers = self._processes
+
+    def apply_async(self, func, args = (), kwds = {}, callback = None, error_callback = None):
+        if instrumentation.enabled():   # Pickling cost in the parent, and the task itself in the worker
+            instrumentation.pickled_size((func, args, kwds))
+            func, args = instrumentation.timed_call, ('pool_task:%s' % getattr(func, '__name__', 'task'), func, *args)
+        return super().apply_async(func, args, kwds, callback, error_callback)
+
+    def de_map(self, func, iterable):
+        ''' Map-like callable for optimize.differential_evolution(workers = ...) '''
+        iterable = list(iterable)
+        instrumentation.pickled_size((func, iterable))
+        return self.map(func, iterable, chunksize = max(1, len(iterable) // (4 * self.n_workers)))
+
+
+def get_pool(n_workers = None):
+    '''
+    Return the shared pool (created on first call). n_workers only matters for the first call.
+    '''
+    global _pool
+    if _pool is None:
+        _pool = WorkerPool(processes = n_workers or int(mp.cpu_count()))
+        atexit.register(close_pool)
+    return _pool
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()   # Just a good practice
+        _pool.join()
+        _pool = None
+
+def n_pool_workers(pool, n_workers = None):
+    '''
+    Number of workers of a pool (e.g. to split work into one chunk per worker): n_workers if given, 1 if serial (pool == ''),
+    WorkerPool.n_workers, or the default size of a multiprocessing pool for other pool-like objects
+    '''
+    if n_workers is not None:
+        return n_workers
+    if pool == '':
+        return 1
+    return getattr(pool, 'n_workers', None) or int(mp.cpu_count())
+
+def de_workers(pool):
+    '''
+    The "workers" argument of optimize.differential_evolution for a given pool:
+    serial if pool == '', otherwise DE runs on the given pool instead of creating a new one
+    '''
+    if pool == '':
+        return 1
+    if hasattr(pool, 'de_map'):
+        return pool.de_map
+    return pool.map